@@ -2,6 +2,12 @@
 
 import argparse
 import sqlite3
+import sys
+
+from db_utils import load_chemicalite, has_table
+from parallel_build import run_pipeline, create_progress_table, get_progress, set_progress, cpu_type
+from profiling import profiler, add_profile_arguments, setup_profiling
+from shards import is_manifest, shard_db_names, run_on_shards
 
 
 def compose_index_table_name(main_table_name, fp, radius_morgan):
@@ -12,10 +18,136 @@ def compose_index_table_name(main_table_name, fp, radius_morgan):
     return index_table_name
 
 
+def compose_bfp_table_name(main_table_name, fp, radius_morgan):
+    if fp in ['morgan', 'feat_morgan']:
+        bfp_table_name = f'{main_table_name}_{fp}{radius_morgan}_bfp'
+    else:
+        bfp_table_name = f'{main_table_name}_{fp}_bfp'
+    return bfp_table_name
+
+
+def compose_bfp_function(fp, mol, radius_morgan):
+    # SQL expression computing fingerprint of the given Mol expression
+    return f"mol_{fp}_bfp({mol}, {f'{radius_morgan},' if fp in ['morgan', 'feat_morgan'] else ''} 2048)"
+
+
+def create_bfp_table(con, bfp_table_name):
+    # popcounts of fingerprints are stored and indexed to restrict similarity search to compounds
+    # which can reach the threshold (t * a <= b <= a / t for a query with popcount a)
+    con.execute(f"CREATE TABLE IF NOT EXISTS {bfp_table_name} (id INTEGER PRIMARY KEY, fp BLOB, popcnt INTEGER)")
+    if 'popcnt' not in [items[1] for items in con.execute(f"PRAGMA table_info({bfp_table_name})")]:
+        # table created without popcounts
+        con.execute(f"ALTER TABLE {bfp_table_name} ADD COLUMN popcnt INTEGER")
+        con.execute(f"UPDATE {bfp_table_name} SET popcnt = bfp_weight(fp)")
+    con.execute(f"CREATE INDEX IF NOT EXISTS {bfp_table_name}_popcnt_idx ON {bfp_table_name}(popcnt)")
+
+
+def compose_bfp_insert(bfp_table_name):
+    # ?1 - rowid, ?2 - fingerprint
+    return f"INSERT OR REPLACE INTO {bfp_table_name}(id, fp, popcnt) VALUES (?1, ?2, bfp_weight(?2))"
+
+
+def compose_changes_table_name(index_table_name):
+    return f'{index_table_name}_changes'
+
+
+def create_change_tracking(con, table, mol_field, index_table_name):
+    # rowids of updated and deleted molecules are logged by triggers to be reindexed by the next incremental run
+    changes_table_name = compose_changes_table_name(index_table_name)
+    con.execute(f"CREATE TABLE IF NOT EXISTS {changes_table_name} (id INTEGER PRIMARY KEY)")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {index_table_name}_on_update AFTER UPDATE OF {mol_field} ON {table} "
+                f"BEGIN INSERT OR IGNORE INTO {changes_table_name} (id) VALUES (old.rowid); END")
+    con.execute(f"CREATE TRIGGER IF NOT EXISTS {index_table_name}_on_delete AFTER DELETE ON {table} "
+                f"BEGIN INSERT OR IGNORE INTO {changes_table_name} (id) VALUES (old.rowid); END")
+
+
+def apply_changes(con, table, mol_field, fp, radius_morgan, index_table_name, bfp_table_name, last_rowid):
+    # recomputes fingerprints of changed molecules which were indexed earlier (rowid <= last_rowid),
+    # fingerprints of deleted molecules are removed
+    changes_table_name = compose_changes_table_name(index_table_name)
+    rowids = con.execute(f"SELECT id FROM {changes_table_name} WHERE id <= ?", (last_rowid, )).fetchall()
+    if not rowids:
+        return 0
+    insert_sqls = {index_table_name: f"INSERT INTO {index_table_name}(id, fp) VALUES (?1, ?2)"}
+    if bfp_table_name is not None:
+        insert_sqls[bfp_table_name] = compose_bfp_insert(bfp_table_name)
+    for t in insert_sqls:
+        con.executemany(f"DELETE FROM {t} WHERE id = ?", rowids)
+    rows = con.execute(f"SELECT rowid, {compose_bfp_function(fp, mol_field, radius_morgan)} "
+                       f"FROM {table} "
+                       f"WHERE rowid IN (SELECT id FROM {changes_table_name} WHERE id <= ?1) AND "
+                       f"{mol_field} IS NOT NULL", (last_rowid, )).fetchall()
+    for sql in insert_sqls.values():
+        con.executemany(sql, rows)
+    con.execute(f"DELETE FROM {changes_table_name} WHERE id <= ?", (last_rowid, ))
+    return len(rowids)
+
+
+def add_fp(db_name, table, mol_field, fp, radius_morgan=2, store_bfp=False, ncpu=1, chunk_size=10000, resume=False,
+           incremental=False, verbose=False):
+    with sqlite3.connect(db_name) as con:
+
+        load_chemicalite(con)
+
+        # create a virtual table to be filled with bfp data
+        # con.execute(f"DROP TABLE IF EXISTS {table}_{fp}_idx")
+        index_table_name = compose_index_table_name(table, fp, radius_morgan)
+        index_exists = has_table(con, index_table_name)
+        con.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {index_table_name} "
+                    f"USING rdtree(id, fp bits(2048))")
+
+        write_sqls = []
+        bfp_table_name = compose_bfp_table_name(table, fp, radius_morgan)
+        if store_bfp or has_table(con, bfp_table_name):
+            create_bfp_table(con, bfp_table_name)
+        if store_bfp:
+            # fingerprints are computed once, stored and inserted in the index
+            write_sqls.append(compose_bfp_insert(bfp_table_name))
+        if incremental or not (store_bfp and index_exists):
+            write_sqls.append(f"INSERT INTO {index_table_name}(id, fp) VALUES (?1, ?2)")
+            task = index_table_name
+        else:
+            task = bfp_table_name
+        if incremental and not store_bfp and has_table(con, bfp_table_name):
+            write_sqls.append(compose_bfp_insert(bfp_table_name))
+
+        create_change_tracking(con, table, mol_field, index_table_name)
+        create_progress_table(con)
+
+        if incremental:
+            last_rowid = get_progress(con, task)
+            if last_rowid == 0 and index_exists:
+                # index was created before progress was tracked
+                last_rowid = con.execute(f"SELECT max(id) FROM {index_table_name}").fetchone()[0] or 0
+                set_progress(con, task, last_rowid)
+            with profiler.phase('apply_changes'):
+                n = apply_changes(con, table, mol_field, fp, radius_morgan, index_table_name,
+                                  bfp_table_name if has_table(con, bfp_table_name) else None, last_rowid)
+            profiler.count('changed_records', n)
+            if verbose:
+                sys.stderr.write(f'{n} changed or deleted records were reindexed\n')
+
+        con.commit()
+    con.close()
+
+    # compute and insert the fingerprints
+    select_sql = f"SELECT rowid, {compose_bfp_function(fp, mol_field, radius_morgan)} " \
+                 f"FROM {table} " \
+                 f"WHERE rowid > ?1 AND rowid <= ?2 AND {mol_field} IS NOT NULL"
+    run_pipeline(db_name, task, table, select_sql, write_sqls,
+                 ncpu=ncpu, chunk_size=chunk_size, resume=resume or incremental, verbose=verbose)
+
+    # changes of molecules indexed by this run are already taken into account
+    with sqlite3.connect(db_name) as con:
+        con.execute(f"DELETE FROM {compose_changes_table_name(index_table_name)} WHERE id <= ?",
+                    (get_progress(con, task), ))
+    con.close()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Similarity search in SQLite DB.')
     parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
-                        help='input SQLite DB.')
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py).')
     parser.add_argument('-t', '--table', metavar='STRING', default='mols',
                         help='table name where Mol objects are stored. Default: mols.')
     parser.add_argument('-m', '--mol_field', metavar='STRING', default='mol',
@@ -25,28 +157,37 @@ def main():
                         help='fingerprint type to compute. Default: morgan.')
     parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
                         help='radius of Morgan fingerprint. Default: 2.')
+    parser.add_argument('-s', '--store_bfp', required=False, default=False, action='store_true',
+                        help='additionally store fingerprints in an ordinary table keyed by rowid. Similarity search '
+                             'will score hits with stored fingerprints instead of regenerating them from Mol objects. '
+                             'Popcounts of fingerprints are stored and indexed as well to enable popcount bounded '
+                             'search (see --method of sim_search.py). If the index was created earlier, only the '
+                             'table of fingerprints is filled.')
+    parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                        help='number of cpus used to compute fingerprints. Default: 1.')
+    parser.add_argument('--chunk_size', metavar='INTEGER', default=10000, type=int,
+                        help='number of rowids processed and committed at once. Default: 10000.')
+    parser.add_argument('--resume', required=False, default=False, action='store_true',
+                        help='continue an interrupted run from the last committed rowid.')
+    parser.add_argument('-i', '--incremental', required=False, default=False, action='store_true',
+                        help='update existing index: fingerprints are computed only for molecules added after the '
+                             'previous run, molecules changed or deleted since then are reindexed or removed.')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
+                        help='print progress to stderr.')
 
-    args = parser.parse_args()
-    with sqlite3.connect(args.input_db) as con:
-
-        con.enable_load_extension(True)
-        con.load_extension('chemicalite')
-        con.enable_load_extension(False)
-
-        # create a virtual table to be filled with bfp data
-        # con.execute(f"DROP TABLE IF EXISTS {args.table}_{args.fp}_idx")
-        index_table_name = compose_index_table_name(args.table, args.fp, args.radius_morgan)
-        con.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {index_table_name} "
-                    f"USING rdtree(id, fp bits(2048))")
+    add_profile_arguments(parser)
 
-        # compute and insert the fingerprints
-        sql = f"INSERT INTO {index_table_name}(id, fp) " \
-              f"SELECT rowid, mol_{args.fp}_bfp({args.mol_field}, {f'{args.radius_morgan},' if args.fp in ['morgan', 'feat_morgan'] else ''} 2048) " \
-              f"FROM {args.table} " \
-              f"WHERE {args.mol_field} IS NOT NULL"
-        con.execute(sql)
+    args = parser.parse_args()
+    setup_profiling(args)
 
-        con.commit()
+    kwargs = dict(table=args.table, mol_field=args.mol_field, fp=args.fp, radius_morgan=args.radius_morgan,
+                  store_bfp=args.store_bfp, chunk_size=args.chunk_size, resume=args.resume,
+                  incremental=args.incremental, verbose=args.verbose)
+    if is_manifest(args.input_db):
+        # shards are processed in parallel
+        run_on_shards(add_fp, shard_db_names(args.input_db), ncpu=args.ncpu, **kwargs)
+    else:
+        add_fp(args.input_db, ncpu=args.ncpu, **kwargs)
 
 
 if __name__ == '__main__':
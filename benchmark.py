@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from db_utils import connect_db
+from sim_search import find_similar, query_bfp, has_stored_bfp
+from substr_search import query_pattern, substructure_search
+from parallel_build import cpu_type
+
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# fragments are attached to the next fragment by their last atom, rings end with an atom which can take a substituent
+RINGS = ['c1ccccc1', 'c1ccncc1', 'c1ccsc1', 'c1ccoc1', 'C1CCNCC1', 'C1CCOCC1', 'C1CCCC1', 'c1cnc2ccccc2c1',
+         'c1ccc(F)cc1', 'c1ccc(Cl)cc1', 'c1ccc(OC)cc1', 'c1cc(C)ncc1', 'C1CN(C)CCN1', 'c1nc(ncn1)']
+LINKERS = ['', 'C', 'CC', 'O', 'N', 'C(=O)N', 'NC(=O)', 'C(=O)O', 'S(=O)(=O)N', 'C=C', 'C#C', 'N(C)', 'OCC']
+# terminal groups written to be attached by their first atom (the end of a chain)
+# and by their last atom (the start of a chain)
+TERMINALS = ['', 'C', 'F', 'Cl', 'O', 'N', 'C(F)(F)F', 'C#N', 'C(=O)O', 'OC', 'N(C)C', 'C(C)C']
+LEADING_TERMINALS = ['', 'C', 'F', 'Cl', 'O', 'N', 'FC(F)(F)', 'N#C', 'OC(=O)', 'CO', 'CN(C)', 'CC(C)']
+
+# substructure queries from frequent to rare ones
+SUBSTRUCTURES = ['c1ccccc1', 'C(=O)N', 'c1ccncc1', 'S(=O)(=O)N', 'C(F)(F)F', 'c1ccsc1C(=O)N', 'c1cnc2ccccc2c1C#N']
+
+
+def generate_smiles(n, seed=42):
+    # deterministic synthetic library of linear chains of rings joined by linkers with terminal groups
+    rng = random.Random(seed)
+    for i in range(n):
+        parts = [rng.choice(LEADING_TERMINALS)]
+        for _ in range(rng.randint(1, 4)):
+            parts.append(rng.choice(RINGS))
+            parts.append(rng.choice(LINKERS))
+        parts.append(rng.choice(TERMINALS))
+        yield ''.join(parts), f'syn{i}'
+
+
+def run_script(name, *args):
+    # wall time of a script of the repository
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, name)] + [str(a) for a in args],
+                   check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def summary(times):
+    # latency statistics in milliseconds
+    times = sorted(times)
+    if not times:
+        return {}
+
+    def q(p):
+        return round(times[min(len(times) - 1, int(p * len(times)))] * 1000, 3)
+
+    return {'n': len(times), 'mean': round(sum(times) / len(times) * 1000, 3),
+            'p50': q(0.5), 'p90': q(0.9), 'p99': q(0.99), 'max': round(times[-1] * 1000, 3)}
+
+
+def build_db(work_dir, smiles, fp, radius_morgan, ncpu):
+    # DB is built by the ordinary sequence of scripts, every stage is timed
+    smi_fname = os.path.join(work_dir, 'library.smi')
+    db_name = os.path.join(work_dir, 'library.db')
+    with open(smi_fname, 'wt') as f:
+        for smi, mol_id in smiles:
+            f.write(f'{smi}\t{mol_id}\n')
+    if os.path.exists(db_name):
+        os.remove(db_name)
+    stages = {
+        'create_db': run_script('create_db.py', '-i', smi_fname, '-o', db_name),
+        'create_mol_field': run_script('create_mol_field.py', '-d', db_name, '-c', ncpu),
+        f'add_fp_to_db_{fp}': run_script('add_fp_to_db.py', '-d', db_name, '-f', fp, '-r', radius_morgan,
+                                         '-c', ncpu, '--store_bfp'),
+        'add_fp_to_db_pattern': run_script('add_fp_to_db.py', '-d', db_name, '-f', 'pattern', '-c', ncpu),
+    }
+    return db_name, {'seconds': {k: round(v, 3) for k, v in stages.items()},
+                     'db_size_bytes': os.path.getsize(db_name)}
+
+
+def bench_similarity(db_name, queries, fp, radius_morgan, threshold, limit, methods):
+    # single query latencies of threshold and top-k searches for every candidate selection method
+    con = connect_db(db_name)
+    stored_bfp = has_stored_bfp(con, 'mols', fp, radius_morgan)
+    bfps = [query_bfp(con, smi, fp, radius_morgan) for smi, _ in queries]
+    bfps = [bfp for bfp in bfps if bfp is not None]
+    output = {}
+    for method in methods:
+        for name, t, k in [('threshold', threshold, None), ('topk', None, limit)]:
+            # the first queries warm up the page cache
+            for bfp in bfps[:5]:
+                find_similar(con, bfp, fp, 'mol', 'mols', t, k, radius_morgan, stored_bfp, method)
+            times = []
+            hits = 0
+            for bfp in bfps:
+                start = time.perf_counter()
+                hits += len(find_similar(con, bfp, fp, 'mol', 'mols', t, k, radius_morgan, stored_bfp, method))
+                times.append(time.perf_counter() - start)
+            output[f'{method}_{name}'] = dict(summary(times), hits=hits)
+    con.close()
+    return output
+
+
+def bench_bulk(db_name, work_dir, queries, fp, radius_morgan, threshold, ncpus):
+    # throughput of bulk_sim_search.py depending on the number of cpus
+    query_fname = os.path.join(work_dir, 'queries.smi')
+    output_fname = os.path.join(work_dir, 'bulk_output.txt')
+    with open(query_fname, 'wt') as f:
+        for smi, mol_id in queries:
+            f.write(f'{smi}\t{mol_id}\n')
+    output = []
+    for ncpu in ncpus:
+        seconds = run_script('bulk_sim_search.py', '-d', db_name, '-i', query_fname, '-o', output_fname,
+                             '-f', fp, '-r', radius_morgan, '-p', threshold, '-c', ncpu)
+        output.append({'ncpu': ncpu, 'seconds': round(seconds, 3),
+                       'queries_per_second': round(len(queries) / seconds, 3)})
+    return output
+
+
+def bench_substructure(db_name, nmols, repeats=3):
+    # latencies of substructure queries of different selectivity
+    con = connect_db(db_name)
+    output = []
+    for smarts in SUBSTRUCTURES:
+        qmol, qbfp = query_pattern(con, smarts)
+        if qmol is None:
+            continue
+        candidates = con.execute("SELECT count(*) FROM mols_pattern_idx WHERE id MATCH rdtree_subset(?1)",
+                                 (qbfp, )).fetchone()[0]
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            hits = sum(1 for _ in substructure_search(con, 'mols', 'mol', qmol, qbfp))
+            times.append(time.perf_counter() - start)
+        output.append(dict(summary(times), query=smarts, hits=hits, candidates=candidates,
+                           selectivity=round(hits / max(nmols, 1), 6)))
+    con.close()
+    return output
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SCRIPT_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of building DB and similarity, bulk and substructure '
+                                                 'searches on a deterministic synthetic library. Results are saved '
+                                                 'as JSON to compare different versions of scripts.')
+    parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
+                        help='output JSON file. If omitted output will be printed to STDOUT.')
+    parser.add_argument('-s', '--scales', metavar='INTEGER', default=[10000], type=int, nargs='*',
+                        help='sizes of synthetic libraries, e.g. 10000 100000 1000000. Default: 10000.')
+    parser.add_argument('-w', '--work_dir', metavar='DIRNAME', default=None,
+                        help='directory where libraries and DBs are created. If omitted a temporary directory is '
+                             'used and removed at the end. Default: None.')
+    parser.add_argument('--seed', metavar='INTEGER', default=42, type=int,
+                        help='seed of the synthetic library and of the selection of queries. Default: 42.')
+    parser.add_argument('-n', '--nqueries', metavar='INTEGER', default=100, type=int,
+                        help='number of queries sampled from the library. Default: 100.')
+    parser.add_argument('-f', '--fp', metavar='STRING', default='morgan',
+                        choices=['morgan', 'feat_morgan', 'atom_pairs', 'rdkit', 'topological_torsion'],
+                        help='fingerprint type used for similarity search. Default: morgan.')
+    parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
+                        help='radius of Morgan fingerprint. Default: 2.')
+    parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=0.7, type=float,
+                        help='Tanimoto similarity threshold. Default: 0.7.')
+    parser.add_argument('-l', '--limit', metavar='INTEGER', default=10, type=int,
+                        help='number of compounds retrieved by top-k searches. Default: 10.')
+    parser.add_argument('--methods', metavar='STRING', default=['rdtree', 'popcount'], nargs='*',
+                        choices=['rdtree', 'popcount'],
+                        help='candidate selection methods of similarity search to compare. '
+                             'Default: rdtree popcount.')
+    parser.add_argument('-c', '--ncpu', metavar='INTEGER', default=[cpu_type(i) for i in (1, 2, 4)], type=cpu_type,
+                        nargs='*',
+                        help='numbers of cpus used by bulk search. Default: 1 2 4.')
+    parser.add_argument('--build_ncpu', default=cpu_type(os.cpu_count()), type=cpu_type,
+                        help='number of cpus used to build DB. Default: all cpus.')
+
+    args = parser.parse_args()
+
+    work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix='chemicalite_benchmark_')
+    os.makedirs(work_dir, exist_ok=True)
+    results = {'meta': {'commit': git_commit(),
+                        'python': platform.python_version(),
+                        'sqlite': sqlite3.sqlite_version,
+                        'platform': platform.platform(),
+                        'cpu_count': os.cpu_count(),
+                        'args': {k: v for k, v in vars(args).items() if k not in ('output', 'work_dir')}},
+               'scales': []}
+
+    try:
+        for n in args.scales:
+            smiles = list(generate_smiles(n, args.seed))
+            queries = random.Random(args.seed).sample(smiles, min(args.nqueries, len(smiles)))
+            db_name, build = build_db(work_dir, smiles, args.fp, args.radius_morgan, args.build_ncpu)
+            con = sqlite3.connect(db_name)
+            nmols = con.execute("SELECT count(*) FROM mols").fetchone()[0]
+            con.close()
+            results['scales'].append({
+                'n': n,
+                'nmols': nmols,
+                'build': build,
+                'similarity': bench_similarity(db_name, queries, args.fp, args.radius_morgan, args.threshold,
+                                               args.limit, args.methods),
+                'bulk': bench_bulk(db_name, work_dir, queries, args.fp, args.radius_morgan, args.threshold,
+                                   sorted(set(args.ncpu))),
+                'substructure': bench_substructure(db_name, nmols),
+            })
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.output is not None:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,50 +1,93 @@
 #!/usr/bin/env python3
 
 import argparse
-import sqlite3
 from multiprocessing import Pool, cpu_count
 from functools import partial
-from itertools import islice
-from sim_search import sql_for_similarity
+from parallel_build import bounded_imap
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from query_cache import QueryCache
+from query_prep import open_prep_pool, iter_prepared, add_prep_arguments
+from result_writers import SIMILARITY_COLUMNS, open_writer, add_output_arguments
+from shards import is_manifest, shard_db_names, merge_hits, ShardPool
+from sim_search import search_similar, top_k_similarity, connect_db, query_bfp, has_stored_bfp, read_smi
 
 
-def cpu_type(x):
-    return max(1, min(int(x), cpu_count()))
+_con = None
+_cache = None
 
 
-def take(n, iterable):
-    return list(islice(iterable, n))
+def cpu_type(x):
+    return max(1, min(int(x), cpu_count()))
 
 
-def get_similarity(con, fp, mol_field, table, query, threshold, limit, radius_morgan):
-    while threshold >= 0:
-        sql = sql_for_similarity(fp=fp, mol_field=mol_field, table=table, limit=limit, radius_morgan=radius_morgan)
-        res = con.execute(sql, (query, threshold)).fetchall()
-        if len(res) < limit:
-            threshold -= 0.1
+def get_similarity(con, fp, mol_field, table, query, threshold, limit, radius_morgan, bfp=None, method='rdtree'):
+    profiler.count('queries')
+    if bfp is None:
+        with profiler.phase('query_prep'):
+            bfp = query_bfp(con, query, fp, radius_morgan)
+    if bfp is None:
+        profiler.count('invalid_queries')
+        return []
+    stored_bfp = has_stored_bfp(con, table, fp, radius_morgan)
+    with profiler.phase('search'):
+        if limit is None:
+            res = search_similar(con, bfp, threshold, fp=fp, mol_field=mol_field, table=table,
+                                 radius_morgan=radius_morgan, stored_bfp=stored_bfp, method=method)
         else:
-            return res
-
-
-def calc_sim_for_smiles(smiles, db_name, fp, mol_field, table, threshold, limit, radius_morgan):
-    with sqlite3.connect(db_name) as con, sqlite3.connect(':memory:') as dest:
-        con.backup(dest)
-        dest.enable_load_extension(True)
-        dest.load_extension('chemicalite')
-        dest.enable_load_extension(False)
-        all_res = []
-        for mol_id, smi in smiles:
-            res = get_similarity(dest, fp, mol_field, table, smi, threshold=threshold, limit=limit, radius_morgan=radius_morgan)
-            res = [(smi, mol_id) + i for i in res]
-            all_res.extend(res)
+            res = top_k_similarity(con, bfp, limit, fp=fp, mol_field=mol_field, table=table,
+                                   radius_morgan=radius_morgan, threshold=threshold, stored_bfp=stored_bfp,
+                                   method=method)
+    profiler.record('hits_per_query', len(res))
+    return res
+
+
+def init_worker(db_name, db_mode, cache_fname=None, cache_size=None):
+    # every worker opens DB once and reuses the connection for all batches of queries
+    global _con, _cache
+    _con = connect_db(db_name, mode=db_mode)
+    if cache_fname is not None:
+        _cache = QueryCache(cache_fname, _con, db_name, cache_size)
+
+
+def get_cached_similarity(con, fp, mol_field, table, query, bfp, canon_smi, threshold, limit, radius_morgan,
+                          method='rdtree'):
+    key = ('bulk_similarity', table, mol_field, fp, radius_morgan, 2048, canon_smi, threshold, limit)
+    res = _cache.get(*key)
+    if res is None:
+        res = get_similarity(con, fp, mol_field, table, query, threshold, limit, radius_morgan, bfp=bfp,
+                             method=method)
+        _cache.put(res, *key)
+    return res
+
+
+def calc_sim_for_queries(queries, fp, mol_field, table, threshold, limit, radius_morgan, method='rdtree'):
+    # queries are prepared by query_prep.prepare_queries
+    all_res = []
+    for smi, mol_id, bfp, canon_smi in queries:
+        if _cache is not None:
+            res = get_cached_similarity(_con, fp, mol_field, table, smi, bfp, canon_smi, threshold=threshold,
+                                        limit=limit, radius_morgan=radius_morgan, method=method)
+        else:
+            res = get_similarity(_con, fp, mol_field, table, smi, threshold=threshold, limit=limit,
+                                 radius_morgan=radius_morgan, bfp=bfp, method=method)
+        res = [(smi, mol_id) + i for i in res]
+        all_res.extend(res)
     return all_res
 
 
+def calc_sim_for_shard(con, queries, fp, mol_field, table, threshold, limit, radius_morgan, method='rdtree'):
+    # hits of every query in a shard, they are merged with hits from other shards (see shards.ShardPool)
+    return [(smi, mol_id, get_similarity(con, fp, mol_field, table, smi, threshold=threshold, limit=limit,
+                                         radius_morgan=radius_morgan, bfp=bfp, method=method))
+            for smi, mol_id, bfp, _ in queries]
+
+
 def main():
     parser = argparse.ArgumentParser(description='Bulk similarity search using the selected fingerprints, '
                                                  'which should be previously added to DB.')
     parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
-                        help='input SQLite DB.')
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py). Every batch of queries '
+                             'is searched in all shards in parallel, cpus are divided between shards.')
     parser.add_argument('-i', '--input_smiles', metavar='FILENAME', required=True,
                         help='input smiles.')
     parser.add_argument('-o', '--output', metavar='FILENAME', required=True,
@@ -61,43 +104,76 @@ def main():
     parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=0.7, type=float,
                         help='Tanimoto similarity threshold. Default: 0.7.')
     parser.add_argument('-l', '--limit', metavar='INTEGER', default=None, type=int,
-                        help='maximum number of matches to retrieve. If specified the threshold will be lowered until '
-                             'the given number of molecules will be found. Default: None.')
+                        help='maximum number of matches to retrieve. If specified and there are fewer compounds above the '
+                             'threshold, the given number of the most similar compounds will be returned. '
+                             'Default: None.')
     parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
                         help='number of cpus.')
+    parser.add_argument('-b', '--batch_size', metavar='INTEGER', default=10, type=int,
+                        help='number of queries sent to a worker at once. Default: 10.')
+    parser.add_argument('-a', '--db_mode', metavar='STRING', default='immutable',
+                        choices=['immutable', 'memory', 'default'],
+                        help='how workers access DB: immutable - read-only memory mapped access shared by all '
+                             'workers through OS page cache, memory - every worker keeps its own in-memory copy of '
+                             'DB, default - ordinary connection. Default: immutable.')
+    parser.add_argument('--method', metavar='STRING', default='rdtree', choices=['rdtree', 'popcount'],
+                        help='how candidates are selected: rdtree - the fingerprint index, popcount - stored '
+                             'fingerprints with popcounts which can reach the threshold (see sim_search.py). '
+                             'Default: rdtree.')
+    parser.add_argument('--cache', metavar='FILENAME', default=None,
+                        help='SQLite file to cache search results. Repeated queries are answered from the cache '
+                             'until DB is changed. Default: None.')
+    parser.add_argument('--cache_size', metavar='INTEGER', default=256, type=int,
+                        help='maximum size of cached results in megabytes. Default: 256.')
+
+    add_prep_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
-
-    p = Pool(args.ncpu)
-
-    smiles = []
-    mol_ids = []
-    with open(args.input_smiles) as f:
-        for line in f:
-            items = line.strip().split()
-            smiles.append(items[0])
-            if len(items) > 1:
-                mol_ids.append(items[1])
-            else:
-                mol_ids.append(items[0])
-    chunked = iter(partial(take, args.ncpu, zip(mol_ids, smiles)), []) # partial calls take function until output is an empty sheet
-                                                                       # by take function islice extracts n elements from zip
-                                                                       # with saving a condition about zip
-
-    with open(args.output, 'wt') as f:
-        f.write('\t'.join(['query_smi', 'query_id', 'found_smi', 'found_id', 'similarity']) + '\n')
-        for res in p.map(partial(calc_sim_for_smiles,
-                                 db_name=args.input_db,
-                                 fp=args.fp,
-                                 mol_field=args.mol_field,
-                                 table=args.table,
-                                 threshold=args.threshold,
-                                 limit=args.limit,
-                                 radius_morgan=args.radius_morgan),
-                         chunked):
-            for items in res:
-                f.write('\t'.join(map(str, items)) + '\n')
-                f.flush()
+    setup_profiling(args)
+
+    if is_manifest(args.input_db) and args.cache is not None:
+        parser.error('--cache is not supported for shard manifests.')
+
+    kwargs = dict(fp=args.fp, mol_field=args.mol_field, table=args.table, threshold=args.threshold,
+                  limit=args.limit, radius_morgan=args.radius_morgan, method=args.method)
+
+    # queries are read lazily, parsed and fingerprinted by the preparation pool and passed in batches to search
+    # workers, so preparation, search and output overlap and only a few batches are kept in memory
+    prep_pool = open_prep_pool(args.prep_ncpu)
+    rejects = open(args.rejects, 'wt') if args.rejects is not None else None
+    try:
+        batches = iter_prepared(read_smi(args.input_smiles), args.fp, args.radius_morgan, prep_pool,
+                                batch_size=args.batch_size, max_pending=2 * args.ncpu,
+                                canonical=args.cache is not None, rejects=rejects)
+
+        if is_manifest(args.input_db):
+            db_names = shard_db_names(args.input_db)
+            nprocs = max(1, args.ncpu // len(db_names))
+            with open_writer(args.output, SIMILARITY_COLUMNS, args.output_format,
+                             table=args.output_table) as writer, \
+                    ShardPool(db_names, args.db_mode, nprocs) as shards:
+                for res in shards.imap(profiled(calc_sim_for_shard), batches, 2 * nprocs, **kwargs):
+                    # res contains hits of the batch of queries in every shard
+                    for queries in zip(*map(collect, res)):
+                        smi, mol_id = queries[0][:2]
+                        writer.write_rows((smi, mol_id) + items
+                                          for items in merge_hits([rows for _, _, rows in queries], args.limit))
+            return
+
+        with open_writer(args.output, SIMILARITY_COLUMNS, args.output_format, table=args.output_table) as writer, \
+                Pool(args.ncpu, initializer=init_worker,
+                     initargs=(args.input_db, args.db_mode, args.cache, args.cache_size * 2 ** 20)) as p:
+            for res in bounded_imap(p, profiled(partial(calc_sim_for_queries, **kwargs)), batches, 2 * args.ncpu,
+                                    unordered=True):
+                writer.write_rows(collect(res))
+
+    finally:
+        if prep_pool is not None:
+            prep_pool.terminate()
+        if rejects is not None:
+            rejects.close()
 
 
 if __name__ == '__main__':
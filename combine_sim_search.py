@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
 
 import argparse
-import pandas as pd
-import sqlite3
+import json
 from multiprocessing import Pool, cpu_count
 from functools import partial
 from itertools import islice
-from operator import itemgetter
-from sim_search import sql_for_similarity
+from add_fp_to_db import compose_bfp_table_name, compose_bfp_function
+from db_utils import connect_db
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from result_writers import SIMILARITY_COLUMNS, open_writer, add_output_arguments
+from sim_search import find_similar, nearest_neighbours, query_bfp, has_stored_bfp, read_smi
+
+
+_con = None
 
 
 def cpu_type(x):
@@ -18,31 +23,101 @@ def take(n, iterable):
     return list(islice(iterable, n))
 
 
-def get_similarity(con, fp, mol_field, table, query, threshold, limit, radius_morgan):
-        sql = sql_for_similarity(fp=fp, mol_field=mol_field, table=table, limit=limit, radius_morgan=radius_morgan)
-        res = con.execute(sql, (query, threshold)).fetchall()
+class FusedScores:
+    # The best similarity and the best query of every found molecule (max fusion) or similarities to all queries
+    # (mean fusion). Only molecules found by individual queries are kept, so the size is bounded by
+    # the number of queries multiplied by the limit. Mean similarities are computed over valid queries only,
+    # they are exact for the kept molecules, but a molecule which is not among top molecules of any single query
+    # may have a higher mean similarity, so the mean top is an approximation.
+
+    def __init__(self, fusion, nqueries):
+        self.fusion = fusion
+        self.nqueries = nqueries
+        self.invalid = set()
+        self.items = {}   # found_smi: [found_id, best similarity, query_smi, query_id, {query index: similarity}]
+
+    def __len__(self):
+        return len(self.items)
+
+    def reject(self, query_idx):
+        # queries which cannot be parsed are not counted by mean fusion
+        self.invalid.add(query_idx)
+
+    def update(self, query_idx, query_smi, query_id, rows):
+        for found_smi, found_id, sim in rows:
+            item = self.items.get(found_smi)
+            if item is None:
+                item = self.items[found_smi] = [found_id, sim, query_smi, query_id, {}]
+            elif sim > item[1]:
+                item[1:4] = sim, query_smi, query_id
+            if self.fusion == 'mean':
+                item[4][query_idx] = sim
+
+    def missing(self):
+        # query indices and found ids without known similarities
+        res = {}
+        for item in self.items.values():
+            for idx in range(self.nqueries):
+                if idx not in item[4] and idx not in self.invalid:
+                    res.setdefault(idx, []).append(item[0])
         return res
 
-
-def calc_sim_for_smiles(smiles, db_name, fp, mol_field, table, threshold, limit, radius_morgan):
-    with sqlite3.connect(db_name) as con, sqlite3.connect(':memory:') as dest:
-        con.backup(dest)
-        dest.enable_load_extension(True)
-        dest.load_extension('chemicalite')
-        dest.enable_load_extension(False)
-        while threshold >= 0:
-            all_res = []
-            for mol_id, smi in smiles:
-                res = get_similarity(dest, fp, mol_field, table, smi, threshold=threshold, limit=limit, radius_morgan=radius_morgan)
-                res = [(smi, mol_id) + i for i in res]
-                all_res.extend(res)
-            df = pd.DataFrame(all_res, columns=['query_smi', 'query_id', 'found_smi', 'found_id', 'similarity'])
-            df = df.sort_values('found_id', ascending=False).groupby('found_smi').head(1)
-            if len(df) < limit:
-                threshold -= 0.05
-            else:
-                return df.head(limit)
-        return None
+    def score(self, item):
+        if self.fusion == 'mean':
+            return sum(item[4].values()) / max(self.nqueries - len(self.invalid), 1)
+        return item[1]
+
+    def top(self, limit):
+        items = sorted(self.items.items(), key=lambda x: self.score(x[1]), reverse=True)[:limit]
+        return [(item[2], item[3], found_smi, item[0], self.score(item)) for found_smi, item in items]
+
+
+def sql_for_scores(fp, mol_field, table, radius_morgan=2, stored_bfp=False):
+    # similarity of the given molecules to a query, ?1 - fingerprint of the query, ?2 - JSON list of ids
+    if stored_bfp:
+        bfp_table_name = compose_bfp_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan)
+        sql = f"""SELECT main.smi, main.id, bfp_tanimoto(bfp.fp, ?1)
+                  FROM {table} AS main, {bfp_table_name} AS bfp
+                  WHERE main.id IN (SELECT value FROM json_each(?2)) AND bfp.id = main.rowid"""
+    else:
+        sql = f"""SELECT main.smi, main.id, bfp_tanimoto({compose_bfp_function(fp, f'main.{mol_field}', radius_morgan)}, ?1)
+                  FROM {table} AS main
+                  WHERE main.id IN (SELECT value FROM json_each(?2)) AND main.{mol_field} IS NOT NULL"""
+    return sql
+
+
+def init_worker(db_name, db_mode):
+    global _con
+    _con = connect_db(db_name, mode=db_mode)
+
+
+def search_queries(queries, fp, mol_field, table, threshold, limit, radius_morgan, exhaustive=False):
+    # returns hits of every query and whether the query found the limit of hits above the threshold,
+    # exhaustive search returns top hits regardless of the threshold, hits of invalid queries are None
+    stored_bfp = has_stored_bfp(_con, table, fp, radius_morgan)
+    output = []
+    for idx, smi, mol_id in queries:
+        bfp = query_bfp(_con, smi, fp, radius_morgan)
+        if bfp is None:
+            output.append((idx, smi, mol_id, None, True))
+            continue
+        if exhaustive:
+            res = nearest_neighbours(_con, bfp, limit, fp, mol_field, table, radius_morgan, stored_bfp)
+        else:
+            res = find_similar(_con, bfp, fp, mol_field, table, threshold, limit, radius_morgan, stored_bfp)
+        output.append((idx, smi, mol_id, res, len(res) >= limit))
+    return output
+
+
+def score_queries(items, fp, mol_field, table, radius_morgan):
+    # similarities of the given found molecules to queries, items are (query index, smi, id, list of found ids)
+    sql = sql_for_scores(fp, mol_field, table, radius_morgan, has_stored_bfp(_con, table, fp, radius_morgan))
+    output = []
+    for idx, smi, mol_id, found_ids in items:
+        bfp = query_bfp(_con, smi, fp, radius_morgan)
+        res = profiler.fetchall(_con, sql, (bfp, json.dumps(found_ids))) if bfp is not None else []
+        output.append((idx, smi, mol_id, res, True))
+    return output
 
 
 def main():
@@ -50,9 +125,9 @@ def main():
                                                  'which should be previously added to DB. This script uses all '
                                                  'supplied reference compounds and returns the overall number of '
                                                  'compounds specified in the limit argument across '
-                                                 'all given queries together. The threshold will be gradually reduced '
-                                                 'starting from the specified value to find the given number of '
-                                                 'compounds.')
+                                                 'all given queries together. If there are fewer compounds above the '
+                                                 'specified threshold, the most similar compounds below the threshold '
+                                                 'are returned to find the given number of compounds.')
     parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
                         help='input SQLite DB.')
     parser.add_argument('-i', '--input_smiles', metavar='FILENAME', required=True,
@@ -72,33 +147,75 @@ def main():
                         help='Tanimoto similarity threshold. Default: 0.7.')
     parser.add_argument('-l', '--limit', metavar='INTEGER', required=True, type=int,
                         help='overall maximum number of matches to retrieve across all queries together.')
+    parser.add_argument('-u', '--fusion', metavar='STRING', default='max', choices=['max', 'mean'],
+                        help='how similarities to different queries are combined: max - the maximum similarity, '
+                             'mean - the mean similarity to all valid queries. Mean fusion is an approximation: '
+                             'mean similarities are computed only for compounds found among top compounds of '
+                             'individual queries, other compounds with a higher mean similarity are missed. '
+                             'Default: max.')
     parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
-                        help='number of cpus. This argument has no effect (not implemented).')
+                        help='number of cpus.')
+    parser.add_argument('-b', '--batch_size', metavar='INTEGER', default=10, type=int,
+                        help='number of queries sent to a worker at once. Default: 10.')
+    parser.add_argument('-a', '--db_mode', metavar='STRING', default='immutable',
+                        choices=['immutable', 'memory', 'default'],
+                        help='how workers access DB: immutable - read-only memory mapped access shared by all '
+                             'workers through OS page cache, memory - every worker keeps its own in-memory copy of '
+                             'DB, default - ordinary connection. Default: immutable.')
+
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
-
-    smiles = []
-    mol_ids = []
-    with open(args.input_smiles) as f:
-        for line in f:
-            items = line.strip().split()
-            smiles.append(items[0])
-            if len(items) > 1:
-                mol_ids.append(items[1])
-            else:
-                mol_ids.append(items[0])
-
-    df = calc_sim_for_smiles(smiles=list(zip(mol_ids, smiles)),
-                             db_name=args.input_db,
-                             fp=args.fp,
-                             mol_field=args.mol_field,
-                             table=args.table,
-                             threshold=args.threshold,
-                             limit=args.limit,
-                             radius_morgan=args.radius_morgan)
-    df.to_csv(args.output, sep="\t", index=False)
+    setup_profiling(args)
+
+    queries = [(idx, smi, mol_id) for idx, (smi, mol_id) in enumerate(read_smi(args.input_smiles))]
+    scores = FusedScores(args.fusion, len(queries))
+    kwargs = dict(fp=args.fp, mol_field=args.mol_field, table=args.table, radius_morgan=args.radius_morgan)
+
+    with Pool(args.ncpu, initializer=init_worker, initargs=(args.input_db, args.db_mode)) as p:
+
+        # the overall top compounds are always among top compounds of individual queries
+        unsaturated = []
+        with profiler.phase('threshold_search'):
+            chunked = iter(partial(take, args.batch_size, iter(queries)), [])
+            for res in p.imap_unordered(profiled(partial(search_queries, threshold=args.threshold,
+                                                         limit=args.limit, **kwargs)),
+                                        chunked):
+                for idx, smi, mol_id, rows, saturated in collect(res):
+                    if rows is None:
+                        profiler.count('invalid_queries')
+                        scores.reject(idx)
+                        continue
+                    scores.update(idx, smi, mol_id, rows)
+                    if not saturated:
+                        unsaturated.append((idx, smi, mol_id))
+
+        # only queries which did not find enough compounds above the threshold are searched below it
+        if len(scores) < args.limit and unsaturated:
+            profiler.count('exhaustive_queries', len(unsaturated))
+            with profiler.phase('exhaustive_search'):
+                chunked = iter(partial(take, args.batch_size, iter(unsaturated)), [])
+                for res in p.imap_unordered(profiled(partial(search_queries, threshold=args.threshold,
+                                                             limit=args.limit, exhaustive=True, **kwargs)),
+                                            chunked):
+                    for idx, smi, mol_id, rows, saturated in collect(res):
+                        scores.update(idx, smi, mol_id, rows)
+
+        if args.fusion == 'mean':
+            with profiler.phase('scoring'):
+                missing = scores.missing()
+                items = [(idx, smi, mol_id, missing[idx]) for idx, smi, mol_id in queries if idx in missing]
+                chunked = iter(partial(take, args.batch_size, iter(items)), [])
+                for res in p.imap_unordered(profiled(partial(score_queries, **kwargs)), chunked):
+                    for idx, smi, mol_id, rows, _ in collect(res):
+                        scores.update(idx, smi, mol_id, rows)
+
+    profiler.count('found_compounds', len(scores))
+    with profiler.phase('output'), \
+            open_writer(args.output, SIMILARITY_COLUMNS, args.output_format, table=args.output_table) as writer:
+        writer.write_rows(scores.top(args.limit))
 
 
 if __name__ == '__main__':
     main()
-
@@ -1,46 +1,397 @@
 #!/usr/bin/env python3
 
 import argparse
+import bz2
+import gzip
+import os
 import sqlite3
 import sys
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+
+from add_fp_to_db import compose_index_table_name, compose_bfp_table_name, compose_bfp_function, create_change_tracking, \
+    create_bfp_table, compose_bfp_insert
+from db_utils import load_chemicalite, bump_generation
+from parallel_build import create_progress_table, set_progress, bounded_imap, cpu_type
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from shards import is_manifest, compose_shard_names, write_manifest, range_bounds, sample_ids, shard_index
+from structure_keys import STRUCTURE_KEYS, add_key_arguments, selected_keys, register_key_functions, sql_for_key, \
+    create_key_indexes, dedup_structures
+
+
+_con = None
+
+
+def take(n, iterable):
+    return list(islice(iterable, n))
+
+
+def open_text(fname):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'rt')
+    if fname.endswith('.bz2'):
+        return bz2.open(fname, 'rt')
+    return open(fname)
+
+
+def is_sdf(fname):
+    return fname.endswith(('.sdf', '.sdf.gz', '.sdf.bz2', '.sd', '.sd.gz', '.sd.bz2'))
+
+
+def read_smiles_records(f, sep=None):
+    # yields (smi, id, molblock) tuples
+    for line in f:
+        items = line.strip().split(sep)
+        if not items or not items[0]:
+            continue
+        yield items[0], items[1] if len(items) > 1 else items[0], None
+
+
+def read_sdf_records(f, id_field=None):
+    # yields (smi, id, molblock) tuples, id is taken from the given property or from the title line
+
+    def parse(lines):
+        end = next((i for i, s in enumerate(lines) if s.startswith('M  END')), len(lines) - 1)
+        mol_id = lines[0].strip()
+        if id_field is not None:
+            for i, s in enumerate(lines[end + 1:-1], end + 1):
+                if s.startswith('>') and f'<{id_field}>' in s:
+                    mol_id = lines[i + 1].strip()
+                    break
+        return None, mol_id, ''.join(lines[:end + 1])
+
+    lines = []
+    for line in f:
+        if line.startswith('$$$$'):
+            if lines:
+                yield parse(lines)
+            lines = []
+        else:
+            lines.append(line)
+    if any(line.strip() for line in lines):
+        yield parse(lines)
+
+
+def init_worker():
+    global _con
+    _con = sqlite3.connect(':memory:')
+    load_chemicalite(_con)
+    register_key_functions(_con)
+
+
+def prepare_records(records, fps, radius_morgan, keys=()):
+    # adds Mol object, fingerprints and structure keys to every record,
+    # canonical smiles are stored for records read from SDF
+    with profiler.phase('prepare'):
+        fp_sql = f"SELECT {', '.join(compose_bfp_function(fp, '?1', radius_morgan) for fp in fps)}" if fps else None
+        key_sql = f"SELECT {', '.join(sql_for_key(key, '?1') for key in keys)}" if keys else None
+        output = []
+        for smi, mol_id, molblock in records:
+            if molblock is None:
+                mol = _con.execute("SELECT mol_from_smiles(?1)", (smi, )).fetchone()[0]
+            else:
+                mol = _con.execute("SELECT mol_from_molblock(?1)", (molblock, )).fetchone()[0]
+                if mol is not None:
+                    smi = _con.execute("SELECT mol_to_smiles(?1)", (mol, )).fetchone()[0]
+            if mol is not None and fp_sql is not None:
+                bfps = _con.execute(fp_sql, (mol, )).fetchone()
+            else:
+                bfps = (None, ) * len(fps)
+            if mol is not None and key_sql is not None:
+                key_values = _con.execute(key_sql, (mol, )).fetchone()
+            else:
+                key_values = (None, ) * len(keys)
+            output.append((smi, mol_id, molblock, mol) + tuple(bfps) + tuple(key_values))
+        return output
+
+
+def set_bulk_pragmas(con, journal_mode):
+    con.execute(f"PRAGMA journal_mode={journal_mode}")
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute("PRAGMA cache_size=-1048576")
+    con.execute("PRAGMA temp_store=MEMORY")
+
+
+def remove_duplicates(con, table, extra_tables, duplicates_fname=None):
+    # keeps the first record of every id, reports removed duplicates and creates the unique index on ids
+    con.execute(f"CREATE TEMP TABLE duplicates AS "
+                f"SELECT rowid AS rid, id FROM {table} "
+                f"WHERE rowid NOT IN (SELECT min(rowid) FROM {table} GROUP BY id)")
+    n = con.execute("SELECT count(*) FROM temp.duplicates").fetchone()[0]
+    if duplicates_fname is not None:
+        with open(duplicates_fname, 'wt') as f:
+            for mol_id, rid in con.execute("SELECT id, rid FROM temp.duplicates ORDER BY rid"):
+                f.write(f'{mol_id}\t{rid}\n')
+    if n:
+        rids = [(rid, ) for rid, in con.execute("SELECT rid FROM temp.duplicates")]
+        for t in extra_tables:
+            con.executemany(f"DELETE FROM {t} WHERE id = ?", rids)
+        con.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rid FROM temp.duplicates)")
+    con.execute("DROP TABLE temp.duplicates")
+    con.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_id_idx ON {table}(id)")
+    con.commit()
+    return n
+
+
+def shard_fname(fname, i, nshards):
+    # name of a report of the i-th shard
+    if fname is None or nshards == 1:
+        return fname
+    root, ext = os.path.splitext(fname)
+    return f'{root}_{i}{ext}'
+
+
+def compose_insert(table, sdf, mol_field=None, nfps=0, keys=(), bulk=False):
+    # SQL inserting records (smi, id, molblock) or prepared records (smi, id, molblock, mol, fp1, ..., fpN, key1, ...)
+    # (see prepare_records) and the number of leading values of a record passed to it.
+    # SMILES of SDF records which are not prepared are generated from molblocks by Chemicalite
+    params = [('smi', 1), ('id', 2)]
+    if sdf:
+        params.append(('molblock', 3))
+    if mol_field is not None:
+        params.append((mol_field, 4))
+        params.extend((key, 5 + nfps + i) for i, key in enumerate(keys))
+    nparams = max(i for _, i in params)
+    values = [f'?{i}' for _, i in params]
+    if sdf and mol_field is None:
+        values[0] = 'mol_to_smiles(mol_from_molblock(?3))'
+    insert_sql = f"INSERT {'' if bulk else 'OR IGNORE '}INTO {table} ({', '.join(name for name, _ in params)}) " \
+                 f"VALUES ({', '.join(values)})"
+    return insert_sql, nparams
+
+
+def create_tables(con, args, sdf, keys=()):
+    # returns SQL inserting records, the number of its parameters, SQL inserting fingerprints and their tables
+    if args.bulk:
+        set_bulk_pragmas(con, args.journal_mode)
+
+    columns = ['id TEXT' if args.bulk else 'id TEXT UNIQUE', 'smi TEXT']
+    if sdf:
+        columns.append('molblock TEXT')
+    if args.mol_field is not None:
+        columns.append(f'{args.mol_field} MOL')
+    columns.extend(f'{key} TEXT' for key in keys)
+    con.execute(f"CREATE TABLE {args.table} ({', '.join(columns)})")
+
+    insert_sql, nparams = compose_insert(args.table, sdf, args.mol_field, len(args.fp), keys, args.bulk)
+    fp_sqls = []
+    fp_tables = []
+    if sdf or args.mol_field is not None:
+        load_chemicalite(con)
+    if args.mol_field is not None:
+        create_progress_table(con)
+        for i, fp in enumerate(args.fp):
+            index_table_name = compose_index_table_name(args.table, fp, args.radius_morgan)
+            con.execute(f"CREATE VIRTUAL TABLE {index_table_name} USING rdtree(id, fp bits(2048))")
+            create_change_tracking(con, args.table, args.mol_field, index_table_name)
+            fp_sqls.append((f"INSERT INTO {index_table_name}(id, fp) VALUES (?, ?)", i))
+            fp_tables.append(index_table_name)
+            if args.store_bfp:
+                bfp_table_name = compose_bfp_table_name(args.table, fp, args.radius_morgan)
+                create_bfp_table(con, bfp_table_name)
+                fp_sqls.append((compose_bfp_insert(bfp_table_name), i))
+                fp_tables.append(bfp_table_name)
+    con.commit()
+    return insert_sql, nparams, fp_sqls, fp_tables
+
+
+def insert_batch(con, batch, insert_sql, nparams, fp_sqls):
+    if fp_sqls:
+        # rowids are needed to fill indexes, so records are inserted one by one
+        for rec in batch:
+            cur = con.execute(insert_sql, rec[:nparams])
+            if cur.rowcount > 0 and rec[3] is not None:
+                for sql, j in fp_sqls:
+                    con.execute(sql, (cur.lastrowid, rec[4 + j]))
+    else:
+        con.executemany(insert_sql, (rec[:nparams] for rec in batch))
+
+
+def finish_db(con, args, fp_tables, keys=(), duplicates_fname=None, dedup_fname=None):
+    # returns the number of records with duplicated ids removed after the bulk load and
+    # the number of records with duplicated structures
+    if args.mol_field is not None:
+        # mark all rows as processed, so create_mol_field.py and add_fp_to_db.py can continue from here
+        max_rowid = con.execute(f"SELECT max(rowid) FROM {args.table}").fetchone()[0] or 0
+        set_progress(con, f'{args.table}.{args.mol_field}', max_rowid)
+        for fp in args.fp:
+            set_progress(con, compose_index_table_name(args.table, fp, args.radius_morgan), max_rowid)
+        con.commit()
+
+    bump_generation(con)
+    con.commit()
+
+    n = 0
+    if args.bulk:
+        n = remove_duplicates(con, args.table, fp_tables, duplicates_fname)
+
+    create_key_indexes(con, args.table, keys)
+    con.commit()
+    n_structures = 0
+    if args.dedup_structures is not None:
+        n_structures = dedup_structures(con, args.table, args.dedup_structures, fp_tables,
+                                        remove=args.dedup_mode == 'remove', report_fname=dedup_fname)
+
+    if args.bulk and args.journal_mode == 'WAL':
+        con.execute("PRAGMA journal_mode=DELETE")
+    return n, n_structures
 
 
 def main():
     parser = argparse.ArgumentParser(description='Create a DB with a table containing id and smi columns.')
     parser.add_argument('-i', '--input', metavar='FILENAME', required=True, default=None,
-                        help='input SMILES file. The file should contain names which should be distinct, records with '
-                             'repeated ids will be ignored during insert.')
+                        help='input SMILES or SDF file, which can be compressed with gzip or bzip2 (.gz and .bz2 '
+                             'extensions). The file should contain names which should be distinct, records with '
+                             'repeated ids will be ignored during insert. MolBlocks from SDF are stored in the '
+                             'molblock column and SMILES are generated from them.')
     parser.add_argument('-o', '--output', metavar='FILENAME', required=True,
-                        help='SQLite DB to create.')
+                        help='SQLite DB or a manifest of shard DBs (see --shards) to create.')
     parser.add_argument('-t', '--table', metavar='STRING', default='mols',
                         help='table name where to store smiles and ids of molecules. Default: mols.')
     parser.add_argument('-s', '--sep', metavar='STRING', default=None,
                         help='separator in input SMILES file. Default: None (whitespaces).')
+    parser.add_argument('--id_field', metavar='STRING', default=None,
+                        help='SDF property containing ids of molecules. Default: None (title line).')
+    parser.add_argument('-b', '--bulk', required=False, default=False, action='store_true',
+                        help='fast bulk load: journal and disk synchronization are switched off and uniqueness of '
+                             'ids is checked after the load, only the first record of every id is kept. '
+                             'DB may be corrupted if the process is interrupted.')
+    parser.add_argument('-j', '--journal_mode', metavar='STRING', default='OFF', choices=['OFF', 'WAL'],
+                        help='journal mode used by the bulk load. Default: OFF.')
+    parser.add_argument('--duplicates', metavar='FILENAME', default=None,
+                        help='text file where ids and rowids of removed duplicated records will be saved by the bulk '
+                             'load. Default: None.')
+    parser.add_argument('--batch_size', metavar='INTEGER', default=10000, type=int,
+                        help='number of records inserted at once. Default: 10000.')
+    parser.add_argument('-m', '--mol_field', metavar='STRING', default=None,
+                        help='create a column with RDKit Mol objects during the load. Default: None.')
+    parser.add_argument('-f', '--fp', metavar='STRING', default=[], nargs='*',
+                        choices=['morgan', 'feat_morgan', 'pattern', 'atom_pairs', 'rdkit', 'topological_torsion'],
+                        help='fingerprint indexes to create during the load, requires --mol_field. Default: None.')
+    parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
+                        help='radius of Morgan fingerprint. Default: 2.')
+    parser.add_argument('--store_bfp', required=False, default=False, action='store_true',
+                        help='additionally store fingerprints in ordinary tables (see add_fp_to_db.py).')
+    parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                        help='number of cpus used to create Mol objects and fingerprints. Default: 1.')
+    parser.add_argument('--shards', metavar='INTEGER', default=1, type=int,
+                        help='number of shard DBs to create. If greater than 1, the output should be a JSON manifest '
+                             '(e.g. lib.json), shards are created next to it (lib_0.db, lib_1.db, ...). The manifest '
+                             'can be passed to other scripts instead of DB. Default: 1.')
+    parser.add_argument('--shard_by', metavar='STRING', default='hash', choices=['hash', 'range'],
+                        help='how compounds are distributed between shards: hash - by CRC32 hash of ids, range - by '
+                             'ranges of ids estimated from a sample of input ids (the input is read twice). '
+                             'Default: hash.')
+    add_key_arguments(parser)
+    parser.add_argument('--dedup_structures', metavar='STRING', default=None, choices=STRUCTURE_KEYS,
+                        help='find records with the same structure under different ids by the given structure key '
+                             '(canon_smi or inchikey), the key column is created. Shards are checked '
+                             'independently. Default: None.')
+    parser.add_argument('--dedup_mode', metavar='STRING', default='report', choices=['report', 'remove'],
+                        help='what to do with duplicated structures: report - only count them and save them to '
+                             '--dedup_report, remove - also remove them keeping the first record. Default: report.')
+    parser.add_argument('--dedup_report', metavar='FILENAME', default=None,
+                        help='text file where ids of records with duplicated structures, their keys and ids of the '
+                             'first records with the same structures will be saved. Default: None.')
     parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
                         help='print progress to stderr.')
 
+    add_profile_arguments(parser)
+
     args = parser.parse_args()
-    with sqlite3.connect(args.output) as con:
+    setup_profiling(args)
 
-        con.execute(f"CREATE TABLE {args.table} (id TEXT UNIQUE, smi TEXT)")
-        con.commit()
+    if args.fp and args.mol_field is None:
+        parser.error('--fp requires --mol_field.')
+    keys = selected_keys(args)
+    if args.dedup_structures is not None and args.dedup_structures not in keys:
+        keys = [key for key in STRUCTURE_KEYS if key in keys or key == args.dedup_structures]
+    if keys and args.mol_field is None:
+        parser.error('structure keys and --dedup_structures require --mol_field.')
+
+    sdf = is_sdf(args.input)
+
+    bounds = None
+    if args.shards > 1:
+        if not is_manifest(args.output):
+            parser.error('--shards requires a JSON manifest as --output.')
+        db_names = compose_shard_names(args.output, args.shards)
+        if args.shard_by == 'range':
+            with profiler.phase('sample_ids'), open_text(args.input) as f:
+                records = read_sdf_records(f, args.id_field) if sdf else read_smiles_records(f, args.sep)
+                bounds = range_bounds(sample_ids(records), args.shards)
+        write_manifest(args.output, db_names, args.shard_by, args.table, bounds)
+    else:
+        db_names = [args.output]
+
+    cons = [sqlite3.connect(db_name) for db_name in db_names]
+    try:
+        with profiler.phase('create_tables'):
+            for con in cons:
+                insert_sql, nparams, fp_sqls, fp_tables = create_tables(con, args, sdf, keys)
+
+        pool = None
+        if args.mol_field is not None and args.ncpu > 1:
+            pool = Pool(args.ncpu, initializer=init_worker)
+        elif args.mol_field is not None:
+            init_worker()
 
         i = 0
-        lines = []
-        with open(args.input) as f:
-            for line in f:
-                lines.append(line.strip().split(args.sep))
-                i += 1
-                if i % 10000 == 0:
-                    con.executemany(f"INSERT OR IGNORE INTO {args.table} (smi, id) VALUES(?, ?)", lines)
-                    con.commit()
-                    lines = []
+        try:
+            with open_text(args.input) as f:
+                records = read_sdf_records(f, args.id_field) if sdf else read_smiles_records(f, args.sep)
+                batches = iter(partial(take, args.batch_size, records), [])
+                if args.mol_field is not None:
+                    func = profiled(partial(prepare_records, fps=args.fp, radius_morgan=args.radius_morgan,
+                                            keys=keys))
+                    batches = bounded_imap(pool, func, batches, 2 * args.ncpu) if pool is not None else map(func, batches)
+                    batches = map(collect, batches)
+                while True:
+                    # time of reading and preparation of records which is not overlapped with inserts
+                    with profiler.phase('read'):
+                        batch = next(batches, None)
+                    if batch is None:
+                        break
+                    if len(cons) > 1:
+                        groups = [[] for _ in cons]
+                        for rec in batch:
+                            groups[shard_index(rec[1], len(cons), bounds)].append(rec)
+                    else:
+                        groups = [batch]
+                    with profiler.phase('insert'):
+                        for con, group in zip(cons, groups):
+                            insert_batch(con, group, insert_sql, nparams, fp_sqls)
+                            con.commit()
+                    i += len(batch)
+                    profiler.count('records', len(batch))
                     if args.verbose:
                         sys.stderr.write(f'\r{i} records were processed')
-            con.executemany(f"INSERT OR IGNORE INTO {args.table} (smi, id) VALUES(?, ?)", lines)
-            con.commit()
-            if args.verbose:
-                sys.stderr.write(f'\r{i} records were processed')
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+        n = 0
+        n_structures = 0
+        for j, con in enumerate(cons):
+            with profiler.phase('finish'):
+                res = finish_db(con, args, fp_tables, keys, shard_fname(args.duplicates, j, len(cons)),
+                                shard_fname(args.dedup_report, j, len(cons)))
+            n += res[0]
+            n_structures += res[1]
+        profiler.count('duplicated_structures', n_structures)
+        if args.bulk and args.verbose:
+            sys.stderr.write(f'\n{n} records with duplicated ids were removed')
+        if args.dedup_structures is not None and args.verbose:
+            sys.stderr.write(f'\n{n_structures} records with duplicated structures were '
+                             f'{"removed" if args.dedup_mode == "remove" else "found"}')
+
+        if args.verbose:
+            sys.stderr.write('\n')
+
+    finally:
+        for con in cons:
+            con.close()
 
 
 if __name__ == '__main__':
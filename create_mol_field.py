@@ -3,11 +3,57 @@
 import argparse
 import sqlite3
 
+from db_utils import load_chemicalite
+from parallel_build import run_pipeline, cpu_type
+from profiling import add_profile_arguments, setup_profiling
+from shards import is_manifest, shard_db_names, run_on_shards
+from structure_keys import add_key_arguments, selected_keys, sql_for_key, create_key_columns, create_key_indexes
+
+
+def create_mol_field(db_name, table, source_field, source_field_type, output_field, keys=(), ncpu=1,
+                     chunk_size=10000, resume=False, verbose=False):
+    with sqlite3.connect(db_name) as con:
+
+        load_chemicalite(con)
+
+        columns = list(i[1] for i in con.execute(f"PRAGMA table_info({table})"))
+        if output_field not in columns:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {output_field} MOL")
+        create_key_columns(con, table, keys)
+        con.commit()
+    con.close()
+
+    if source_field_type == 'smi':
+        func = 'mol_from_smiles'
+    elif source_field_type == 'molblock':
+        func = 'mol_from_molblock'
+    if keys:
+        # structure keys are computed from the same Mol objects, the materialized subquery prevents SQLite
+        # from creating Mol objects again for every key,
+        # rows having Mol objects but missing keys are processed too
+        missing = ' OR '.join(f'{key} IS NULL' for key in [output_field] + list(keys))
+        select_sql = f"WITH t AS MATERIALIZED (SELECT {func}({source_field}) AS m, rowid AS rid FROM {table} " \
+                     f"WHERE rowid > ?1 AND rowid <= ?2 AND ({missing})) " \
+                     f"SELECT m, rid, {', '.join(sql_for_key(key, 'm') for key in keys)} FROM t"
+    else:
+        select_sql = f"SELECT {func}({source_field}), rowid FROM {table} " \
+                     f"WHERE rowid > ?1 AND rowid <= ?2 AND {output_field} IS NULL"
+    write_sql = f"UPDATE {table} SET {output_field} = ?1" \
+                f"{''.join(f', {key} = ?{i}' for i, key in enumerate(keys, 3))} WHERE rowid = ?2"
+    run_pipeline(db_name, f'{table}.{output_field}', table, select_sql, [write_sql],
+                 ncpu=ncpu, chunk_size=chunk_size, resume=resume, verbose=verbose)
+
+    if keys:
+        # indexes are built once after all keys were computed
+        with sqlite3.connect(db_name) as con:
+            create_key_indexes(con, table, keys)
+        con.close()
+
 
 def main():
     parser = argparse.ArgumentParser(description='Insert a column with RDKit Mol object.')
     parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
-                        help='input SQLite DB.')
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py).')
     parser.add_argument('-t', '--table', metavar='STRING', default='mols',
                         help='table name where source data are stored and where generated Mol objects will stored. '
                              'Default: mols.')
@@ -17,26 +63,29 @@ def main():
                         help='type of input field data. Can be smi for SMILES and mol for MolBlock. Default: smi.')
     parser.add_argument('-o', '--output_field', metavar='STRING', default='mol',
                         help='output field where RDKit Mol objects will be stored. Default: mol.')
+    parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                        help='number of cpus used to create Mol objects. Default: 1.')
+    parser.add_argument('-s', '--chunk_size', metavar='INTEGER', default=10000, type=int,
+                        help='number of rowids processed and committed at once. Default: 10000.')
+    parser.add_argument('--resume', required=False, default=False, action='store_true',
+                        help='continue an interrupted run from the last committed rowid.')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
+                        help='print progress to stderr.')
+    add_key_arguments(parser)
+
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
-    with sqlite3.connect(args.input_db) as con:
-
-        con.enable_load_extension(True)
-        con.load_extension('chemicalite')
-        con.enable_load_extension(False)
-
-        columns = list(i[1] for i in con.execute(f"PRAGMA table_info({args.table})"))
-        if args.output_field not in columns:
-            con.execute(f"ALTER TABLE {args.table} ADD COLUMN {args.output_field} MOL")
-        if args.source_field_type == 'smi':
-            con.execute(f"UPDATE {args.table} "
-                        f"SET {args.output_field} = mol_from_smiles({args.source_field}) "
-                        f"WHERE {args.output_field} IS NULL")
-        elif args.source_field_type == 'molblock':
-            con.execute(f"UPDATE {args.table} "
-                        f"SET {args.output_field} = mol_from_molblock({args.source_field}) "
-                        f"WHERE {args.output_field} IS NULL")
-        con.commit()
+    setup_profiling(args)
+
+    kwargs = dict(table=args.table, source_field=args.source_field, source_field_type=args.source_field_type,
+                  output_field=args.output_field, keys=selected_keys(args), chunk_size=args.chunk_size,
+                  resume=args.resume, verbose=args.verbose)
+    if is_manifest(args.input_db):
+        # shards are processed in parallel
+        run_on_shards(create_mol_field, shard_db_names(args.input_db), ncpu=args.ncpu, **kwargs)
+    else:
+        create_mol_field(args.input_db, ncpu=args.ncpu, **kwargs)
 
 
 if __name__ == '__main__':
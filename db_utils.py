@@ -0,0 +1,69 @@
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+
+def load_chemicalite(con):
+    con.enable_load_extension(True)
+    con.load_extension('chemicalite')
+    con.enable_load_extension(False)
+
+
+def connect_db(db_name, mode='immutable', mmap_size=2 ** 36, cache_size=2 ** 20):
+    # immutable - read-only connection which maps the DB file into memory, so the pages are shared
+    #             through the OS page cache by all processes and consecutive runs,
+    # memory - private in-memory copy of the whole DB,
+    # default - ordinary connection with default SQLite settings.
+    # cache_size is given in KiB
+    if mode == 'immutable':
+        uri = f'file:{pathname2url(os.path.abspath(db_name))}?mode=ro&immutable=1'
+        con = sqlite3.connect(uri, uri=True)
+        con.execute(f'PRAGMA mmap_size={int(mmap_size)}')
+        con.execute(f'PRAGMA cache_size=-{int(cache_size)}')
+    elif mode == 'memory':
+        con = sqlite3.connect(':memory:')
+        with sqlite3.connect(db_name) as src:
+            src.backup(con)
+        src.close()
+    elif mode == 'default':
+        con = sqlite3.connect(db_name)
+    else:
+        raise ValueError(f'Unknown DB access mode: {mode}')
+    load_chemicalite(con)
+    return con
+
+
+def has_table(con, table_name):
+    return con.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table_name, )).fetchone() is not None
+
+
+def warm_up(con, names):
+    # reads all pages of the given tables and indexes together with shadow tables of virtual tables and indexes
+    # named after them (e.g. rdtree index), so they are loaded into the OS page cache, which is shared by all
+    # processes with immutable access, while the rest of DB stays on disk
+    rows = con.execute("SELECT type, name, tbl_name, sql FROM sqlite_master").fetchall()
+    for obj_type, name, tbl_name, sql in rows:
+        if not any(name == i or name.startswith(f'{i}_') for i in names) or sql is None:
+            continue
+        if obj_type == 'table' and not sql.upper().startswith('CREATE VIRTUAL'):
+            for _ in con.execute(f"SELECT * FROM {name}"):
+                pass
+        elif obj_type == 'index':
+            # only indexed columns are selected, so the index is scanned without lookups of table rows
+            columns = [i[2] for i in con.execute(f"PRAGMA index_info({name})")]
+            if all(columns):
+                for _ in con.execute(f"SELECT {', '.join(columns)} FROM {tbl_name} INDEXED BY {name}"):
+                    pass
+
+
+def bump_generation(con):
+    # generation counter of DB content, it is increased by every script changing data
+    generation = con.execute("PRAGMA user_version").fetchone()[0]
+    con.execute(f"PRAGMA user_version={generation + 1}")
+
+
+def db_content_key(con, db_name):
+    # changes whenever DB content is changed by the scripts or by anything else modifying the file
+    st = os.stat(db_name)
+    generation = con.execute("PRAGMA user_version").fetchone()[0]
+    return f'{generation}:{st.st_size}:{st.st_mtime_ns}'
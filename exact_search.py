@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+from functools import partial
+from itertools import islice
+
+from db_utils import connect_db
+from profiling import profiler, add_profile_arguments, setup_profiling
+from result_writers import EXACT_COLUMNS, open_writer, add_output_arguments
+from shards import shard_db_names
+from sim_search import read_smi
+from structure_keys import STRUCTURE_KEYS, register_key_functions, sql_for_key
+
+
+def take(n, iterable):
+    return list(islice(iterable, n))
+
+
+def sql_for_query_keys(key):
+    # structure keys of a JSON list of query SMILES, ?1 - the list
+    return f"SELECT {sql_for_key(key, 'mol_from_smiles(q.value)')} FROM json_each(?1) AS q ORDER BY q.key"
+
+
+def sql_for_exact(table, key):
+    # every query of a JSON list of structure keys is looked up by the index of the key column,
+    # ?1 - the list, CROSS JOIN keeps the list as the outer loop
+    return f"""SELECT q.key, main.smi, main.id
+               FROM json_each(?1) AS q CROSS JOIN {table} AS main
+               WHERE main.{key} = q.value"""
+
+
+def has_key_column(con, table, key):
+    return any(i[1] == key for i in con.execute(f"PRAGMA table_info({table})"))
+
+
+def query_keys(con, smiles, key):
+    return [k for k, in con.execute(sql_for_query_keys(key), (json.dumps(smiles), ))]
+
+
+def find_exact(con, table, key, keys):
+    # returns (query index, found smi, found id) of compounds matching structure keys of queries,
+    # None keys of invalid queries match nothing
+    return profiler.fetchall(con, sql_for_exact(table, key), (json.dumps(keys), ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Exact structure search. Queries are converted to canonical SMILES '
+                                                 'or InChIKeys and are looked up in batches by the indexed column '
+                                                 'created by create_mol_field.py or create_db.py with --canon_smi or '
+                                                 '--inchikey.')
+    parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py).')
+    parser.add_argument('-q', '--query', metavar='STRING or FNAME', required=True,
+                        help='query SMILES or a file with SMILES and optional ids.')
+    parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
+                        help='output text file. If omitted output will be printed to STDOUT.')
+    parser.add_argument('-t', '--table', metavar='STRING', default='mols',
+                        help='table name where compounds are stored. Default: mols.')
+    parser.add_argument('-k', '--key', metavar='STRING', default='canon_smi', choices=STRUCTURE_KEYS,
+                        help='structure key used for search: canon_smi or inchikey. Default: canon_smi.')
+    parser.add_argument('-b', '--batch_size', metavar='INTEGER', default=10000, type=int,
+                        help='number of queries looked up at once. Default: 10000.')
+    parser.add_argument('-a', '--db_mode', metavar='STRING', default='immutable',
+                        choices=['immutable', 'memory', 'default'],
+                        help='how DB is accessed: immutable - read-only memory mapped access, memory - in-memory '
+                             'copy of DB, default - ordinary connection. Default: immutable.')
+    parser.add_argument('--not_found', metavar='FILENAME', default=None,
+                        help='text file where queries without matches (including invalid ones) will be saved. '
+                             'Default: None.')
+    add_output_arguments(parser)
+
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+    setup_profiling(args)
+
+    with profiler.phase('connect'):
+        cons = [connect_db(db_name, mode=args.db_mode) for db_name in shard_db_names(args.input_db)]
+        for con in cons:
+            register_key_functions(con)
+    if not all(has_key_column(con, args.table, args.key) for con in cons):
+        parser.error(f'{args.key} column is missing, it can be created by create_mol_field.py --{args.key}.')
+
+    if os.path.isfile(args.query):
+        queries = read_smi(args.query)
+    else:
+        queries = [(args.query, args.query)]
+
+    not_found = open(args.not_found, 'wt') if args.not_found is not None else None
+    try:
+        with open_writer(args.output, EXACT_COLUMNS, args.output_format, table=args.output_table) as writer:
+            for batch in iter(partial(take, args.batch_size, iter(queries)), []):
+                with profiler.phase('query_prep'):
+                    # keys of queries are computed by the first shard, all shards have the same functions
+                    keys = query_keys(cons[0], [smi for smi, _ in batch], args.key)
+                profiler.count('queries', len(batch))
+                profiler.count('invalid_queries', sum(k is None for k in keys))
+                with profiler.phase('search'):
+                    rows = [row for con in cons for row in find_exact(con, args.table, args.key, keys)]
+                    rows.sort(key=lambda x: x[0])
+                profiler.count('hits', len(rows))
+                with profiler.phase('output'):
+                    writer.write_rows(batch[i] + (smi, mol_id) for i, smi, mol_id in rows)
+                    if not_found is not None:
+                        found = set(i for i, _, _ in rows)
+                        not_found.write(''.join(f'{smi}\t{mol_id}\n' for i, (smi, mol_id) in enumerate(batch)
+                                                if i not in found))
+    finally:
+        if not_found is not None:
+            not_found.close()
+        for con in cons:
+            con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sqlite3
+from functools import partial
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from add_fp_to_db import compose_bfp_table_name, compose_bfp_function
+from db_utils import load_chemicalite, has_table
+from result_writers import SIMILARITY_COLUMNS, open_writer, add_output_arguments
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from sim_search import query_bfp, read_smi
+
+
+NBITS = 2048
+NWORDS = NBITS // 64
+LIB_BLOCK = 4096     # number of library fingerprints compared at once
+QUERY_BLOCK = 32     # number of query fingerprints compared at once
+
+_lib = None
+_lib_cnt = None
+_queries = None
+_queries_cnt = None
+
+
+def cpu_type(x):
+    return max(1, min(int(x), cpu_count()))
+
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(a):
+        return np.bitwise_count(a).sum(axis=-1, dtype=np.int32)
+else:
+    _POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(a):
+        a = np.ascontiguousarray(a)
+        return _POPCOUNT_TABLE[a.view(np.uint8)].sum(axis=-1, dtype=np.int32)
+
+
+def bfp_to_array(bfps):
+    # list of Chemicalite bfp blobs to a packed (n, NWORDS) uint64 matrix
+    return np.frombuffer(b''.join(bfps), dtype=np.uint64).reshape(len(bfps), NWORDS)
+
+
+def tanimoto(queries, queries_cnt, lib, lib_cnt):
+    # (nq, NWORDS) x (nl, NWORDS) -> (nq, nl) matrix of Tanimoto coefficients
+    common = popcount(queries[:, None, :] & lib[None, :, :])
+    union = queries_cnt[:, None] + lib_cnt[None, :] - common
+    return np.divide(common, union, out=np.zeros(union.shape, dtype=np.float64), where=union > 0, casting='unsafe')
+
+
+def sql_for_fps(con, table, mol_field, fp, radius_morgan):
+    # returns SQL expression of a fingerprint and FROM clause of compounds with fingerprints,
+    # stored fingerprints are used if they were added to DB, otherwise fingerprints are generated from Mol objects
+    bfp_table_name = compose_bfp_table_name(table, fp, radius_morgan)
+    if has_table(con, bfp_table_name):
+        from_sql = f"FROM {table} AS main, {bfp_table_name} AS bfp WHERE main.rowid = bfp.id AND bfp.fp IS NOT NULL"
+        fp_sql = 'bfp.fp'
+    else:
+        from_sql = f"FROM {table} AS main WHERE main.{mol_field} IS NOT NULL"
+        fp_sql = compose_bfp_function(fp, f'main.{mol_field}', radius_morgan)
+    return fp_sql, from_sql
+
+
+def export_matrix(con, prefix, table, mol_field, fp, radius_morgan, chunk_size=100000):
+    fp_sql, from_sql = sql_for_fps(con, table, mol_field, fp, radius_morgan)
+    n = con.execute(f"SELECT count(*) {from_sql}").fetchone()[0]
+    fps = np.lib.format.open_memmap(prefix + '.npy', mode='w+', dtype=np.uint64, shape=(n, NWORDS))
+    cnt = np.lib.format.open_memmap(prefix + '.cnt.npy', mode='w+', dtype=np.int32, shape=(n, ))
+
+    i = 0
+    with open(prefix + '.tsv', 'wt') as f:
+        cur = con.execute(f"SELECT main.smi, main.id, {fp_sql} {from_sql} ORDER BY main.rowid")
+        while i < n:
+            rows = cur.fetchmany(min(chunk_size, n - i))
+            if not rows:
+                break
+            block = bfp_to_array([r[2] for r in rows])
+            fps[i:i + len(rows)] = block
+            cnt[i:i + len(rows)] = popcount(block)
+            f.write(''.join(f'{smi}\t{mol_id}\n' for smi, mol_id, _ in rows))
+            i += len(rows)
+    fps.flush()
+    cnt.flush()
+
+    with open(prefix + '.json', 'wt') as f:
+        json.dump({'table': table, 'fp': fp, 'radius_morgan': radius_morgan, 'nbits': NBITS, 'size': i}, f)
+
+    return i
+
+
+def load_labels(prefix):
+    with open(prefix + '.tsv') as f:
+        return [tuple(line.rstrip('\n').split('\t')) for line in f]
+
+
+def init_worker(prefix, queries, queries_cnt):
+    global _lib, _lib_cnt, _queries, _queries_cnt
+    _lib = np.load(prefix + '.npy', mmap_mode='r')
+    _lib_cnt = np.load(prefix + '.cnt.npy', mmap_mode='r')
+    _queries = queries
+    _queries_cnt = queries_cnt
+
+
+def iter_blocks(start, end):
+    # yields library offset and similarity matrix of all queries against a block of library fingerprints
+    for lb in range(start, end, LIB_BLOCK):
+        lib = np.asarray(_lib[lb:min(lb + LIB_BLOCK, end)])
+        lib_cnt = np.asarray(_lib_cnt[lb:min(lb + LIB_BLOCK, end)])
+        sim = np.empty((len(_queries), len(lib)), dtype=np.float64)
+        for qb in range(0, len(_queries), QUERY_BLOCK):
+            sim[qb:qb + QUERY_BLOCK] = tanimoto(_queries[qb:qb + QUERY_BLOCK], _queries_cnt[qb:qb + QUERY_BLOCK],
+                                                lib, lib_cnt)
+        profiler.count('comparisons', sim.size)
+        yield lb, sim
+
+
+def merge_top(best_idx, best_sim, idx, sim, k):
+    # keeps k best hits along the last axis
+    idx = np.concatenate([best_idx, idx], axis=-1)
+    sim = np.concatenate([best_sim, sim], axis=-1)
+    if sim.shape[-1] > k:
+        top = np.argpartition(-sim, k - 1, axis=-1)[..., :k]
+        idx = np.take_along_axis(idx, top, axis=-1)
+        sim = np.take_along_axis(sim, top, axis=-1)
+    return idx, sim
+
+
+def search_range(bounds, threshold, limit):
+    # returns (query index, library index, similarity) arrays of hits within the given range of library rows
+    start, end = bounds
+    if limit is None:
+        qi, li, s = [], [], []
+        for lb, sim in iter_blocks(start, end):
+            q, l = np.nonzero(sim >= threshold)
+            qi.append(q)
+            li.append(l + lb)
+            s.append(sim[q, l])
+        if not qi:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return np.concatenate(qi), np.concatenate(li), np.concatenate(s)
+    else:
+        best_idx = np.zeros((len(_queries), 0), dtype=np.int64)
+        best_sim = np.zeros((len(_queries), 0), dtype=np.float64)
+        for lb, sim in iter_blocks(start, end):
+            idx = np.broadcast_to(np.arange(lb, lb + sim.shape[1]), sim.shape)
+            best_idx, best_sim = merge_top(best_idx, best_sim, idx, sim, limit)
+        qi = np.repeat(np.arange(len(_queries)), best_idx.shape[1])
+        li, s = best_idx.ravel(), best_sim.ravel()
+        mask = s >= threshold
+        return qi[mask], li[mask], s[mask]
+
+
+def combine_range(bounds, threshold, limit):
+    # returns (best query index, library index, similarity) of top hits by the maximum similarity to all queries
+    start, end = bounds
+    best_q = np.zeros(0, dtype=np.int64)
+    best_idx = np.zeros(0, dtype=np.int64)
+    best_sim = np.zeros(0, dtype=np.float64)
+    for lb, sim in iter_blocks(start, end):
+        q = sim.argmax(axis=0)
+        s = sim[q, np.arange(sim.shape[1])]
+        l = np.arange(lb, lb + sim.shape[1])
+        mask = s >= threshold
+        best_q = np.concatenate([best_q, q[mask]])
+        best_idx = np.concatenate([best_idx, l[mask]])
+        best_sim = np.concatenate([best_sim, s[mask]])
+        if len(best_sim) > limit:
+            top = np.argpartition(-best_sim, limit - 1)[:limit]
+            best_q, best_idx, best_sim = best_q[top], best_idx[top], best_sim[top]
+    return best_q, best_idx, best_sim
+
+
+def run_search(prefix, queries, queries_cnt, threshold, limit, combine=False, ncpu=1):
+    n = len(np.load(prefix + '.cnt.npy', mmap_mode='r'))
+    step = max(LIB_BLOCK, -(-n // (ncpu * 4)))
+    ranges = [(i, min(i + step, n)) for i in range(0, n, step)]
+    func = profiled(partial(combine_range if combine else search_range,
+                            threshold=threshold if threshold is not None else -1,
+                            limit=limit))
+    if ncpu > 1:
+        with Pool(ncpu, initializer=init_worker, initargs=(prefix, queries, queries_cnt)) as p:
+            parts = [collect(part) for part in p.imap_unordered(func, ranges)]
+    else:
+        init_worker(prefix, queries, queries_cnt)
+        parts = [collect(func(r)) for r in ranges]
+
+    qi = np.concatenate([p[0] for p in parts]) if parts else np.empty(0, dtype=np.int64)
+    li = np.concatenate([p[1] for p in parts]) if parts else np.empty(0, dtype=np.int64)
+    s = np.concatenate([p[2] for p in parts]) if parts else np.empty(0, dtype=np.float64)
+
+    # sort by query and decreasing similarity, library order is kept for ties
+    if combine:
+        order = np.lexsort((li, -s))[:limit]
+    else:
+        order = np.lexsort((li, -s, qi))
+        qi, li, s = qi[order], li[order], s[order]
+        if limit is not None:
+            # keep only `limit` hits for each query after merging of ranges
+            first = np.searchsorted(qi, qi, side='left')
+            order = np.nonzero(np.arange(len(qi)) - first < limit)[0]
+        else:
+            order = np.arange(len(qi))
+    return qi[order], li[order], s[order]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Brute-force similarity search over a packed fingerprint matrix held '
+                                                 'in memory. The matrix should be exported from DB once.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='export fingerprints from DB into a memory mappable matrix.')
+    export_parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
+                               help='input SQLite DB.')
+    export_parser.add_argument('-o', '--output', metavar='PREFIX', required=True,
+                               help='prefix of output files: PREFIX.npy - fingerprints, PREFIX.cnt.npy - bit counts, '
+                                    'PREFIX.tsv - smiles and ids, PREFIX.json - metadata.')
+    export_parser.add_argument('-t', '--table', metavar='STRING', default='mols',
+                               help='table name where Mol objects are stored. Default: mols.')
+    export_parser.add_argument('-m', '--mol_field', metavar='STRING', default='mol',
+                               help='field name where mol objects are stored. Default: mol.')
+    export_parser.add_argument('-f', '--fp', metavar='STRING', default='morgan',
+                               choices=['morgan', 'feat_morgan', 'pattern', 'atom_pairs', 'rdkit', 'topological_torsion'],
+                               help='fingerprint type to export. Default: morgan.')
+    export_parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
+                               help='radius of Morgan fingerprint. Default: 2.')
+
+    search_parser = subparsers.add_parser('search', help='similarity search of one or many queries.')
+    search_parser.add_argument('-x', '--matrix', metavar='PREFIX', required=True,
+                               help='prefix of the exported fingerprint matrix.')
+    search_parser.add_argument('-q', '--query', metavar='STRING or FNAME', required=True,
+                               help='reference SMILES or SMILES file.')
+    search_parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
+                               help='output text file. If omitted output will be printed to STDOUT.')
+    search_parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=None, type=float,
+                               help='Tanimoto similarity threshold. Default: None.')
+    search_parser.add_argument('-l', '--limit', metavar='INTEGER', default=None, type=int,
+                               help='maximum number of matches to retrieve for every query or overall if --combine '
+                                    'is specified. Default: None.')
+    search_parser.add_argument('--combine', required=False, default=False, action='store_true',
+                               help='return the overall number of compounds specified in the limit argument across '
+                                    'all queries together ranked by the maximum similarity to queries.')
+    search_parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                               help='number of cpus.')
+    add_output_arguments(search_parser)
+    add_profile_arguments(export_parser)
+    add_profile_arguments(search_parser)
+
+    args = parser.parse_args()
+    setup_profiling(args)
+
+    if args.command == 'export':
+        with profiler.phase('export'), sqlite3.connect(args.input_db) as con:
+            load_chemicalite(con)
+            n = export_matrix(con, args.output, args.table, args.mol_field, args.fp, args.radius_morgan)
+        profiler.count('exported', n)
+        return
+
+    if args.threshold is None and args.limit is None:
+        parser.error('threshold or limit should be specified.')
+    if args.combine and args.limit is None:
+        parser.error('limit should be specified for combined search.')
+
+    with open(args.matrix + '.json') as f:
+        meta = json.load(f)
+
+    if os.path.isfile(args.query):
+        queries = list(read_smi(args.query))
+    else:
+        queries = [(args.query, args.query)]
+
+    # query fingerprints are generated by Chemicalite to be identical to fingerprints stored in DB
+    with profiler.phase('query_prep'):
+        con = sqlite3.connect(':memory:')
+        load_chemicalite(con)
+        bfps = [query_bfp(con, smi, meta['fp'], meta['radius_morgan']) for smi, _ in queries]
+        con.close()
+        queries = [q for q, bfp in zip(queries, bfps) if bfp is not None]
+        queries_fps = bfp_to_array([bfp for bfp in bfps if bfp is not None])
+        queries_cnt = popcount(queries_fps)
+    profiler.count('queries', len(queries))
+
+    with profiler.phase('search'):
+        qi, li, s = run_search(args.matrix, queries_fps, queries_cnt, args.threshold, args.limit,
+                               combine=args.combine, ncpu=args.ncpu)
+    profiler.count('hits', len(s))
+    with profiler.phase('load_labels'):
+        labels = load_labels(args.matrix)
+
+    with profiler.phase('output'), \
+            open_writer(args.output, SIMILARITY_COLUMNS, args.output_format, table=args.output_table) as writer:
+        writer.write_rows(queries[q] + labels[l] + (sim, ) for q, l, sim in zip(qi.tolist(), li.tolist(), s.tolist()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import sqlite3
+import sys
+
+from profiling import profiler, add_profile_arguments, setup_profiling
+from shards import shard_db_names
+
+
+def optimize_db(db_name, page_size=16384, verbose=False):
+    # DB is rebuilt with the given page size, tables and indexes are defragmented and stored contiguously,
+    # so the file can be read sequentially and memory mapped by immutable connections (rollback journal is used,
+    # because a pending WAL file cannot be seen by immutable connections and prevents changing the page size)
+    size = os.path.getsize(db_name)
+    con = sqlite3.connect(db_name)
+    old_page_size = con.execute("PRAGMA page_size").fetchone()[0]
+    with profiler.phase('vacuum'):
+        con.execute("PRAGMA journal_mode=DELETE")
+        con.execute(f"PRAGMA page_size={page_size}")
+        con.execute("VACUUM")
+    con.close()
+    if verbose:
+        sys.stderr.write(f'{db_name}: page size {old_page_size} -> {page_size}, '
+                         f'{size} -> {os.path.getsize(db_name)} bytes\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Optimize DB for searching once it was created: rebuild it with '
+                                                 'a larger page size and without free pages and fragmentation. '
+                                                 'Temporary free disk space of the size of DB is required.')
+    parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py). Shards are '
+                             'processed one by one.')
+    parser.add_argument('-p', '--page_size', metavar='INTEGER', default=16384, type=int,
+                        choices=[2 ** i for i in range(9, 17)],
+                        help='page size of DB in bytes, a power of two between 512 and 65536. Larger pages make '
+                             'B-trees shallower and reads of fingerprints more sequential. Default: 16384.')
+    parser.add_argument('-v', '--verbose', required=False, default=False, action='store_true',
+                        help='print page and file sizes to stderr.')
+
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+    setup_profiling(args)
+
+    for db_name in shard_db_names(args.input_db):
+        optimize_db(db_name, page_size=args.page_size, verbose=args.verbose)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import sqlite3
+import sys
+import threading
+import time
+from collections import deque
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool, cpu_count
+from queue import Queue
+
+from db_utils import load_chemicalite, bump_generation
+from profiling import profiler, profiled, collect
+from structure_keys import register_key_functions
+
+
+_con = None
+
+
+def cpu_type(x):
+    return max(1, min(int(x), cpu_count()))
+
+
+def create_progress_table(con):
+    # the last committed rowid of every build task, it is used to resume interrupted builds
+    con.execute("CREATE TABLE IF NOT EXISTS build_progress (task TEXT PRIMARY KEY, last_rowid INTEGER)")
+
+
+def get_progress(con, task):
+    res = con.execute("SELECT last_rowid FROM build_progress WHERE task = ?", (task, )).fetchone()
+    return res[0] if res is not None else 0
+
+
+def set_progress(con, task, last_rowid):
+    con.execute("INSERT OR REPLACE INTO build_progress (task, last_rowid) VALUES (?, ?)", (task, last_rowid))
+
+
+def rowid_ranges(con, table, start, chunk_size):
+    # half-open ranges (lo, hi] of rowids
+    max_rowid = con.execute(f"SELECT max(rowid) FROM {table}").fetchone()[0] or 0
+    for lo in range(start, max_rowid, chunk_size):
+        yield lo, min(lo + chunk_size, max_rowid)
+
+
+def bounded_imap(pool, func, iterable, max_pending, unordered=False):
+    # Pool.imap consumes the whole input iterable at once by its own thread, here the iterable is consumed lazily by
+    # the calling thread (so it can read a cursor of the caller) and at most max_pending items are in flight
+    items = iter(iterable)
+    done = Queue()
+    pending = deque()
+
+    def submit():
+        for item in islice(items, max_pending - len(pending)):
+            if unordered:
+                pending.append(pool.apply_async(func, (item, ), callback=lambda res: done.put((True, res)),
+                                                error_callback=lambda e: done.put((False, e))))
+            else:
+                pending.append(pool.apply_async(func, (item, )))
+
+    submit()
+    while pending:
+        if unordered:
+            ok, res = done.get()
+            pending.pop()
+            if not ok:
+                raise res
+        else:
+            res = pending.popleft().get()
+        submit()
+        yield res
+
+
+def init_worker(db_name):
+    global _con
+    _con = sqlite3.connect(db_name)
+    load_chemicalite(_con)
+    register_key_functions(_con)
+
+
+def compute_chunk(bounds, select_sql):
+    # select_sql takes ?1 and ?2 as bounds of the rowid range
+    with profiler.phase('compute'):
+        return bounds[1], profiler.fetchall(_con, select_sql, bounds)
+
+
+def write_chunks(db_name, task, write_sqls, queue, errors, verbose):
+    # the only writer to DB, every chunk is written in a single transaction together with the progress mark
+    con = sqlite3.connect(db_name)
+    try:
+        load_chemicalite(con)
+        n = 0
+        start_time = time.perf_counter()
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            last_rowid, rows = item
+            with profiler.phase('write'), con:
+                for sql in write_sqls:
+                    con.executemany(sql, rows)
+                set_progress(con, task, last_rowid)
+            n += len(rows)
+            profiler.count('rows_written', len(rows))
+            if verbose:
+                speed = n / max(time.perf_counter() - start_time, 1e-9)
+                sys.stderr.write(f'\r{n} records were processed ({speed:.0f} records/s), last rowid {last_rowid}')
+    except Exception as e:
+        errors.append(e)
+        while queue.get() is not None:
+            pass
+    finally:
+        con.close()
+        if verbose:
+            sys.stderr.write('\n')
+
+
+def run_pipeline(db_name, task, table, select_sql, write_sqls, ncpu=1, chunk_size=10000, resume=False,
+                 verbose=False):
+    # rows selected by select_sql from rowid ranges of the table are computed by a pool of processes
+    # and are written by write_sqls in a separate thread
+    with sqlite3.connect(db_name) as con:
+        # WAL lets workers read DB while the writer commits chunks
+        con.execute("PRAGMA journal_mode=WAL")
+        create_progress_table(con)
+        con.commit()
+        start = get_progress(con, task) if resume else 0
+        ranges = list(rowid_ranges(con, table, start, chunk_size))
+    con.close()
+
+    queue = Queue(maxsize=2 * ncpu)
+    errors = []
+    writer = threading.Thread(target=write_chunks, args=(db_name, task, write_sqls, queue, errors, verbose))
+    writer.start()
+
+    try:
+        func = profiled(partial(compute_chunk, select_sql=select_sql))
+        if ncpu > 1:
+            with Pool(ncpu, initializer=init_worker, initargs=(db_name, )) as p:
+                # ordered results keep the progress mark contiguous, at most 2 * ncpu computed chunks wait for
+                # the writer, so workers stop computing when the writer is slower than them
+                for item in bounded_imap(p, func, ranges, 2 * ncpu):
+                    if errors:
+                        break
+                    queue.put(collect(item))
+        else:
+            init_worker(db_name)
+            try:
+                for item in map(func, ranges):
+                    if errors:
+                        break
+                    queue.put(collect(item))
+            finally:
+                _con.close()
+    finally:
+        queue.put(None)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    with profiler.phase('finalize'), sqlite3.connect(db_name) as con:
+        bump_generation(con)
+        con.execute("PRAGMA journal_mode=DELETE")
+    con.close()
@@ -0,0 +1,204 @@
+import atexit
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
+
+class Profiler:
+    # Wall and CPU time of named phases, counters, distributions of per query values, query plans of executed SQL
+    # and the number of SQLite VM steps (counted by the progress handler every vm_unit steps).
+    # Does nothing until enabled, so library functions can be instrumented unconditionally.
+
+    def __init__(self, vm_unit=1000):
+        self.enabled = False
+        self.vm_unit = vm_unit
+        self.interval = None
+        self.lock = threading.RLock()
+        self.pid = os.getpid()
+        self.reset()
+
+    def reset(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.last_report = self.start_wall
+        self.phases = {}    # name: [calls, wall, cpu]
+        self.counters = {}
+        self.values = {}    # name: [n, total, min, max]
+        self.plans = {}     # sql: query plan
+        self.vm_steps = 0
+
+    def enable(self, interval=None):
+        # interval - seconds between progress lines printed to stderr
+        self.enabled = True
+        self.interval = interval
+        self.pid = os.getpid()
+        self.reset()
+
+    def phase(self, name):
+        return self._phase(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def _phase(self, name):
+        # CPU time is the time of the whole process, it includes other threads
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                item = self.phases.setdefault(name, [0, 0.0, 0.0])
+                item[0] += 1
+                item[1] += time.perf_counter() - wall
+                item[2] += time.process_time() - cpu
+            self.report()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+            self.report()
+
+    def record(self, name, value):
+        if self.enabled:
+            with self.lock:
+                item = self.values.get(name)
+                if item is None:
+                    self.values[name] = [1, value, value, value]
+                else:
+                    item[0] += 1
+                    item[1] += value
+                    item[2] = min(item[2], value)
+                    item[3] = max(item[3], value)
+
+    def _on_progress(self):
+        self.vm_steps += self.vm_unit
+        return 0
+
+    def watch(self, con):
+        if self.enabled:
+            con.set_progress_handler(self._on_progress, self.vm_unit)
+
+    def explain(self, con, sql, params=()):
+        # query plan of every distinct SQL is captured once
+        if self.enabled and sql not in self.plans:
+            try:
+                self.plans[sql] = [row[-1] for row in con.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+            except sqlite3.Error as e:
+                self.plans[sql] = [f'error: {e}']
+
+    def fetchall(self, con, sql, params=()):
+        # executes SQL recording its plan, VM steps and the number of returned rows
+        if not self.enabled:
+            return con.execute(sql, params).fetchall()
+        self.explain(con, sql, params)
+        self.watch(con)
+        steps = self.vm_steps
+        rows = con.execute(sql, params).fetchall()
+        self.count('statements')
+        self.record('vm_steps_per_statement', self.vm_steps - steps)
+        self.record('rows_per_statement', len(rows))
+        return rows
+
+    def report(self):
+        if self.interval is not None and os.getpid() == self.pid:
+            now = time.perf_counter()
+            if now - self.last_report >= self.interval:
+                self.last_report = now
+                phases = ', '.join(f'{k} {v[1]:.1f}s' for k, v in self.phases.items())
+                counters = ', '.join(f'{k} {v}' for k, v in self.counters.items())
+                sys.stderr.write(f'[{now - self.start_wall:.1f}s] {phases}; {counters}\n')
+
+    def stats(self):
+        with self.lock:
+            return {'wall': time.perf_counter() - self.start_wall,
+                    'cpu': time.process_time() - self.start_cpu,
+                    'phases': {k: {'calls': v[0], 'wall': v[1], 'cpu': v[2]} for k, v in self.phases.items()},
+                    'counters': dict(self.counters, vm_steps=self.vm_steps),
+                    'values': {k: {'n': v[0], 'total': v[1], 'mean': v[1] / v[0], 'min': v[2], 'max': v[3]}
+                               for k, v in self.values.items()},
+                    'plans': dict(self.plans)}
+
+    def merge(self, stats):
+        # adds statistics collected by a worker process (see call)
+        with self.lock:
+            for k, v in stats['phases'].items():
+                item = self.phases.setdefault(k if k.startswith('worker.') else f'worker.{k}', [0, 0.0, 0.0])
+                item[0] += v['calls']
+                item[1] += v['wall']
+                item[2] += v['cpu']
+            for k, v in stats['counters'].items():
+                if k == 'vm_steps':
+                    self.vm_steps += v
+                else:
+                    self.counters[k] = self.counters.get(k, 0) + v
+            for k, v in stats['values'].items():
+                item = self.values.get(k)
+                if item is None:
+                    self.values[k] = [v['n'], v['total'], v['min'], v['max']]
+                else:
+                    item[0] += v['n']
+                    item[1] += v['total']
+                    item[2] = min(item[2], v['min'])
+                    item[3] = max(item[3], v['max'])
+            for k, v in stats['plans'].items():
+                self.plans.setdefault(k, v)
+        self.report()
+
+    def write(self, fname):
+        stats = self.stats()
+        stats['argv'] = sys.argv
+        if fname == '-':
+            json.dump(stats, sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        else:
+            with open(fname, 'wt') as f:
+                json.dump(stats, f, indent=2)
+
+
+profiler = Profiler()
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', metavar='FILENAME', default=None,
+                        help='save timings of phases, counters, VM steps and query plans of executed SQL as JSON at '
+                             'exit, - prints them to stderr. Default: None.')
+    parser.add_argument('--profile_interval', metavar='SECONDS', default=None, type=float,
+                        help='print progress of profiled phases and counters to stderr every given number of seconds. '
+                             'Default: None.')
+
+
+def setup_profiling(args):
+    if args.profile is not None or args.profile_interval is not None:
+        profiler.enable(args.profile_interval)
+        if args.profile is not None:
+            atexit.register(profiler.write, args.profile)
+
+
+def call(func, main_pid, *args, **kwargs):
+    # runs func in a worker process and returns its result together with statistics collected during the call,
+    # statistics of calls in the main process are collected directly
+    if os.getpid() == main_pid:
+        return func(*args, **kwargs), None
+    profiler.enabled = True
+    profiler.reset()
+    return func(*args, **kwargs), profiler.stats()
+
+
+def profiled(func):
+    # func executed by a pool should be wrapped and its results should be unwrapped by collect
+    if not profiler.enabled:
+        return func
+    return partial(call, func, os.getpid())
+
+
+def collect(item):
+    if not profiler.enabled:
+        return item
+    res, stats = item
+    if stats is not None:
+        profiler.merge(stats)
+    return res
@@ -0,0 +1,81 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from db_utils import db_content_key
+from shards import is_manifest, manifest_content_key
+
+
+class QueryCache:
+    # Persistent cache of search results stored in a sidecar SQLite DB, which can be shared by several DBs.
+    # Keys include the path and the content key of DB, so results become stale as soon as DB is changed and results of
+    # older versions of the same DB are purged on opening.
+    # The least recently used results are evicted when the total size exceeds max_size bytes, the total size is
+    # kept up to date by triggers.
+
+    def __init__(self, fname, con, db_name, max_size=2 ** 28):
+        self.con = sqlite3.connect(fname, timeout=60)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        with self.con:
+            columns = [i[1] for i in self.con.execute("PRAGMA table_info(results)")]
+            if columns and 'db_path' not in columns:
+                # cache created by a previous version
+                self.con.execute("DROP TABLE results")
+            self.con.execute("CREATE TABLE IF NOT EXISTS results "
+                             "(key TEXT PRIMARY KEY, db_path TEXT, db_key TEXT, value TEXT, size INTEGER, "
+                             "last_access REAL)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS results_last_access_idx ON results(last_access)")
+            self.con.execute("CREATE INDEX IF NOT EXISTS results_db_path_idx ON results(db_path)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS cache_meta (id INTEGER PRIMARY KEY, total_size INTEGER)")
+            self.con.execute("INSERT OR IGNORE INTO cache_meta (id, total_size) "
+                             "SELECT 0, coalesce(sum(size), 0) FROM results")
+            self.con.execute("CREATE TRIGGER IF NOT EXISTS results_on_insert AFTER INSERT ON results "
+                             "BEGIN UPDATE cache_meta SET total_size = total_size + new.size WHERE id = 0; END")
+            self.con.execute("CREATE TRIGGER IF NOT EXISTS results_on_update AFTER UPDATE OF size ON results "
+                             "BEGIN UPDATE cache_meta SET total_size = total_size + new.size - old.size "
+                             "WHERE id = 0; END")
+            self.con.execute("CREATE TRIGGER IF NOT EXISTS results_on_delete AFTER DELETE ON results "
+                             "BEGIN UPDATE cache_meta SET total_size = total_size - old.size WHERE id = 0; END")
+            self.db_path = os.path.abspath(db_name)
+            self.db_key = manifest_content_key(db_name) if is_manifest(db_name) else db_content_key(con, db_name)
+            self.con.execute("DELETE FROM results WHERE db_path = ? AND db_key != ?", (self.db_path, self.db_key))
+        self.max_size = max_size
+
+    def close(self):
+        self.con.close()
+
+    def _key(self, parts):
+        return hashlib.sha1(json.dumps([self.db_path, self.db_key] + list(parts)).encode()).hexdigest()
+
+    def get(self, *parts):
+        key = self._key(parts)
+        res = self.con.execute("SELECT value FROM results WHERE key = ?", (key, )).fetchone()
+        if res is None:
+            return None
+        with self.con:
+            self.con.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+        return [tuple(items) for items in json.loads(res[0])]
+
+    def put(self, value, *parts):
+        value = json.dumps(value)
+        with self.con:
+            self.con.execute("INSERT INTO results (key, db_path, db_key, value, size, last_access) "
+                             "VALUES (?, ?, ?, ?, ?, ?) "
+                             "ON CONFLICT(key) DO UPDATE SET value = excluded.value, size = excluded.size, "
+                             "last_access = excluded.last_access",
+                             (self._key(parts), self.db_path, self.db_key, value, len(value), time.time()))
+            self.evict()
+
+    def evict(self):
+        total = self.con.execute("SELECT total_size FROM cache_meta WHERE id = 0").fetchone()[0]
+        if total <= self.max_size:
+            return
+        keys = []
+        for key, size in self.con.execute("SELECT key, size FROM results ORDER BY last_access"):
+            keys.append((key, ))
+            total -= size
+            if total <= self.max_size:
+                break
+        self.con.executemany("DELETE FROM results WHERE key = ?", keys)
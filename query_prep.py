@@ -0,0 +1,91 @@
+import sqlite3
+from collections import OrderedDict
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
+
+from add_fp_to_db import compose_bfp_function
+from db_utils import load_chemicalite
+from parallel_build import bounded_imap
+from profiling import profiler, profiled, collect
+
+
+_con = None
+# in-process memo of prepared queries, the least recently used ones are dropped when it exceeds MAX_MEMO items
+_memo = OrderedDict()
+MAX_MEMO = 100000
+
+
+def take(n, iterable):
+    return list(islice(iterable, n))
+
+
+def init_worker():
+    global _con
+    _con = sqlite3.connect(':memory:')
+    load_chemicalite(_con)
+
+
+def open_prep_pool(ncpu):
+    # queries are prepared in-process if ncpu is 0
+    if ncpu > 0:
+        return Pool(ncpu, initializer=init_worker)
+    init_worker()
+    return None
+
+
+def prepare_query(smi, fp, radius_morgan, canonical=False):
+    # (bfp, canonical smiles) of a query or None if it cannot be parsed, repeated queries are taken from the memo,
+    # the SMILES is parsed once and the fingerprint is generated from the Mol object
+    key = (smi, fp, radius_morgan, canonical)
+    if key in _memo:
+        profiler.count('query_memo_hits')
+        _memo.move_to_end(key)
+        return _memo[key]
+    sql = f"SELECT {compose_bfp_function(fp, '?1', radius_morgan)}{', mol_to_smiles(?1)' if canonical else ''}"
+    mol = _con.execute("SELECT mol_from_smiles(?1)", (smi, )).fetchone()[0]
+    row = _con.execute(sql, (mol, )).fetchone() if mol is not None else None
+    res = (row[0], row[1] if canonical else None) if row is not None and row[0] is not None else None
+    _memo[key] = res
+    if len(_memo) > MAX_MEMO:
+        _memo.popitem(last=False)
+    return res
+
+
+def prepare_queries(queries, fp, radius_morgan, canonical=False):
+    # returns (smi, id, bfp, canonical smiles or None) of valid queries and (smi, id) of rejected ones
+    with profiler.phase('query_prep'):
+        prepared = []
+        rejected = []
+        for smi, mol_id in queries:
+            res = prepare_query(smi, fp, radius_morgan, canonical)
+            if res is None:
+                rejected.append((smi, mol_id))
+            else:
+                prepared.append((smi, mol_id) + res)
+        return prepared, rejected
+
+
+def iter_prepared(queries, fp, radius_morgan, pool=None, batch_size=100, max_pending=4, canonical=False,
+                  rejects=None):
+    # yields batches of prepared queries in the input order, queries are read lazily and at most max_pending
+    # batches are prepared ahead of the consumer, rejected queries are written to the rejects file object
+    batches = iter(partial(take, batch_size, iter(queries)), [])
+    func = profiled(partial(prepare_queries, fp=fp, radius_morgan=radius_morgan, canonical=canonical))
+    results = bounded_imap(pool, func, batches, max_pending) if pool is not None else map(func, batches)
+    for res in results:
+        prepared, rejected = collect(res)
+        profiler.count('prepared_queries', len(prepared))
+        profiler.count('rejected_queries', len(rejected))
+        if rejects is not None and rejected:
+            rejects.write(''.join(f'{smi}\t{mol_id}\n' for smi, mol_id in rejected))
+        if prepared:
+            yield prepared
+
+
+def add_prep_arguments(parser):
+    parser.add_argument('--prep_ncpu', metavar='INTEGER', default=1, type=int,
+                        help='number of processes parsing and fingerprinting queries ahead of the search, '
+                             '0 - queries are prepared by the main process. Default: 1.')
+    parser.add_argument('--rejects', metavar='FILENAME', default=None,
+                        help='text file where queries which cannot be parsed will be saved. Default: None.')
@@ -0,0 +1,170 @@
+import bz2
+import gzip
+import io
+import sqlite3
+import sys
+from abc import ABC, abstractmethod
+
+
+# columns of search results with their types
+SIMILARITY_COLUMNS = [('query_smi', str), ('query_id', str), ('found_smi', str), ('found_id', str),
+                      ('similarity', float)]
+SUBSTRUCTURE_COLUMNS = [('query_smarts', str), ('query_id', str), ('found_smi', str), ('found_id', str)]
+EXACT_COLUMNS = [('query_smi', str), ('query_id', str), ('found_smi', str), ('found_id', str)]
+
+OUTPUT_FORMATS = ['auto', 'tsv', 'parquet', 'arrow', 'sqlite']
+
+
+def output_format(fname, fmt='auto'):
+    # format of the output file guessed by its extension, text files can be compressed (.gz, .bz2, .zst)
+    if fmt != 'auto':
+        return fmt
+    if fname is None:
+        return 'tsv'
+    if fname.endswith('.parquet'):
+        return 'parquet'
+    if fname.endswith(('.arrow', '.feather', '.ipc')):
+        return 'arrow'
+    if fname.endswith(('.db', '.sqlite', '.sqlite3')):
+        return 'sqlite'
+    return 'tsv'
+
+
+def open_text(fname, buffer_size):
+    if fname.endswith('.gz'):
+        return gzip.open(fname, 'wt', compresslevel=6)
+    if fname.endswith('.bz2'):
+        return bz2.open(fname, 'wt')
+    if fname.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('zstandard package is required to write .zst files')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(open(fname, 'wb')), encoding='utf-8')
+    return open(fname, 'wt', buffering=buffer_size)
+
+
+class ResultWriter(ABC):
+    # Rows are collected and written in batches of batch_size rows, flush writes the collected rows immediately.
+
+    def __init__(self, columns, batch_size):
+        self.columns = columns
+        self.batch_size = batch_size
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.rows.append(row)
+            if len(self.rows) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.rows:
+            self._write(self.rows)
+            self.rows = []
+
+    def close(self):
+        self.flush()
+
+    @abstractmethod
+    def _write(self, rows):
+        pass
+
+
+class TsvWriter(ResultWriter):
+
+    def __init__(self, fname, columns, header=True, batch_size=10000, buffer_size=2 ** 20):
+        super().__init__(columns, batch_size)
+        self.f = open_text(fname, buffer_size) if fname is not None else sys.stdout
+        if header:
+            self.f.write('\t'.join(name for name, _ in columns) + '\n')
+
+    def _write(self, rows):
+        self.f.write(''.join('\t'.join(map(str, row)) + '\n' for row in rows))
+
+    def flush(self):
+        super().flush()
+        if self.f is sys.stdout:
+            self.f.flush()
+
+    def close(self):
+        super().close()
+        if self.f is not sys.stdout:
+            self.f.close()
+
+
+class ArrowWriter(ResultWriter):
+    # Parquet file or Arrow IPC file, every batch becomes a row group (a record batch)
+
+    def __init__(self, fname, columns, fmt='parquet', batch_size=100000):
+        super().__init__(columns, batch_size)
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow package is required to write Parquet and Arrow files')
+        self.pa = pa
+        types = {str: pa.string(), float: pa.float64(), int: pa.int64()}
+        self.schema = pa.schema([(name, types[t]) for name, t in columns])
+        if fmt == 'parquet':
+            self.writer = pq.ParquetWriter(fname, self.schema)
+        else:
+            self.writer = pa.ipc.new_file(fname, self.schema)
+
+    def _write(self, rows):
+        # None values are written as nulls
+        arrays = [self.pa.array([t(v) if v is not None else None for v in values], type=field.type)
+                  for (_, t), field, values in zip(self.columns, self.schema, zip(*rows))]
+        self.writer.write_batch(self.pa.record_batch(arrays, schema=self.schema))
+
+    def close(self):
+        super().close()
+        self.writer.close()
+
+
+class SqliteWriter(ResultWriter):
+    # the table is recreated, rows are inserted in a single transaction
+
+    def __init__(self, fname, columns, table='results', batch_size=100000):
+        super().__init__(columns, batch_size)
+        types = {str: 'TEXT', float: 'REAL', int: 'INTEGER'}
+        self.con = sqlite3.connect(fname)
+        self.con.execute(f"DROP TABLE IF EXISTS {table}")
+        self.con.execute(f"CREATE TABLE {table}({', '.join(f'{name} {types[t]}' for name, t in columns)})")
+        self.sql = f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))})"
+
+    def _write(self, rows):
+        self.con.executemany(self.sql, rows)
+
+    def close(self):
+        super().close()
+        self.con.commit()
+        self.con.close()
+
+
+def open_writer(fname, columns, fmt='auto', header=True, table='results'):
+    # fname None - TSV to STDOUT
+    fmt = output_format(fname, fmt)
+    if fname is None and fmt != 'tsv':
+        raise ValueError(f'{fmt} output requires an output file')
+    if fmt in ('parquet', 'arrow'):
+        return ArrowWriter(fname, columns, fmt)
+    if fmt == 'sqlite':
+        return SqliteWriter(fname, columns, table)
+    return TsvWriter(fname, columns, header)
+
+
+def add_output_arguments(parser):
+    parser.add_argument('--output_format', metavar='STRING', default='auto', choices=OUTPUT_FORMATS,
+                        help='format of the output: tsv - text file (compressed if the file name ends with .gz, .bz2 '
+                             'or .zst), parquet, arrow - Arrow IPC file (pyarrow is required), sqlite - table of '
+                             'SQLite DB. auto - by the extension of the output file (.parquet, .arrow/.feather, '
+                             '.db/.sqlite, otherwise tsv). Default: auto.')
+    parser.add_argument('--output_table', metavar='STRING', default='results',
+                        help='table name of SQLite output, an existing table is replaced. Default: results.')
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import os
+import socket
+
+from profiling import profiler, add_profile_arguments, setup_profiling
+from result_writers import SIMILARITY_COLUMNS, SUBSTRUCTURE_COLUMNS, open_writer, add_output_arguments
+from sim_search import read_smi
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        super().__init__('localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(con, endpoint, params):
+    con.request('POST', f'/{endpoint}', body=json.dumps(params), headers={'Content-Type': 'application/json'})
+    res = con.getresponse()
+    payload = json.loads(res.read())
+    if res.status != 200:
+        raise RuntimeError(f'{res.status} {res.reason}: {payload.get("error")}')
+    return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Send queries to search_server.py and save results in the same '
+                                                 'format as sim_search.py and substr_search.py.')
+    parser.add_argument('-e', '--endpoint', metavar='STRING', default='similarity',
+                        choices=['similarity', 'topk', 'bulk', 'substructure'],
+                        help='type of search: similarity, topk, bulk or substructure. Default: similarity.')
+    parser.add_argument('-q', '--query', metavar='STRING or FNAME', required=True,
+                        help='reference SMILES (SMARTS) or a file with SMILES (SMARTS) and optional ids.')
+    parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
+                        help='output text file. If omitted output will be printed to STDOUT.')
+    parser.add_argument('--host', metavar='STRING', default='127.0.0.1',
+                        help='host of the server. Default: 127.0.0.1.')
+    parser.add_argument('--port', metavar='INTEGER', default=8765, type=int,
+                        help='port of the server. Default: 8765.')
+    parser.add_argument('-s', '--socket', metavar='FILENAME', default=None,
+                        help='Unix socket of the server. Default: None.')
+    parser.add_argument('-f', '--fp', metavar='STRING', default='morgan',
+                        choices=['morgan', 'feat_morgan', 'pattern', 'atom_pairs', 'rdkit', 'topological_torsion'],
+                        help='fingerprint type. Default: morgan.')
+    parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
+                        help='radius of Morgan fingerprint. Default: 2.')
+    parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=None, type=float,
+                        help='Tanimoto similarity threshold (see sim_search.py and bulk_sim_search.py). '
+                             'Default: None.')
+    parser.add_argument('-l', '--limit', metavar='INTEGER', default=None, type=int,
+                        help='maximum number of matches to retrieve, k for topk search. Default: None.')
+    parser.add_argument('-b', '--batch_size', metavar='INTEGER', default=100, type=int,
+                        help='number of queries sent in one bulk request. Default: 100.')
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+    setup_profiling(args)
+
+    if os.path.isfile(args.query):
+        queries = list(read_smi(args.query))
+    else:
+        queries = [(args.query, args.query)]
+
+    if args.socket is not None:
+        con = UnixHTTPConnection(args.socket)
+    else:
+        con = http.client.HTTPConnection(args.host, args.port)
+
+    params = {}
+    if args.endpoint != 'substructure':
+        params.update({'fp': args.fp, 'radius_morgan': args.radius_morgan})
+        if args.threshold is not None:
+            params['threshold'] = args.threshold
+    if args.endpoint == 'topk':
+        params['k'] = args.limit if args.limit is not None else 1
+    elif args.limit is not None:
+        params['limit'] = args.limit
+
+    columns = SUBSTRUCTURE_COLUMNS if args.endpoint == 'substructure' else SIMILARITY_COLUMNS
+    writer = open_writer(args.output, columns, args.output_format, table=args.output_table)
+    try:
+        if args.endpoint == 'bulk':
+            batches = [{'queries': queries[i:i + args.batch_size]} for i in range(0, len(queries), args.batch_size)]
+        else:
+            batches = [{'query': smi, 'query_id': mol_id} for smi, mol_id in queries]
+        for batch in batches:
+            with profiler.phase('request'):
+                payload = request(con, args.endpoint, dict(params, **batch))
+            if payload['columns'] != [name for name, _ in columns]:
+                raise RuntimeError(f'unexpected columns returned by the server: {", ".join(payload["columns"])}')
+            profiler.count('requests')
+            profiler.record('hits_per_request', len(payload['rows']))
+            with profiler.phase('output'):
+                writer.write_rows(map(tuple, payload['rows']))
+                if args.output is None:
+                    writer.flush()
+    finally:
+        con.close()
+        writer.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from multiprocessing import cpu_count
+
+from bulk_sim_search import get_similarity
+from db_utils import load_chemicalite, connect_db
+from profiling import profiler, add_profile_arguments, setup_profiling
+from result_writers import SIMILARITY_COLUMNS, SUBSTRUCTURE_COLUMNS
+from sim_search import find_similar, top_k_similarity, query_bfp, has_stored_bfp
+from substr_search import query_pattern, substructure_search
+
+
+FP_TYPES = ['morgan', 'feat_morgan', 'pattern', 'atom_pairs', 'rdkit', 'topological_torsion']
+
+
+def cpu_type(x):
+    return max(1, min(int(x), cpu_count()))
+
+
+class SearchDB:
+    # Keeps DB open for the whole lifetime of the server, every thread of the pool gets its own connection.
+    # In memory mode DB is copied once into a shared in-memory DB, which is used by all connections.
+
+    def __init__(self, db_name, mode='immutable', table='mols', mol_field='mol'):
+        self.db_name = db_name
+        self.mode = mode
+        self.table = table
+        self.mol_field = mol_field
+        self.local = threading.local()
+        self.keeper = None
+        if mode == 'memory':
+            self.uri = f'file:search_server_{os.getpid()}?mode=memory&cache=shared'
+            self.keeper = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            with sqlite3.connect(db_name) as src:
+                src.backup(self.keeper)
+            src.close()
+
+    def connection(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            if self.mode == 'memory':
+                con = sqlite3.connect(self.uri, uri=True)
+                load_chemicalite(con)
+            else:
+                con = connect_db(self.db_name, mode=self.mode)
+            self.local.con = con
+        return con
+
+    def similarity(self, query, query_id=None, fp='morgan', radius_morgan=2, threshold=None, limit=None):
+        con = self.connection()
+        bfp = query_bfp(con, query, fp, radius_morgan)
+        if bfp is None:
+            return []
+        res = find_similar(con, bfp, fp, self.mol_field, self.table, threshold, limit, radius_morgan,
+                           stored_bfp=has_stored_bfp(con, self.table, fp, radius_morgan))
+        return [(query, query_id or query) + i for i in res]
+
+    def topk(self, query, k, query_id=None, fp='morgan', radius_morgan=2, threshold=0.7):
+        con = self.connection()
+        bfp = query_bfp(con, query, fp, radius_morgan)
+        if bfp is None:
+            return []
+        res = top_k_similarity(con, bfp, k, fp, self.mol_field, self.table, radius_morgan, threshold=threshold,
+                               stored_bfp=has_stored_bfp(con, self.table, fp, radius_morgan))
+        return [(query, query_id or query) + i for i in res]
+
+    def bulk(self, queries, fp='morgan', radius_morgan=2, threshold=0.7, limit=None):
+        con = self.connection()
+        output = []
+        for smi, query_id in queries:
+            res = get_similarity(con, fp, self.mol_field, self.table, smi, threshold, limit, radius_morgan)
+            output.extend((smi, query_id) + i for i in res)
+        return output
+
+    def substructure(self, query, query_id=None, limit=None):
+        con = self.connection()
+        qmol, qbfp = query_pattern(con, query)
+        if qmol is None:
+            return []
+        res = substructure_search(con, self.table, self.mol_field, qmol, qbfp, limit=limit)
+        return [(query, query_id or query) + i for i in res]
+
+
+def parse_request(path, params):
+    # returns the name of SearchDB method, output columns and validated arguments,
+    # values used to compose SQL are checked and converted explicitly
+    params = dict(params)
+    if 'fp' in params and params['fp'] not in FP_TYPES:
+        raise ValueError(f'unknown fingerprint {params["fp"]}')
+    for name, func in [('radius_morgan', int), ('limit', int), ('k', int), ('threshold', float)]:
+        if params.get(name) is not None:
+            params[name] = func(params[name])
+    if path == '/similarity':
+        return 'similarity', SIMILARITY_COLUMNS, params
+    if path == '/topk':
+        return 'topk', SIMILARITY_COLUMNS, params
+    if path == '/bulk':
+        params['queries'] = [(q[0], q[1] if len(q) > 1 else q[0]) for q in params['queries']]
+        return 'bulk', SIMILARITY_COLUMNS, params
+    if path == '/substructure':
+        return 'substructure', SUBSTRUCTURE_COLUMNS, params
+    raise KeyError(f'unknown endpoint {path}')
+
+
+class SearchServer:
+
+    def __init__(self, db, max_concurrency=1, max_pending=100):
+        self.db = db
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        # requests above the limit are rejected instead of queuing indefinitely
+        self.pending = asyncio.Semaphore(max_pending)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode('latin-1').split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                status, payload = await self.process(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(f'HTTP/1.1 {status}\r\n'
+                             f'Content-Type: application/json\r\n'
+                             f'Content-Length: {len(data)}\r\n\r\n'.encode('latin-1') + data)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def process(self, method, path, body):
+        if method == 'GET' and path == '/health':
+            return '200 OK', {'status': 'ok'}
+        if method != 'POST':
+            return '405 Method Not Allowed', {'error': 'only POST requests are supported'}
+        if self.pending.locked():
+            return '503 Service Unavailable', {'error': 'too many pending requests'}
+        async with self.pending:
+            try:
+                name, columns, params = parse_request(path, json.loads(body or b'{}'))
+                func = partial(getattr(self.db, name), **params)
+            except (KeyError, TypeError, IndexError, ValueError) as e:
+                return '400 Bad Request', {'error': str(e)}
+            profiler.count(f'requests.{name}')
+            try:
+                with profiler.phase(name):
+                    rows = await asyncio.get_running_loop().run_in_executor(self.executor, func)
+            except (TypeError, sqlite3.Error) as e:
+                return '400 Bad Request', {'error': str(e)}
+            except Exception as e:
+                return '500 Internal Server Error', {'error': str(e)}
+            profiler.record(f'hits_per_request.{name}', len(rows))
+            return '200 OK', {'columns': [name for name, _ in columns], 'rows': rows}
+
+
+async def serve(server, host, port, socket_path):
+    if socket_path is not None:
+        srv = await asyncio.start_unix_server(server.handle, path=socket_path)
+        sys.stderr.write(f'listening on {socket_path}\n')
+    else:
+        srv = await asyncio.start_server(server.handle, host=host, port=port)
+        sys.stderr.write(f'listening on http://{host}:{port}\n')
+    async with srv:
+        await srv.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search server which keeps DB open and answers similarity and '
+                                                 'substructure queries sent as JSON over HTTP. Endpoints: '
+                                                 '/similarity, /topk, /bulk, /substructure (POST) and '
+                                                 '/health (GET). Use search_client.py to send queries.')
+    parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
+                        help='input SQLite DB.')
+    parser.add_argument('-t', '--table', metavar='STRING', default='mols',
+                        help='table name where Mol objects are stored. Default: mols.')
+    parser.add_argument('-m', '--mol_field', metavar='STRING', default='mol',
+                        help='field name where mol objects are stored. Default: mol.')
+    parser.add_argument('--host', metavar='STRING', default='127.0.0.1',
+                        help='host to listen on. Default: 127.0.0.1.')
+    parser.add_argument('--port', metavar='INTEGER', default=8765, type=int,
+                        help='port to listen on. Default: 8765.')
+    parser.add_argument('-s', '--socket', metavar='FILENAME', default=None,
+                        help='listen on a Unix socket instead of a TCP port. Default: None.')
+    parser.add_argument('-a', '--db_mode', metavar='STRING', default='immutable', choices=['immutable', 'memory'],
+                        help='how DB is accessed: immutable - read-only memory mapped access, memory - DB is '
+                             'copied in memory once at start. Default: immutable.')
+    parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                        help='maximum number of queries executed concurrently. Default: 1.')
+    parser.add_argument('--max_pending', metavar='INTEGER', default=100, type=int,
+                        help='maximum number of accepted requests, further requests are rejected. Default: 100.')
+    add_profile_arguments(parser)
+
+    args = parser.parse_args()
+    setup_profiling(args)
+
+    db = SearchDB(args.input_db, mode=args.db_mode, table=args.table, mol_field=args.mol_field)
+    try:
+        asyncio.run(serve(SearchServer(db, max_concurrency=args.ncpu, max_pending=args.max_pending),
+                          args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if args.socket is not None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
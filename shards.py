@@ -0,0 +1,171 @@
+import heapq
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import zlib
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, Process
+from urllib.request import pathname2url
+
+from db_utils import connect_db
+from profiling import profiler
+
+
+_con = None
+
+
+def is_manifest(fname):
+    return fname.endswith('.json')
+
+
+def compose_shard_names(manifest_fname, nshards):
+    root = os.path.splitext(manifest_fname)[0]
+    return [f'{root}_{i}.db' for i in range(nshards)]
+
+
+def write_manifest(manifest_fname, shard_fnames, shard_by, table, bounds=None):
+    # paths of shards are stored relative to the manifest
+    base = os.path.dirname(os.path.abspath(manifest_fname))
+    manifest = {'shard_by': shard_by,
+                'table': table,
+                'shards': [os.path.relpath(os.path.abspath(fname), base) for fname in shard_fnames]}
+    if bounds is not None:
+        manifest['bounds'] = bounds
+    with open(manifest_fname, 'wt') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def read_manifest(manifest_fname):
+    with open(manifest_fname) as f:
+        manifest = json.load(f)
+    base = os.path.dirname(os.path.abspath(manifest_fname))
+    manifest['shards'] = [os.path.join(base, fname) for fname in manifest['shards']]
+    return manifest
+
+
+def shard_db_names(db_name):
+    # shard DBs listed in a manifest or the DB itself
+    return read_manifest(db_name)['shards'] if is_manifest(db_name) else [db_name]
+
+
+def range_bounds(ids, nshards):
+    # ids separating nshards ranges of the given (sampled) ids
+    ids = sorted(ids)
+    return [ids[len(ids) * i // nshards] for i in range(1, nshards)] if ids else []
+
+
+def sample_ids(records, size=100000, seed=0):
+    # reservoir sample of ids of (smi, id, ...) records
+    rng = random.Random(seed)
+    sample = []
+    for i, rec in enumerate(records):
+        if i < size:
+            sample.append(rec[1])
+        else:
+            j = rng.randint(0, i)
+            if j < size:
+                sample[j] = rec[1]
+    return sample
+
+
+def shard_index(mol_id, nshards, bounds=None):
+    # shard of a compound by the hash of its id or by the range of ids
+    if bounds is not None:
+        return bisect_right(bounds, mol_id)
+    return zlib.crc32(mol_id.encode()) % nshards
+
+
+def manifest_content_key(manifest_fname):
+    # changes whenever content of any shard is changed (see db_utils.db_content_key)
+    keys = []
+    for fname in read_manifest(manifest_fname)['shards']:
+        st = os.stat(fname)
+        con = sqlite3.connect(f'file:{pathname2url(fname)}?mode=ro', uri=True)
+        generation = con.execute("PRAGMA user_version").fetchone()[0]
+        con.close()
+        keys.append(f'{generation}:{st.st_size}:{st.st_mtime_ns}')
+    return ';'.join(keys)
+
+
+def merge_hits(results, limit=None):
+    # merges lists of hits sorted by decreasing similarity (the last item of every hit)
+    return list(islice(heapq.merge(*results, key=lambda x: -x[-1]), limit))
+
+
+def run_shard(func, db_name, stats_fname, kwargs):
+    # statistics of profiled phases are passed to the main process through a file
+    profiler.reset()
+    func(db_name, **kwargs)
+    if stats_fname is not None:
+        with open(stats_fname, 'wt') as f:
+            json.dump(profiler.stats(), f)
+
+
+def run_on_shards(func, db_names, ncpu=1, **kwargs):
+    # func(db_name, ncpu=..., **kwargs) is run for every shard in a separate process,
+    # cpus are divided between shards
+    kwargs = dict(kwargs, ncpu=max(1, ncpu // len(db_names)))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        stats_fnames = [os.path.join(tmp_dir, f'{i}.json') if profiler.enabled else None
+                        for i in range(len(db_names))]
+        procs = [Process(target=run_shard, args=(func, db_name, stats_fname, kwargs))
+                 for db_name, stats_fname in zip(db_names, stats_fnames)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        failed = [db_name for db_name, p in zip(db_names, procs) if p.exitcode != 0]
+        if failed:
+            raise RuntimeError(f'processing of shards failed: {", ".join(failed)}')
+        for stats_fname in stats_fnames:
+            if stats_fname is not None:
+                with open(stats_fname) as f:
+                    profiler.merge(json.load(f))
+
+
+def init_worker(db_name, db_mode):
+    global _con
+    _con = connect_db(db_name, mode=db_mode)
+
+
+def call_with_connection(args, func, kwargs):
+    return func(_con, *args, **kwargs)
+
+
+class ShardPool:
+    # Every shard is searched by its own pool of processes which keep the shard DB open.
+    # Functions are called as func(con, *args, **kwargs) and return results of all shards in the order of shards.
+
+    def __init__(self, db_names, db_mode='immutable', nprocs=1):
+        self.pools = [Pool(nprocs, initializer=init_worker, initargs=(db_name, db_mode)) for db_name in db_names]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for p in self.pools:
+            p.terminate()
+
+    def submit(self, func, args, kwargs):
+        return [p.apply_async(call_with_connection, (args, func, kwargs)) for p in self.pools]
+
+    def map(self, func, *args, **kwargs):
+        return [job.get() for job in self.submit(func, args, kwargs)]
+
+    def imap(self, func, iterable, max_pending, **kwargs):
+        # results of func(con, item, **kwargs) for items in the input order,
+        # up to max_pending items are searched on all shards concurrently
+        pending = deque()
+        for item in iterable:
+            pending.append(self.submit(func, (item, ), kwargs))
+            if len(pending) >= max_pending:
+                yield [job.get() for job in pending.popleft()]
+        while pending:
+            yield [job.get() for job in pending.popleft()]
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+
+import numpy as np
+
+from db_utils import connect_db
+from fp_matrix import cpu_type, popcount, bfp_to_array, tanimoto, sql_for_fps, load_labels, LIB_BLOCK, QUERY_BLOCK
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from result_writers import SIMILARITY_COLUMNS, open_writer, add_output_arguments
+
+
+CLUSTER_COLUMNS = [('smi', str), ('id', str), ('cluster', int), ('is_centroid', int), ('centroid_similarity', float)]
+PICK_COLUMNS = [('smi', str), ('id', str), ('pick', int), ('max_similarity', float)]
+
+_a = None
+_a_cnt = None
+_b = None
+_b_cnt = None
+
+
+def load_fps(name, table, mol_field, fp, radius_morgan, chunk_size=100000):
+    # returns (smi, id) labels, fingerprints and bit counts of compounds of DB or of a matrix exported by fp_matrix.py
+    if os.path.isfile(name + '.npy'):
+        with open(name + '.json') as f:
+            meta = json.load(f)
+        if (meta['fp'], meta['radius_morgan']) != (fp, radius_morgan):
+            raise ValueError(f'{name} contains other fingerprints than {fp} with radius {radius_morgan}')
+        return load_labels(name), np.load(name + '.npy'), np.load(name + '.cnt.npy')
+    con = connect_db(name)
+    fp_sql, from_sql = sql_for_fps(con, table, mol_field, fp, radius_morgan)
+    labels, blocks = [], []
+    cur = con.execute(f"SELECT main.smi, main.id, {fp_sql} {from_sql} ORDER BY main.rowid")
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        labels.extend((smi, mol_id) for smi, mol_id, _ in rows)
+        blocks.append(bfp_to_array([r[2] for r in rows]))
+    con.close()
+    fps = np.concatenate(blocks) if blocks else bfp_to_array([])
+    return labels, fps, popcount(fps)
+
+
+def popcount_range(cnt, min_cnt, max_cnt, threshold):
+    # range of sorted bit counts which can reach the threshold with queries having bit counts from min_cnt to max_cnt,
+    # Tanimoto coefficient cannot exceed min(a, b) / max(a, b)
+    if threshold <= 0:
+        return 0, len(cnt)
+    return (int(np.searchsorted(cnt, threshold * min_cnt - 1e-9, side='left')),
+            int(np.searchsorted(cnt, max_cnt / threshold + 1e-9, side='right')))
+
+
+def init_worker(a, a_cnt, b, b_cnt):
+    # fingerprints are sorted by bit counts, b is None for a self join
+    global _a, _a_cnt, _b, _b_cnt
+    _a, _a_cnt, _b, _b_cnt = a, a_cnt, b, b_cnt
+
+
+def join_range(bounds, threshold):
+    # returns (a index, b index, similarity) arrays of pairs above the threshold for the given range of rows of a,
+    # a self join returns every pair once (a index < b index)
+    start, end = bounds
+    b, b_cnt = (_a, _a_cnt) if _b is None else (_b, _b_cnt)
+    ai, bi, s = [], [], []
+    for qs in range(start, end, QUERY_BLOCK):
+        qe = min(qs + QUERY_BLOCK, end)
+        q, q_cnt = _a[qs:qe], _a_cnt[qs:qe]
+        lo, hi = popcount_range(b_cnt, q_cnt[0], q_cnt[-1], threshold)
+        if _b is None:
+            lo = max(lo, qs + 1)
+        for lb in range(lo, hi, LIB_BLOCK):
+            le = min(lb + LIB_BLOCK, hi)
+            sim = tanimoto(q, q_cnt, b[lb:le], b_cnt[lb:le])
+            mask = sim >= threshold
+            if _b is None:
+                mask &= np.arange(lb, le)[None, :] > np.arange(qs, qe)[:, None]
+            i, j = np.nonzero(mask)
+            ai.append(i + qs)
+            bi.append(j + lb)
+            s.append(sim[i, j])
+            profiler.count('comparisons', sim.size)
+    if not ai:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    return np.concatenate(ai), np.concatenate(bi), np.concatenate(s)
+
+
+def run_join(a, a_cnt, b, b_cnt, threshold, ncpu=1):
+    # all pairs of a and b (or of a itself if b is None) with similarity above the threshold,
+    # returns indices of the input arrays
+    a_order = np.argsort(a_cnt, kind='stable')
+    a, a_cnt = a[a_order], a_cnt[a_order]
+    if b is not None:
+        b_order = np.argsort(b_cnt, kind='stable')
+        b, b_cnt = b[b_order], b_cnt[b_order]
+    else:
+        b_order = a_order
+
+    n = len(a)
+    # rows are sorted by bit counts and costs of ranges differ, so there are many more ranges than workers
+    step = max(QUERY_BLOCK, -(-n // (ncpu * 16)))
+    ranges = [(i, min(i + step, n)) for i in range(0, n, step)]
+    func = profiled(join_range)
+    if ncpu > 1:
+        with Pool(ncpu, initializer=init_worker, initargs=(a, a_cnt, b, b_cnt)) as p:
+            parts = [collect(part) for part in p.starmap(func, [(r, threshold) for r in ranges])]
+    else:
+        init_worker(a, a_cnt, b, b_cnt)
+        parts = [collect(func(r, threshold)) for r in ranges]
+
+    ai = np.concatenate([p[0] for p in parts]) if parts else np.empty(0, dtype=np.int64)
+    bi = np.concatenate([p[1] for p in parts]) if parts else np.empty(0, dtype=np.int64)
+    s = np.concatenate([p[2] for p in parts]) if parts else np.empty(0, dtype=np.float64)
+    return a_order[ai], b_order[bi], s
+
+
+def neighbour_lists(n, rows, cols, sims):
+    # sparse neighbour lists (indptr, indices, similarities) of n compounds sorted by decreasing similarity
+    order = np.lexsort((cols, -sims, rows))
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols[order], sims[order]
+
+
+def self_neighbour_lists(n, ai, bi, s):
+    # pairs of a self join are added in both directions
+    return neighbour_lists(n, np.concatenate([ai, bi]), np.concatenate([bi, ai]), np.concatenate([s, s]))
+
+
+def filter_neighbours(indptr, indices, sims, threshold):
+    # neighbour lists above a higher threshold than the one they were computed with
+    rows = np.repeat(np.arange(len(indptr) - 1), np.diff(indptr))
+    mask = sims >= threshold
+    return neighbour_lists(len(indptr) - 1, rows[mask], indices[mask], sims[mask])
+
+
+def save_neighbours(fname, indptr, indices, sims, threshold):
+    np.savez(fname, indptr=indptr, indices=indices, similarities=sims, threshold=threshold)
+
+
+def load_neighbours(fname):
+    data = np.load(fname)
+    return data['indptr'], data['indices'], data['similarities'], float(data['threshold'])
+
+
+def sphere_exclusion(indptr, indices, sims, order):
+    # every compound not assigned yet in the given order becomes a centroid of its unassigned neighbours,
+    # returns cluster of every compound, similarity to its centroid and indices of centroids
+    n = len(indptr) - 1
+    cluster = np.full(n, -1, dtype=np.int64)
+    centroid_sim = np.zeros(n, dtype=np.float64)
+    centroids = []
+    for i in order:
+        if cluster[i] >= 0:
+            continue
+        cluster[i] = len(centroids)
+        centroid_sim[i] = 1
+        nb = indices[indptr[i]:indptr[i + 1]]
+        free = cluster[nb] < 0
+        cluster[nb[free]] = len(centroids)
+        centroid_sim[nb[free]] = sims[indptr[i]:indptr[i + 1]][free]
+        centroids.append(i)
+    return cluster, centroid_sim, centroids
+
+
+def cluster_order(indptr, method):
+    # butina - compounds with the largest number of neighbours become centroids first,
+    # leader - compounds become centroids in the input order
+    if method == 'butina':
+        return np.argsort(-np.diff(indptr), kind='stable')
+    return np.arange(len(indptr) - 1)
+
+
+def maxmin_pick(fps, cnt, k, seed=0):
+    # every next compound is the one with the lowest maximum similarity to compounds picked before,
+    # returns picked indices and their maximum similarities to previous picks
+    n = len(fps)
+    k = min(k, n)
+    max_sim = np.full(n, -1.0)
+    picks = [int(np.random.default_rng(seed).integers(n))] if n else []
+    picks_sim = [0.0] if n else []
+    while len(picks) < k:
+        i = picks[-1]
+        for lb in range(0, n, LIB_BLOCK):
+            sim = tanimoto(fps[i:i + 1], cnt[i:i + 1], fps[lb:lb + LIB_BLOCK], cnt[lb:lb + LIB_BLOCK])[0]
+            np.maximum(max_sim[lb:lb + LIB_BLOCK], sim, out=max_sim[lb:lb + LIB_BLOCK])
+        profiler.count('comparisons', n)
+        max_sim[picks] = np.inf
+        i = int(np.argmin(max_sim))
+        picks.append(i)
+        picks_sim.append(float(max_sim[i]))
+    return picks, picks_sim
+
+
+def add_fp_arguments(parser):
+    parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
+                        help='input SQLite DB with fingerprints added by add_fp_to_db.py (stored fingerprints are '
+                             'used if they were added with --store_bfp) or a prefix of a matrix exported by '
+                             'fp_matrix.py.')
+    parser.add_argument('-t', '--table', metavar='STRING', default='mols',
+                        help='table name where Mol objects are stored. Default: mols.')
+    parser.add_argument('-m', '--mol_field', metavar='STRING', default='mol',
+                        help='field name where mol objects are stored. Default: mol.')
+    parser.add_argument('-f', '--fp', metavar='STRING', default='morgan',
+                        choices=['morgan', 'feat_morgan', 'pattern', 'atom_pairs', 'rdkit', 'topological_torsion'],
+                        help='fingerprint type. Default: morgan.')
+    parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
+                        help='radius of Morgan fingerprint. Default: 2.')
+    parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
+                        help='output text file. If omitted output will be printed to STDOUT.')
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Similarity join of two libraries or of a library with itself, '
+                                                 'clustering and diversity picking based on fingerprints added to DB. '
+                                                 'All pairs are compared by blocks in memory, pairs which cannot '
+                                                 'reach the threshold are skipped by bit counts of fingerprints.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    join_parser = subparsers.add_parser('join', help='find all neighbours of compounds above the threshold.')
+    add_fp_arguments(join_parser)
+    join_parser.add_argument('-b', '--input_db_b', metavar='FILENAME', default=None,
+                             help='the second SQLite DB or exported matrix, neighbours of compounds of the first one '
+                                  'are searched in it. If omitted the first library is joined with itself, '
+                                  'a compound is not its own neighbour. Default: None.')
+    join_parser.add_argument('--table_b', metavar='STRING', default=None,
+                             help='table name of the second DB. Default: the same as --table.')
+    join_parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=0.6, type=float,
+                             help='Tanimoto similarity threshold. Default: 0.6.')
+    join_parser.add_argument('-n', '--neighbours', metavar='FILENAME', default=None,
+                             help='save neighbour lists into an .npz file which can be reused by cluster command '
+                                  '(self join only). Default: None.')
+    join_parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                             help='number of cpus.')
+
+    cluster_parser = subparsers.add_parser('cluster', help='cluster a library by neighbour lists.')
+    add_fp_arguments(cluster_parser)
+    cluster_parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=0.6, type=float,
+                                help='Tanimoto similarity threshold of neighbours of centroids. Default: 0.6.')
+    cluster_parser.add_argument('-n', '--neighbours', metavar='FILENAME', default=None,
+                                help='neighbour lists saved by join command for the same library, otherwise '
+                                     'they are computed. Default: None.')
+    cluster_parser.add_argument('--method', metavar='STRING', default='butina', choices=['butina', 'leader'],
+                                help='butina - compounds having more neighbours become centroids first, '
+                                     'leader - compounds become centroids in the order of DB. Default: butina.')
+    cluster_parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                                help='number of cpus.')
+
+    pick_parser = subparsers.add_parser('pick', help='pick a diverse subset by MaxMin algorithm.')
+    add_fp_arguments(pick_parser)
+    pick_parser.add_argument('-k', '--number', metavar='INTEGER', required=True, type=int,
+                             help='number of compounds to pick.')
+    pick_parser.add_argument('--seed', metavar='INTEGER', default=0, type=int,
+                             help='seed of the choice of the first compound. Default: 0.')
+
+    args = parser.parse_args()
+    setup_profiling(args)
+
+    with profiler.phase('load'):
+        labels, fps, cnt = load_fps(args.input_db, args.table, args.mol_field, args.fp, args.radius_morgan)
+    profiler.count('compounds', len(labels))
+
+    if args.command == 'pick':
+        with profiler.phase('pick'):
+            picks, picks_sim = maxmin_pick(fps, cnt, args.number, args.seed)
+        with profiler.phase('output'), \
+                open_writer(args.output, PICK_COLUMNS, args.output_format, table=args.output_table) as writer:
+            writer.write_rows(labels[i] + (n, sim) for n, (i, sim) in enumerate(zip(picks, picks_sim)))
+        return
+
+    if args.command == 'join' and args.input_db_b is not None:
+        if args.neighbours is not None:
+            parser.error('neighbour lists can be saved only for a self join.')
+        with profiler.phase('load'):
+            labels_b, fps_b, cnt_b = load_fps(args.input_db_b, args.table_b or args.table, args.mol_field, args.fp,
+                                              args.radius_morgan)
+        with profiler.phase('join'):
+            ai, bi, s = run_join(fps, cnt, fps_b, cnt_b, args.threshold, args.ncpu)
+            indptr, indices, sims = neighbour_lists(len(labels), ai, bi, s)
+    elif args.command == 'cluster' and args.neighbours is not None:
+        with profiler.phase('load'):
+            indptr, indices, sims, threshold = load_neighbours(args.neighbours)
+        if len(indptr) - 1 != len(labels):
+            parser.error(f'neighbour lists in {args.neighbours} were computed for another library.')
+        if args.threshold < threshold:
+            parser.error(f'neighbour lists were computed with the higher threshold {threshold}.')
+        if args.threshold > threshold:
+            indptr, indices, sims = filter_neighbours(indptr, indices, sims, args.threshold)
+    else:
+        labels_b = labels
+        with profiler.phase('join'):
+            ai, bi, s = run_join(fps, cnt, None, None, args.threshold, args.ncpu)
+            indptr, indices, sims = self_neighbour_lists(len(labels), ai, bi, s)
+        if args.neighbours is not None:
+            with profiler.phase('save_neighbours'):
+                save_neighbours(args.neighbours, indptr, indices, sims, args.threshold)
+    profiler.count('neighbours', len(indices))
+
+    if args.command == 'join':
+        rows = np.repeat(np.arange(len(labels)), np.diff(indptr))
+        with profiler.phase('output'), \
+                open_writer(args.output, SIMILARITY_COLUMNS, args.output_format, table=args.output_table) as writer:
+            writer.write_rows(labels[i] + labels_b[j] + (sim, )
+                              for i, j, sim in zip(rows.tolist(), indices.tolist(), sims.tolist()))
+        return
+
+    with profiler.phase('cluster'):
+        cluster, centroid_sim, centroids = sphere_exclusion(indptr, indices, sims, cluster_order(indptr, args.method))
+    profiler.count('clusters', len(centroids))
+    # compounds are listed by clusters, a centroid is the first compound of its cluster
+    is_centroid = np.zeros(len(labels), dtype=np.int64)
+    is_centroid[centroids] = 1
+    order = np.lexsort((-centroid_sim, -is_centroid, cluster))
+    with profiler.phase('output'), \
+            open_writer(args.output, CLUSTER_COLUMNS, args.output_format, table=args.output_table) as writer:
+        writer.write_rows(labels[i] + (c, centroid, sim) for i, c, centroid, sim in
+                          zip(order.tolist(), cluster[order].tolist(), is_centroid[order].tolist(),
+                              centroid_sim[order].tolist()))
+
+
+if __name__ == '__main__':
+    main()
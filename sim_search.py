@@ -1,35 +1,230 @@
 #!/usr/bin/env python3
 
 import argparse
+import heapq
+import math
 import os
-import psutil
-import sqlite3
-import sys
 
-from add_fp_to_db import compose_index_table_name
+from add_fp_to_db import compose_index_table_name, compose_bfp_table_name, compose_bfp_function
+from db_utils import connect_db, has_table, warm_up
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from query_cache import QueryCache
+from query_prep import open_prep_pool, iter_prepared, add_prep_arguments
+from result_writers import SIMILARITY_COLUMNS, open_writer, add_output_arguments
+from shards import is_manifest, shard_db_names, merge_hits, ShardPool
 
 
-def sql_for_similarity(fp, mol_field, table, limit=None, radius_morgan=2):
+def sql_for_similarity(fp, mol_field, table, limit=None, radius_morgan=2, stored_bfp=False):
+    # ?1 - fingerprint of a query (see query_bfp), ?2 - threshold
     index_table_name = compose_index_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan)
+    if stored_bfp:
+        bfp_table_name = compose_bfp_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan)
+        sql = f"""SELECT 
+                        main.smi, 
+                        main.id, 
+                        bfp_tanimoto(bfp.fp, ?1) as t 
+                      FROM 
+                        {table} AS main, {index_table_name} AS idx, {bfp_table_name} AS bfp
+                      WHERE 
+                        main.rowid = idx.id AND
+                        bfp.id = idx.id AND
+                        idx.id MATCH rdtree_tanimoto(?1, ?2) 
+                      ORDER BY t DESC 
+                      {'LIMIT ' + str(limit) if limit is not None else ''}"""
+    else:
+        sql = f"""SELECT 
+                        main.smi, 
+                        main.id, 
+                        bfp_tanimoto({compose_bfp_function(fp, f'main.{mol_field}', radius_morgan)}, ?1) as t 
+                      FROM 
+                        {table} AS main, {index_table_name} AS idx
+                      WHERE 
+                        main.rowid = idx.id AND
+                        idx.id MATCH rdtree_tanimoto(?1, ?2) 
+                      ORDER BY t DESC 
+                      {'LIMIT ' + str(limit) if limit is not None else ''}"""
+    return sql
+
+
+def sql_for_popcount_similarity(fp, table, limit=None, radius_morgan=2):
+    # stored fingerprints with popcounts in the range of the bounds are scored without the index,
+    # ?1 - fingerprint of a query, ?2 - threshold, ?3 and ?4 - bounds of popcounts (see popcount_bounds)
+    bfp_table_name = compose_bfp_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan)
     sql = f"""SELECT 
                     main.smi, 
                     main.id, 
-                    bfp_tanimoto(mol_{fp}_bfp(main.{mol_field}, {f'{radius_morgan},' if fp in ['morgan', 'feat_morgan'] else ''} 2048), 
-                                 mol_{fp}_bfp(mol_from_smiles(?1), {f'{radius_morgan},' if fp in ['morgan', 'feat_morgan'] else ''} 2048)) as t 
+                    bfp_tanimoto(bfp.fp, ?1) as t 
                   FROM 
-                    {table} AS main, {index_table_name} AS idx
+                    {bfp_table_name} AS bfp, {table} AS main
                   WHERE 
-                    main.rowid = idx.id AND
-                    idx.id MATCH rdtree_tanimoto(mol_{fp}_bfp(mol_from_smiles(?1), {f'{radius_morgan},' if fp in ['morgan', 'feat_morgan'] else ''} 2048), ?2) 
+                    bfp.popcnt BETWEEN ?3 AND ?4 AND
+                    t >= ?2 AND
+                    main.rowid = bfp.id
                   ORDER BY t DESC 
                   {'LIMIT ' + str(limit) if limit is not None else ''}"""
     return sql
 
 
+def sql_for_bucket_similarity(fp, table, limit, radius_morgan=2):
+    # `limit` most similar compounds among stored fingerprints with the given popcount,
+    # ?1 - fingerprint of a query, ?2 - popcount
+    bfp_table_name = compose_bfp_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan)
+    sql = f"""SELECT 
+                    main.smi, 
+                    main.id, 
+                    bfp_tanimoto(bfp.fp, ?1) as t 
+                  FROM 
+                    {bfp_table_name} AS bfp, {table} AS main
+                  WHERE 
+                    bfp.popcnt = ?2 AND
+                    main.rowid = bfp.id
+                  ORDER BY t DESC 
+                  LIMIT {int(limit)}"""
+    return sql
+
+
+def bfp_popcount(bfp):
+    return bin(int.from_bytes(bfp, 'little')).count('1')
+
+
+def popcount_bounds(bfp, threshold):
+    # Swamidass-Baldi bounds: a compound with popcount b can reach similarity t to a query with popcount a
+    # only if t * a <= b <= a / t
+    a = bfp_popcount(bfp)
+    if threshold <= 0:
+        return 0, 2048
+    return math.ceil(threshold * a - 1e-9), math.floor(a / threshold + 1e-9)
+
+
+def similarity_bound(a, b):
+    # the maximum similarity of fingerprints with popcounts a and b
+    return min(a, b) / max(a, b) if max(a, b) > 0 else 1.0
+
+
+def search_similar(con, bfp, threshold, fp, mol_field, table, limit=None, radius_morgan=2, stored_bfp=False,
+                   method='rdtree'):
+    # compounds above the threshold found by the index (rdtree) or by the popcount range of stored fingerprints
+    if method == 'popcount':
+        if not stored_bfp:
+            raise ValueError('popcount search requires stored fingerprints, run add_fp_to_db.py with --store_bfp')
+        sql = sql_for_popcount_similarity(fp, table, limit, radius_morgan)
+        return profiler.fetchall(con, sql, (bfp, threshold) + popcount_bounds(bfp, threshold))
+    sql = sql_for_similarity(fp, mol_field, table, limit, radius_morgan, stored_bfp)
+    return profiler.fetchall(con, sql, (bfp, threshold))
+
+
+def sql_for_top_similarity(fp, mol_field, table, limit, radius_morgan=2):
+    # single scan over all compounds keeping only `limit` most similar ones, ?1 - fingerprint of a query
+    sql = f"""SELECT 
+                    main.smi, 
+                    main.id, 
+                    bfp_tanimoto({compose_bfp_function(fp, f'main.{mol_field}', radius_morgan)}, ?1) as t 
+                  FROM 
+                    {table} AS main
+                  WHERE 
+                    main.{mol_field} IS NOT NULL
+                  ORDER BY t DESC 
+                  LIMIT {int(limit)}"""
+    return sql
+
+
+def top_k_similarity(con, bfp, k, fp, mol_field, table, radius_morgan=2, threshold=0.7, stored_bfp=False,
+                     method='rdtree'):
+    # k nearest neighbours of a query fingerprint.
+    # The index search at the threshold returns all compounds above it, so if it found at least k compounds these are
+    # the k nearest ones. Otherwise k nearest neighbours are found in a single pass (see nearest_neighbours).
+    # If k is None, all compounds above the threshold are returned or the most similar one if there are no such.
+    profiler.count('threshold_searches')
+    res = search_similar(con, bfp, threshold, fp, mol_field, table, k, radius_morgan, stored_bfp, method)
+    if k is None:
+        if res:
+            return res
+        k = 1
+    elif len(res) >= k:
+        return res
+    return nearest_neighbours(con, bfp, k, fp, mol_field, table, radius_morgan, stored_bfp, method)
+
+
+def nearest_neighbours(con, bfp, k, fp, mol_field, table, radius_morgan=2, stored_bfp=False, method='rdtree'):
+    # k most similar compounds in a single pass.
+    # Stored fingerprints are scanned by popcount buckets keeping k best compounds and skipping buckets which cannot
+    # contain closer ones, otherwise fingerprints of all compounds are generated and scanned once with ORDER BY LIMIT k
+    if stored_bfp:
+        return popcount_nearest_neighbours(con, bfp, k, fp, table, radius_morgan)
+    if method == 'popcount':
+        raise ValueError('popcount search requires stored fingerprints, run add_fp_to_db.py with --store_bfp')
+    profiler.count('exhaustive_searches')
+    sql = sql_for_top_similarity(fp, mol_field, table, k, radius_morgan)
+    return profiler.fetchall(con, sql, (bfp, ))
+
+
+def popcount_nearest_neighbours(con, bfp, k, fp, table, radius_morgan=2):
+    # k most similar compounds by scanning popcount buckets in the order of decreasing similarity bound,
+    # the scan stops as soon as the bound of the next bucket cannot exceed the k-th found similarity
+    bfp_table_name = compose_bfp_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan)
+    a = bfp_popcount(bfp)
+    buckets = [b for b, in con.execute(f"SELECT DISTINCT popcnt FROM {bfp_table_name}")]
+    sql = sql_for_bucket_similarity(fp, table, k, radius_morgan)
+    res = []
+    for bound, b in sorted(((similarity_bound(a, b), b) for b in buckets), reverse=True):
+        if len(res) >= k and bound <= res[-1][2]:
+            break
+        profiler.count('popcount_buckets')
+        res = heapq.nlargest(k, res + profiler.fetchall(con, sql, (bfp, b)), key=lambda x: x[2])
+    return res
+
+
+def find_similar(con, bfp, fp, mol_field, table, threshold=None, limit=None, radius_morgan=2, stored_bfp=False,
+                 method='rdtree'):
+    # compounds above the threshold or top similar compounds if the threshold is None (see top_k_similarity)
+    if threshold is None:
+        return top_k_similarity(con, bfp, limit, fp, mol_field, table, radius_morgan, stored_bfp=stored_bfp,
+                                method=method)
+    return search_similar(con, bfp, threshold, fp, mol_field, table, limit, radius_morgan, stored_bfp, method)
+
+
+def search_db(con, bfp, fp, mol_field, table, threshold=None, limit=None, radius_morgan=2, method='rdtree'):
+    # find_similar called by a worker which keeps DB open (see shards.ShardPool)
+    stored_bfp = has_stored_bfp(con, table, fp, radius_morgan)
+    return find_similar(con, bfp, fp, mol_field, table, threshold, limit, radius_morgan, stored_bfp, method)
+
+
+def find_similar_in_shards(shards, bfp, fp, mol_field, table, threshold=None, limit=None, radius_morgan=2,
+                           method='rdtree'):
+    # every shard is searched by its own process, the global top is merged from tops of shards
+    res = shards.map(profiled(search_db), bfp, fp, mol_field, table, threshold, limit, radius_morgan, method)
+    res = merge_hits([collect(items) for items in res], limit)
+    if threshold is None and limit is None:
+        # all compounds above the default threshold or the most similar one (see top_k_similarity)
+        return [items for items in res if items[2] >= 0.7] or res[:1]
+    return res
+
+
+def query_bfp(con, smi, fp, radius_morgan=2):
+    # fingerprint of a query SMILES or None if SMILES cannot be parsed
+    return con.execute(f"SELECT {compose_bfp_function(fp, 'mol_from_smiles(?1)', radius_morgan)}", (smi, )).fetchone()[0]
+
+
+def has_stored_bfp(con, table, fp, radius_morgan=2):
+    return has_table(con, compose_bfp_table_name(main_table_name=table, fp=fp, radius_morgan=radius_morgan))
+
+
+def warm_up_db(con, table, fp, radius_morgan=2, method='rdtree'):
+    # only fingerprints used by the search method are loaded, compounds are read from disk when they are found
+    stored_bfp = has_stored_bfp(con, table, fp, radius_morgan)
+    names = [] if method == 'popcount' else [compose_index_table_name(table, fp, radius_morgan)]
+    if stored_bfp:
+        names.append(compose_bfp_table_name(table, fp, radius_morgan))
+    warm_up(con, names)
+
+
 def read_smi(fname):
+    # yields (smi, id) lazily, empty lines are skipped
     with open(fname) as f:
         for line in f:
             items = line.strip().split()
+            if not items:
+                continue
             mol_id = items[1] if len(items) > 1 else items[0]
             yield items[0], mol_id
 
@@ -38,7 +233,8 @@ def main():
     parser = argparse.ArgumentParser(description='Similarity search using the selected fingerprints, '
                                                  'which should be previously added to DB.')
     parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
-                        help='input SQLite DB.')
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py). Shards are searched '
+                             'in parallel by one process per shard.')
     parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
                         help='output text file. If omitted output will be printed to STDOUT.')
     parser.add_argument('-q', '--query', metavar='STRING or FNAME', required=True,
@@ -53,69 +249,121 @@ def main():
     parser.add_argument('-r', '--radius_morgan', metavar='INTEGER', default=2, type=int,
                         help='radius of Morgan fingerprint. Default: 2.')
     parser.add_argument('-p', '--threshold', metavar='NUMERIC', default=None, type=float,
-                        help='Tanimoto similarity threshold. If omitted then top similar compounds will be returned. '
-                             'Default: None.')
+                        help='Tanimoto similarity threshold. If omitted then top similar compounds will be returned: '
+                             'the number of compounds specified in the limit argument or, if the limit is omitted, '
+                             'all compounds with similarity 0.7 and higher or the most similar one if there are no '
+                             'such compounds. Default: None.')
     parser.add_argument('-l', '--limit', metavar='INTEGER', default=None, type=int,
                         help='maximum number of matches to retrieve. Default: None.')
+    parser.add_argument('--method', metavar='STRING', default='rdtree', choices=['rdtree', 'popcount'],
+                        help='how candidates are selected: rdtree - the fingerprint index, popcount - stored '
+                             'fingerprints with popcounts which can reach the threshold, top similar compounds are '
+                             'searched in popcount buckets in the order of decreasing similarity bound. popcount '
+                             'requires fingerprints stored by add_fp_to_db.py with --store_bfp. Default: rdtree.')
+    parser.add_argument('--cache', metavar='FILENAME', default=None,
+                        help='SQLite file to cache search results. Repeated queries are answered from the cache '
+                             'until DB is changed. Default: None.')
+    parser.add_argument('--cache_size', metavar='INTEGER', default=256, type=int,
+                        help='maximum size of cached results in megabytes. Default: 256.')
+
+    parser.add_argument('-a', '--db_mode', metavar='STRING', default='immutable',
+                        choices=['immutable', 'memory', 'default'],
+                        help='how DB is accessed: immutable - read-only memory mapped access, pages are shared '
+                             'through OS page cache by all processes and consecutive runs, memory - in-memory copy '
+                             'of the whole DB, default - ordinary connection. Default: immutable.')
+    parser.add_argument('--warm_up', required=False, default=False, action='store_true',
+                        help='read the fingerprint index (and stored fingerprints) before the search, so the first '
+                             'queries are as fast as the following ones without loading the whole DB in memory.')
+
+    add_prep_arguments(parser)
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
+    setup_profiling(args)
 
-    con = sqlite3.connect(args.input_db)
-    # copy DB to memory
-    if psutil.virtual_memory().free > os.path.getsize(args.input_db) * 2:
-        dest = sqlite3.connect(':memory:')
-        con.backup(dest)
-        con.close()
-        con = dest
+    shards = None
+    if is_manifest(args.input_db):
+        # the first shard is used to prepare queries
+        with profiler.phase('connect'):
+            db_names = shard_db_names(args.input_db)
+            con = connect_db(db_names[0], mode=args.db_mode)
+            shards = ShardPool(db_names, args.db_mode)
+    else:
+        with profiler.phase('connect'):
+            con = connect_db(args.input_db, mode=args.db_mode)
+
+    if args.warm_up:
+        with profiler.phase('warm_up'):
+            if shards is not None:
+                shards.map(warm_up_db, args.table, args.fp, args.radius_morgan, args.method)
+            else:
+                warm_up_db(con, args.table, args.fp, args.radius_morgan, args.method)
 
+    cache = None
+    writer = None
+    prep_pool = None
+    rejects = None
     try:
-        con.enable_load_extension(True)
-        con.load_extension('chemicalite')
-        con.enable_load_extension(False)
 
-        sql = sql_for_similarity(args.fp, args.mol_field, args.table, args.limit, args.radius_morgan)
+        stored_bfp = has_stored_bfp(con, args.table, args.fp, args.radius_morgan)
 
-        if args.output is not None:
-            sys.stdout = open(args.output, 'wt')
+        writer = open_writer(args.output, SIMILARITY_COLUMNS, args.output_format, table=args.output_table)
 
-        if args.threshold is None:
-            threshold = 0.7
+        # queries of a file are prepared ahead by a separate process while the previous ones are searched
+        if os.path.isfile(args.query):
+            queries = read_smi(args.query)
+            prep_pool = open_prep_pool(args.prep_ncpu)
         else:
-            threshold = args.threshold
+            queries = [(args.query, args.query)]
+            prep_pool = open_prep_pool(0)
+        rejects = open(args.rejects, 'wt') if args.rejects is not None else None
 
-        sys.stdout.write('\t'.join(['query_smi', 'query_id', 'found_smi', 'found_id', 'similarity']) + '\n')
+        if args.cache is not None:
+            cache = QueryCache(args.cache, con, args.input_db, args.cache_size * 2 ** 20)
 
-        if os.path.isfile(args.query):
-            for smi, mol_id in read_smi(args.query):
-                stop = False
-                while not stop:
-                    res = con.execute(sql, (smi, threshold)).fetchall()
-                    res = [(smi, mol_id) + i for i in res]
-                    if res:
-                        sys.stdout.write('\n'.join(['\t'.join(map(str, i)) for i in res]) + '\n')
-                        sys.stdout.flush()
-                        stop = True
-                    else:
-                        if args.threshold is None:
-                            threshold -= 0.1
-                        else:
-                            stop = True
-        else:
-            stop = False
-            while not stop:
-                res = con.execute(sql, (args.query, args.threshold)).fetchall()
-                res = [(args.query, args.query) + i for i in res]
-                if res:
-                    sys.stdout.write('\n'.join(['\t'.join(map(str, i)) for i in res]) + '\n')
-                    sys.stdout.flush()
-                    stop = True
-                else:
-                    if args.threshold is None:
-                        threshold -= 0.1
+        batches = iter_prepared(queries, args.fp, args.radius_morgan, prep_pool, canonical=cache is not None,
+                                rejects=rejects)
+        for smi, mol_id, bfp, canon_smi in (query for batch in batches for query in batch):
+            profiler.count('queries')
+            key = ('similarity', args.table, args.mol_field, args.fp, args.radius_morgan, 2048,
+                   canon_smi if cache is not None else smi, args.threshold, args.limit)
+            res = None
+            if cache is not None:
+                with profiler.phase('cache'):
+                    res = cache.get(*key)
+            if res is None:
+                with profiler.phase('search'):
+                    if shards is not None:
+                        res = find_similar_in_shards(shards, bfp, args.fp, args.mol_field, args.table,
+                                                     args.threshold, args.limit, args.radius_morgan,
+                                                     method=args.method)
                     else:
-                        stop = True
+                        res = find_similar(con, bfp, args.fp, args.mol_field, args.table, args.threshold,
+                                           args.limit, args.radius_morgan, stored_bfp=stored_bfp, method=args.method)
+                if cache is not None:
+                    with profiler.phase('cache'):
+                        cache.put(res, *key)
+            elif cache is not None:
+                profiler.count('cache_hits')
+            profiler.record('hits_per_query', len(res))
+            with profiler.phase('output'):
+                writer.write_rows((smi, mol_id) + i for i in res)
+                # results of interactive queries are shown immediately
+                if args.output is None:
+                    writer.flush()
 
     finally:
+        if writer is not None:
+            writer.close()
+        if prep_pool is not None:
+            prep_pool.terminate()
+        if rejects is not None:
+            rejects.close()
+        if shards is not None:
+            shards.close()
+        if cache is not None:
+            cache.close()
         con.close()
 
 
@@ -0,0 +1,88 @@
+import sys
+from importlib.util import find_spec
+
+
+# columns of structure keys: canon_smi - canonical SMILES generated by Chemicalite,
+# inchikey - InChIKey generated by RDKit from the canonical SMILES
+STRUCTURE_KEYS = ['canon_smi', 'inchikey']
+
+
+def inchikey(smi):
+    # RDKit is imported only when InChIKeys are requested
+    if smi is None:
+        return None
+    from rdkit import Chem
+    mol = Chem.MolFromSmiles(smi)
+    if mol is None:
+        return None
+    return Chem.MolToInchiKey(mol) or None
+
+
+def register_key_functions(con):
+    con.create_function('inchikey', 1, inchikey, deterministic=True)
+
+
+def sql_for_key(key, mol):
+    # SQL expression of a structure key of the given Mol expression
+    if key == 'canon_smi':
+        return f'mol_to_smiles({mol})'
+    if key == 'inchikey':
+        return f'inchikey(mol_to_smiles({mol}))'
+    raise ValueError(f'Unknown structure key: {key}')
+
+
+def create_key_columns(con, table, keys):
+    columns = [i[1] for i in con.execute(f"PRAGMA table_info({table})")]
+    for key in keys:
+        if key not in columns:
+            con.execute(f"ALTER TABLE {table} ADD COLUMN {key} TEXT")
+
+
+def create_key_indexes(con, table, keys):
+    for key in keys:
+        con.execute(f"CREATE INDEX IF NOT EXISTS {table}_{key}_idx ON {table}({key})")
+
+
+def find_duplicated_structures(con, table, key):
+    # records having the same structure key as a record with a lower rowid,
+    # returns (rowid, id, key, id of the first record) tuples
+    return con.execute(f"""SELECT main.rowid, main.id, main.{key}, first.id
+                           FROM {table} AS main,
+                                (SELECT {key} AS k, min(rowid) AS rid FROM {table}
+                                 WHERE {key} IS NOT NULL GROUP BY {key} HAVING count(*) > 1) AS dup,
+                                {table} AS first
+                           WHERE main.{key} = dup.k AND main.rowid != dup.rid AND first.rowid = dup.rid
+                           ORDER BY main.rowid""").fetchall()
+
+
+def dedup_structures(con, table, key, extra_tables, remove=False, report_fname=None):
+    # reports records with duplicated structures under different ids and removes them keeping the first one,
+    # extra_tables are tables of fingerprints referencing rowids of the main table
+    duplicates = find_duplicated_structures(con, table, key)
+    if report_fname is not None:
+        with open(report_fname, 'wt') as f:
+            f.write(f'id\t{key}\tkept_id\n')
+            for _, mol_id, k, first_id in duplicates:
+                f.write(f'{mol_id}\t{k}\t{first_id}\n')
+    if remove and duplicates:
+        rids = [(rid, ) for rid, *_ in duplicates]
+        for t in extra_tables:
+            con.executemany(f"DELETE FROM {t} WHERE id = ?", rids)
+        con.executemany(f"DELETE FROM {table} WHERE rowid = ?", rids)
+        con.commit()
+    return len(duplicates)
+
+
+def add_key_arguments(parser):
+    parser.add_argument('--canon_smi', required=False, default=False, action='store_true',
+                        help='store canonical SMILES in the indexed canon_smi column, it is used by exact_search.py '
+                             'and to find duplicated structures.')
+    parser.add_argument('--inchikey', required=False, default=False, action='store_true',
+                        help='store InChIKey in the indexed inchikey column (RDKit Python package is required).')
+
+
+def selected_keys(args):
+    keys = [key for key in STRUCTURE_KEYS if getattr(args, key)]
+    if 'inchikey' in keys and find_spec('rdkit') is None:
+        sys.exit('RDKit Python package is required to compute InChIKeys.')
+    return keys
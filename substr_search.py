@@ -1,45 +1,227 @@
 #!/usr/bin/env python3
 
 import argparse
-import sqlite3
-import sys
+import json
+import os
+from functools import partial
+from itertools import chain, islice
+from multiprocessing import Pool, cpu_count
+
+from db_utils import connect_db
+from parallel_build import bounded_imap
+from profiling import profiler, profiled, collect, add_profile_arguments, setup_profiling
+from query_cache import QueryCache
+from result_writers import SUBSTRUCTURE_COLUMNS, open_writer, add_output_arguments
+from shards import is_manifest, shard_db_names, ShardPool
+from sim_search import read_smi
+
+
+_con = None
+
+
+def cpu_type(x):
+    return max(1, min(int(x), cpu_count()))
+
+
+def take(n, iterable):
+    return list(islice(iterable, n))
+
+
+def tally(items, counts, found=None):
+    # passes items through counting them in counts[0] and collecting them in found if it is given
+    for item in items:
+        counts[0] += 1
+        if found is not None:
+            found.append(item)
+        yield item
+
+
+def sql_for_substructure(table, mol_field):
+    # ?1 - query Mol, ?2 - pattern fingerprint of the query (see query_pattern)
+    sql = f"""SELECT main.smi, main.id FROM {table} AS main, {table}_pattern_idx AS idx WHERE
+              main.rowid = idx.id AND
+              idx.id MATCH rdtree_subset(?2) AND
+              mol_is_substruct(main.{mol_field}, ?1)"""
+    return sql
+
+
+def sql_for_screen(table):
+    # candidate rowids passed the pattern fingerprint screen, ?1 - pattern fingerprint of the query
+    return f"SELECT id FROM {table}_pattern_idx WHERE id MATCH rdtree_subset(?1)"
+
+
+def sql_for_check(table, mol_field):
+    # ?1 - query Mol, ?2 - JSON list of candidate rowids
+    sql = f"""SELECT main.smi, main.id FROM {table} AS main WHERE
+              main.rowid IN (SELECT value FROM json_each(?2)) AND
+              mol_is_substruct(main.{mol_field}, ?1)"""
+    return sql
+
+
+def query_pattern(con, smarts):
+    # query Mol and its pattern fingerprint or (None, None) if SMARTS cannot be parsed
+    return con.execute("SELECT mol_from_smarts(?1), mol_pattern_bfp(mol_from_smarts(?1), 2048)", (smarts, )).fetchone()
+
+
+def substructure_search(con, table, mol_field, qmol, qbfp, limit=None):
+    # yields hits as soon as they are found
+    sql = sql_for_substructure(table, mol_field)
+    profiler.explain(con, sql, (qmol, qbfp))
+    profiler.watch(con)
+    cur = con.execute(sql, (qmol, qbfp))
+    yield from islice(cur, limit)
+
+
+def find_substructures(con, table, mol_field, qmol, qbfp, limit=None):
+    # substructure_search called by a worker which keeps DB open (see shards.ShardPool)
+    return list(substructure_search(con, table, mol_field, qmol, qbfp, limit=limit))
+
+
+def init_worker(db_name, db_mode):
+    global _con
+    _con = connect_db(db_name, mode=db_mode)
+
+
+def check_candidates(rowids, table, mol_field, qmol):
+    profiler.count('candidates', len(rowids))
+    return profiler.fetchall(_con, sql_for_check(table, mol_field), (qmol, json.dumps(rowids)))
+
+
+def parallel_substructure_search(pool, con, table, mol_field, qmol, qbfp, limit=None, batch_size=1000,
+                                 max_pending=2):
+    # candidates of the fingerprint screen are verified by workers of the pool,
+    # yields hits as soon as they are found and stops once the limit is reached.
+    # Candidate rowids are read lazily by the calling thread (see bounded_imap), so the screen runs ahead of
+    # verification by at most max_pending batches and is not continued after the limit is reached
+    if limit is not None and limit <= 0:
+        return
+    profiler.explain(con, sql_for_screen(table), (qbfp, ))
+    cur = con.execute(sql_for_screen(table), (qbfp, ))
+    batches = ([rowid for rowid, in rows] for rows in iter(partial(cur.fetchmany, batch_size), []))
+    n = 0
+    for res in bounded_imap(pool, profiled(partial(check_candidates, table=table, mol_field=mol_field, qmol=qmol)),
+                            batches, max_pending, unordered=True):
+        for items in collect(res):
+            yield items
+            n += 1
+            if limit is not None and n >= limit:
+                return
 
 
 def main():
     parser = argparse.ArgumentParser(description='Substructure search using pattern fingerprints, '
                                                  'which should be previously added to DB.')
     parser.add_argument('-d', '--input_db', metavar='FILENAME', required=True,
-                        help='input SQLite DB.')
+                        help='input SQLite DB or a manifest of shard DBs (see create_db.py). Shards are searched '
+                             'in parallel by one process per shard, --ncpu is ignored.')
     parser.add_argument('-o', '--output', metavar='FILENAME', required=False, default=None,
                         help='output text file. If omitted output will be printed to STDOUT.')
-    parser.add_argument('-q', '--query', metavar='STRING', required=True,
-                        help='reference SMILES.')
+    parser.add_argument('-q', '--query', metavar='STRING or FNAME', required=True,
+                        help='reference SMARTS or a file with SMARTS and optional ids. For a single query found '
+                             'smiles and ids are returned, for a file output will additionally contain query '
+                             'SMARTS and ids and a header.')
     parser.add_argument('-t', '--table', metavar='STRING', default='mols',
                         help='table name where Mol objects are stored. Default: mols.')
     parser.add_argument('-m', '--mol_field', metavar='STRING', default='mol',
                         help='field name where mol objects are stored. Default: mol.')
     parser.add_argument('-l', '--limit', metavar='INTEGER', default=None, type=int,
-                        help='maximum number of matches to retrieve. Default: None.')
+                        help='maximum number of matches to retrieve for every query. Matches are returned in the '
+                             'order they are found, so with several cpus or shards the order and the matches kept '
+                             'by the limit can differ between runs, without the limit the same matches are '
+                             'returned. Default: None.')
+    parser.add_argument('-c', '--ncpu', default=1, type=cpu_type,
+                        help='number of cpus used to verify candidates of the fingerprint screen. Default: 1.')
+    parser.add_argument('-b', '--batch_size', metavar='INTEGER', default=1000, type=int,
+                        help='number of candidates sent to a worker at once. Default: 1000.')
+    parser.add_argument('-a', '--db_mode', metavar='STRING', default='immutable',
+                        choices=['immutable', 'memory', 'default'],
+                        help='how DB is accessed: immutable - read-only memory mapped access, memory - in-memory '
+                             'copy of DB, default - ordinary connection. Default: immutable.')
+    parser.add_argument('--cache', metavar='FILENAME', default=None,
+                        help='SQLite file to cache search results. Repeated queries are answered from the cache '
+                             'until DB is changed. Default: None.')
+    parser.add_argument('--cache_size', metavar='INTEGER', default=256, type=int,
+                        help='maximum size of cached results in megabytes. Default: 256.')
+
+    add_output_arguments(parser)
+    add_profile_arguments(parser)
 
     args = parser.parse_args()
-    with sqlite3.connect(args.input_db) as con:
-
-        con.enable_load_extension(True)
-        con.load_extension('chemicalite')
-        con.enable_load_extension(False)
-
-        sql = f"""SELECT {args.table}.smi, {args.table}.id FROM {args.table}, {args.table}_pattern_idx AS idx WHERE
-                  {args.table}.rowid = idx.id AND
-                  mol_is_substruct({args.table}.{args.mol_field}, mol_from_smarts(?1)) AND
-                  idx.id MATCH rdtree_subset(mol_pattern_bfp(mol_from_smarts(?1), 2048)) 
-                  {'LIMIT ' + str(args.limit) if args.limit is not None else ''} 
-                  ORDER BY {args.table}.id"""
-        res = con.execute(sql, (args.query, )).fetchall()
-
-        if args.output is not None:
-            sys.stdout = open(args.output, 'wt')
-        for smi, i in res:
-            print(f'{smi}\t{i}')
+    setup_profiling(args)
+
+    if os.path.isfile(args.query):
+        queries = read_smi(args.query)
+        header = True
+    else:
+        queries = [(args.query, args.query)]
+        header = False
+
+    pool = None
+    shards = None
+    with profiler.phase('connect'):
+        if is_manifest(args.input_db):
+            # the first shard is used to prepare queries
+            db_names = shard_db_names(args.input_db)
+            con = connect_db(db_names[0], mode=args.db_mode)
+            shards = ShardPool(db_names, args.db_mode)
+        else:
+            con = connect_db(args.input_db, mode=args.db_mode)
+            if args.ncpu > 1:
+                pool = Pool(args.ncpu, initializer=init_worker, initargs=(args.input_db, args.db_mode))
+    # output of a single query contains only found compounds
+    writer = open_writer(args.output, SUBSTRUCTURE_COLUMNS if header else SUBSTRUCTURE_COLUMNS[2:],
+                         args.output_format, header=header, table=args.output_table)
+    cache = QueryCache(args.cache, con, args.input_db, args.cache_size * 2 ** 20) if args.cache is not None else None
+
+    try:
+        for smarts, query_id in queries:
+            profiler.count('queries')
+            key = ('substructure', args.table, args.mol_field, smarts, args.limit)
+            cached = cache.get(*key) if cache is not None else None
+            if cached is not None:
+                profiler.count('cache_hits')
+                hits = cached
+            else:
+                with profiler.phase('query_prep'):
+                    qmol, qbfp = query_pattern(con, smarts)
+                if qmol is None:
+                    profiler.count('invalid_queries')
+                    continue
+                if shards is not None:
+                    res = shards.map(profiled(find_substructures), args.table, args.mol_field, qmol, qbfp,
+                                     limit=args.limit)
+                    # hits of shards follow each other, so the limit keeps any matches as for a single DB
+                    hits = islice(chain.from_iterable(map(collect, res)), args.limit)
+                elif pool is not None:
+                    hits = parallel_substructure_search(pool, con, args.table, args.mol_field, qmol, qbfp,
+                                                        limit=args.limit, batch_size=args.batch_size,
+                                                        max_pending=2 * args.ncpu)
+                else:
+                    hits = substructure_search(con, args.table, args.mol_field, qmol, qbfp, limit=args.limit)
+            # hits are written as they are found, search and output are not separated
+            counts = [0]
+            found = [] if cache is not None and cached is None else None
+            hits = tally(hits, counts, found)
+            with profiler.phase('search'):
+                if header:
+                    writer.write_rows((smarts, query_id) + hit for hit in hits)
+                else:
+                    writer.write_rows(hits)
+                if args.output is None:
+                    writer.flush()
+            profiler.record('hits_per_query', counts[0])
+            if found is not None:
+                cache.put(found, *key)
+
+    finally:
+        if pool is not None:
+            pool.terminate()
+        if shards is not None:
+            shards.close()
+        if cache is not None:
+            cache.close()
+        writer.close()
+        con.close()
 
 
 if __name__ == '__main__':
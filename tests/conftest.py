@@ -0,0 +1,65 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db_utils import load_chemicalite
+
+
+def chemicalite_available():
+    # Python may be built without loadable extensions or Chemicalite may be missing
+    try:
+        con = sqlite3.connect(':memory:')
+        load_chemicalite(con)
+    except (AttributeError, sqlite3.OperationalError):
+        return False
+    con.close()
+    return True
+
+
+@pytest.fixture(scope='session')
+def chemicalite():
+    if not chemicalite_available():
+        pytest.skip('Chemicalite extension cannot be loaded')
+
+
+@pytest.fixture
+def run_script(monkeypatch):
+    # runs main() of a script with the given command line arguments
+    def run(module, *args):
+        monkeypatch.setattr(sys, 'argv', [module.__name__ + '.py'] + [str(i) for i in args])
+        module.main()
+    return run
+
+
+@pytest.fixture
+def random_fps():
+    # packed 2048-bit fingerprints of n compounds derived from a few random centers by flipping bits,
+    # so similarities cover the whole range including duplicates
+    np = pytest.importorskip('numpy')
+    # centers are the same for all seeds, so different sets contain similar compounds
+    centers = np.random.default_rng(0).random((5, 2048)) < 0.05
+
+    def generate(n, seed=0):
+        rng = np.random.default_rng(seed)
+        bits = centers[rng.integers(len(centers), size=n)] ^ (rng.random((n, 2048)) < rng.random((n, 1)) * 0.1)
+        bits[::17] = centers[0]
+        return np.packbits(bits, axis=1, bitorder='little').view(np.uint64)
+    return generate
+
+
+@pytest.fixture
+def brute_force_tanimoto():
+    # (n, m) matrix of Tanimoto coefficients of packed fingerprints computed from unpacked bits
+    np = pytest.importorskip('numpy')
+
+    def tanimoto(a, b):
+        a = np.unpackbits(a.view(np.uint8), axis=1).astype(np.int64)
+        b = np.unpackbits(b.view(np.uint8), axis=1).astype(np.int64)
+        common = a @ b.T
+        union = a.sum(axis=1)[:, None] + b.sum(axis=1)[None, :] - common
+        return np.where(union > 0, common / np.maximum(union, 1), 0.0)
+    return tanimoto
@@ -0,0 +1,24 @@
+import pytest
+
+import benchmark
+
+
+def test_generate_smiles_is_deterministic():
+    assert list(benchmark.generate_smiles(100, seed=1)) == list(benchmark.generate_smiles(100, seed=1))
+    assert list(benchmark.generate_smiles(100, seed=1)) != list(benchmark.generate_smiles(100, seed=2))
+    assert [mol_id for _, mol_id in benchmark.generate_smiles(3)] == ['syn0', 'syn1', 'syn2']
+
+
+def test_generated_smiles_are_valid():
+    Chem = pytest.importorskip('rdkit.Chem')
+    invalid = [smi for smi, _ in benchmark.generate_smiles(2000) if Chem.MolFromSmiles(smi) is None]
+    assert invalid == []
+
+
+@pytest.mark.parametrize('fragments', [benchmark.LEADING_TERMINALS, benchmark.RINGS, benchmark.LINKERS])
+def test_fragments_can_be_joined(fragments):
+    # every fragment is joined to a ring by its last atom and rings are joined by their first atom
+    Chem = pytest.importorskip('rdkit.Chem')
+    for fragment in fragments:
+        for ring in benchmark.RINGS:
+            assert Chem.MolFromSmiles(fragment + ring) is not None, fragment + ring
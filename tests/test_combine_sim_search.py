@@ -0,0 +1,59 @@
+import pytest
+
+from combine_sim_search import FusedScores
+
+
+def fill(scores):
+    # found (smi, id, similarity) of queries 0 and 2, query 1 is invalid
+    scores.update(0, 'q0', 'Q0', [('CCO', 'a', 0.8), ('CCN', 'b', 0.9), ('CCC', 'c', 0.3)])
+    scores.reject(1)
+    scores.update(2, 'q2', 'Q2', [('CCO', 'a', 0.95), ('CCCl', 'd', 0.5)])
+
+
+def test_max_fusion():
+    scores = FusedScores('max', 3)
+    fill(scores)
+    assert len(scores) == 4
+    assert scores.top(3) == [('q2', 'Q2', 'CCO', 'a', 0.95), ('q0', 'Q0', 'CCN', 'b', 0.9),
+                             ('q2', 'Q2', 'CCCl', 'd', 0.5)]
+    assert scores.top(10)[-1] == ('q0', 'Q0', 'CCC', 'c', 0.3)
+
+
+def test_mean_fusion_missing():
+    scores = FusedScores('mean', 3)
+    fill(scores)
+    # the invalid query is skipped
+    missing = scores.missing()
+    assert sorted(missing) == [0, 2]
+    assert missing[0] == ['d']
+    assert sorted(missing[2]) == ['b', 'c']
+
+
+def test_mean_fusion():
+    scores = FusedScores('mean', 3)
+    fill(scores)
+    scores.update(0, 'q0', 'Q0', [('CCCl', 'd', 0.2)])
+    scores.update(2, 'q2', 'Q2', [('CCN', 'b', 0.7), ('CCC', 'c', 0.3)])
+    assert not scores.missing()
+    # means over the two valid queries, the best query is reported
+    top = scores.top(10)
+    assert [row[:4] for row in top] == [('q2', 'Q2', 'CCO', 'a'), ('q0', 'Q0', 'CCN', 'b'),
+                                        ('q2', 'Q2', 'CCCl', 'd'), ('q0', 'Q0', 'CCC', 'c')]
+    assert [row[4] for row in top] == pytest.approx([0.875, 0.8, 0.35, 0.3])
+
+
+def test_mean_fusion_counts_missing_similarities():
+    # similarities which could not be computed (e.g. molecules without Mol objects) count as 0
+    scores = FusedScores('mean', 3)
+    fill(scores)
+    top = scores.top(2)
+    assert [row[2] for row in top] == ['CCO', 'CCN']
+    assert [row[4] for row in top] == pytest.approx([0.875, 0.45])
+
+
+def test_all_queries_invalid():
+    scores = FusedScores('mean', 2)
+    scores.reject(0)
+    scores.reject(1)
+    assert scores.missing() == {}
+    assert scores.top(5) == []
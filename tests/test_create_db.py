@@ -0,0 +1,104 @@
+import sqlite3
+
+import pytest
+
+import create_db
+
+
+def create_table(con, sdf, mol_field, keys):
+    columns = ['id TEXT', 'smi TEXT'] + (['molblock TEXT'] if sdf else []) + \
+              ([f'{mol_field} BLOB'] if mol_field else []) + [f'{key} TEXT' for key in keys]
+    con.execute(f"CREATE TABLE mols ({', '.join(columns)})")
+
+
+def prepared_record(i, nfps, keys):
+    # (smi, id, molblock, mol, fp1, ..., fpN, key1, ...) as returned by prepare_records
+    return (f'smi{i}', f'id{i}', f'block{i}', f'mol{i}'.encode()) + \
+        tuple(f'fp{i}_{j}'.encode() for j in range(nfps)) + tuple(f'{key}{i}' for key in keys)
+
+
+@pytest.mark.parametrize('sdf', [False, True])
+@pytest.mark.parametrize('nfps', [0, 3])
+@pytest.mark.parametrize('keys', [(), ('canon_smi', ), ('canon_smi', 'inchikey')])
+def test_insert_prepared_records(sdf, nfps, keys):
+    con = sqlite3.connect(':memory:')
+    create_table(con, sdf, 'mol', keys)
+    fp_tables = [f'fp{j}' for j in range(nfps)]
+    for t in fp_tables:
+        con.execute(f"CREATE TABLE {t} (id INTEGER PRIMARY KEY, fp BLOB)")
+    insert_sql, nparams = create_db.compose_insert('mols', sdf, 'mol', nfps, keys)
+    fp_sqls = [(f"INSERT INTO {t}(id, fp) VALUES (?, ?)", j) for j, t in enumerate(fp_tables)]
+    create_db.insert_batch(con, [prepared_record(i, nfps, keys) for i in range(3)], insert_sql, nparams, fp_sqls)
+
+    columns = ['smi', 'id'] + (['molblock'] if sdf else []) + ['mol'] + list(keys)
+    rows = con.execute(f"SELECT rowid, {', '.join(columns)} FROM mols ORDER BY rowid").fetchall()
+    assert [row[1:] for row in rows] == \
+        [(f'smi{i}', f'id{i}') + ((f'block{i}', ) if sdf else ()) + (f'mol{i}'.encode(), ) +
+         tuple(f'{key}{i}' for key in keys) for i in range(3)]
+    for j, t in enumerate(fp_tables):
+        assert con.execute(f"SELECT id, fp FROM {t} ORDER BY id").fetchall() == \
+            [(rowid, f'fp{i}_{j}'.encode()) for i, (rowid, *_) in enumerate(rows)]
+
+
+def test_insert_plain_records():
+    con = sqlite3.connect(':memory:')
+    create_table(con, False, None, ())
+    insert_sql, nparams = create_db.compose_insert('mols', False)
+    create_db.insert_batch(con, [(f'smi{i}', f'id{i}', None) for i in range(3)], insert_sql, nparams, [])
+    assert con.execute("SELECT * FROM mols ORDER BY rowid").fetchall() == [(f'id{i}', f'smi{i}') for i in range(3)]
+
+
+def test_insert_ignores_repeated_ids():
+    con = sqlite3.connect(':memory:')
+    con.execute("CREATE TABLE mols (id TEXT UNIQUE, smi TEXT)")
+    insert_sql, nparams = create_db.compose_insert('mols', False)
+    create_db.insert_batch(con, [('C', 'a', None), ('CC', 'a', None), ('CCC', 'b', None)], insert_sql, nparams, [])
+    assert con.execute("SELECT id, smi FROM mols ORDER BY rowid").fetchall() == [('a', 'C'), ('b', 'CCC')]
+
+
+def test_read_sdf_records():
+    sdf = 'first\n  RDKit\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n> <name>\nA1\n\n$$$$\n' \
+          'second\n  RDKit\n\n  0  0  0  0  0  0  0  0  0  0999 V2000\nM  END\n$$$$\n'
+    records = list(create_db.read_sdf_records(sdf.splitlines(keepends=True), id_field='name'))
+    assert [mol_id for _, mol_id, _ in records] == ['A1', 'second']
+    assert all(molblock.rstrip().endswith('M  END') for _, _, molblock in records)
+
+
+def test_create_db_dedup_remove(tmp_path, chemicalite, run_script):
+    # C(C)O and OCC are the same structure under different ids
+    smi = tmp_path / 'input.smi'
+    smi.write_text('CCO a\nc1ccccc1 b\nOCC c\nC(C)O d\nCCN e\n')
+    db = tmp_path / 'out.db'
+    report = tmp_path / 'dedup.txt'
+    run_script(create_db, '-i', smi, '-o', db, '-m', 'mol', '-f', 'morgan', '--store_bfp',
+               '--dedup_structures', 'canon_smi', '--dedup_mode', 'remove', '--dedup_report', report)
+    con = sqlite3.connect(db)
+    assert [i for i, in con.execute("SELECT id FROM mols ORDER BY rowid")] == ['a', 'b', 'e']
+    rowids = [i for i, in con.execute("SELECT rowid FROM mols ORDER BY rowid")]
+    assert [i for i, in con.execute("SELECT id FROM mols_morgan2_bfp ORDER BY id")] == rowids
+    assert [line.split('\t')[0] for line in report.read_text().splitlines()[1:]] == ['c', 'd']
+
+
+ETHANOL = """ethanol
+     RDKit          2D
+
+  3  2  0  0  0  0  0  0  0  0999 V2000
+    0.0000    0.0000    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    1.2990    0.7500    0.0000 C   0  0  0  0  0  0  0  0  0  0  0  0
+    2.5981   -0.0000    0.0000 O   0  0  0  0  0  0  0  0  0  0  0  0
+  1  2  1  0
+  2  3  1  0
+M  END
+$$$$
+"""
+
+
+@pytest.mark.parametrize('mol_field', [None, 'mol'])
+def test_create_db_sdf_smiles(tmp_path, chemicalite, run_script, mol_field):
+    # SMILES are generated from molblocks with and without Mol objects
+    sdf = tmp_path / 'input.sdf'
+    sdf.write_text(ETHANOL)
+    db = tmp_path / 'out.db'
+    run_script(create_db, '-i', sdf, '-o', db, *(['-m', mol_field] if mol_field else []))
+    con = sqlite3.connect(db)
+    assert con.execute("SELECT id, smi FROM mols").fetchall() == [('ethanol', 'CCO')]
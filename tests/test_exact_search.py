@@ -0,0 +1,49 @@
+import sqlite3
+
+import pytest
+
+import create_db
+import exact_search
+
+
+@pytest.fixture
+def con():
+    con = sqlite3.connect(':memory:')
+    con.execute("CREATE TABLE mols (id TEXT, smi TEXT, canon_smi TEXT)")
+    con.execute("CREATE INDEX mols_canon_smi_idx ON mols(canon_smi)")
+    con.executemany("INSERT INTO mols (id, smi, canon_smi) VALUES (?, ?, ?)",
+                    [('a', 'OCC', 'CCO'), ('b', 'NC', 'CN'), ('c', 'C(C)O', 'CCO')])
+    return con
+
+
+def test_find_exact(con):
+    # the second query is invalid, the third one is not found
+    rows = exact_search.find_exact(con, 'mols', 'canon_smi', ['CCO', None, 'CCC', 'CN'])
+    assert sorted(rows) == [(0, 'C(C)O', 'c'), (0, 'OCC', 'a'), (3, 'NC', 'b')]
+
+
+def test_find_exact_uses_key_index(con):
+    plan = ' '.join(row[-1] for row in con.execute(f"EXPLAIN QUERY PLAN {exact_search.sql_for_exact('mols', 'canon_smi')}",
+                                                   ('[]', )))
+    assert 'mols_canon_smi_idx' in plan
+
+
+def test_has_key_column(con):
+    assert exact_search.has_key_column(con, 'mols', 'canon_smi')
+    assert not exact_search.has_key_column(con, 'mols', 'inchikey')
+
+
+def test_exact_search(tmp_path, chemicalite, run_script):
+    lib = tmp_path / 'lib.smi'
+    lib.write_text('CCO a\nc1ccccc1 b\nOCC c\nCCN d\n')
+    db = tmp_path / 'lib.db'
+    run_script(create_db, '-i', lib, '-o', db, '-m', 'mol', '--canon_smi')
+    queries = tmp_path / 'queries.smi'
+    queries.write_text('C(C)O q1\nXYZ q2\nCCCC q3\nNCC q4\n')
+    output = tmp_path / 'output.txt'
+    not_found = tmp_path / 'not_found.txt'
+    run_script(exact_search, '-d', db, '-q', queries, '-o', output, '-b', 3, '--not_found', not_found)
+    rows = [line.split('\t') for line in output.read_text().splitlines()]
+    assert rows[0] == ['query_smi', 'query_id', 'found_smi', 'found_id']
+    assert sorted((row[1], row[3]) for row in rows[1:]) == [('q1', 'a'), ('q1', 'c'), ('q4', 'd')]
+    assert not_found.read_text() == 'XYZ\tq2\nCCCC\tq3\n'
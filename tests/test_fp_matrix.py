@@ -0,0 +1,100 @@
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import fp_matrix
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # several blocks of library and query fingerprints are compared even for small test sets
+    monkeypatch.setattr(fp_matrix, 'LIB_BLOCK', 64)
+    monkeypatch.setattr(fp_matrix, 'QUERY_BLOCK', 8)
+
+
+@pytest.fixture
+def library(tmp_path, random_fps):
+    # matrix exported from DB with stored fingerprints (Chemicalite is not used to read them)
+    fps = random_fps(300, seed=1)
+    db = tmp_path / 'lib.db'
+    con = sqlite3.connect(db)
+    con.execute("CREATE TABLE mols (smi TEXT, id TEXT)")
+    con.execute("CREATE TABLE mols_morgan2_bfp (id INTEGER PRIMARY KEY, fp BLOB, popcnt INTEGER)")
+    for i, row in enumerate(fps):
+        con.execute("INSERT INTO mols (rowid, smi, id) VALUES (?, ?, ?)", (i + 1, f'smi{i}', f'id{i}'))
+        con.execute("INSERT INTO mols_morgan2_bfp (id, fp) VALUES (?, ?)", (i + 1, row.tobytes()))
+    con.commit()
+    prefix = str(tmp_path / 'lib_morgan2')
+    assert fp_matrix.export_matrix(con, prefix, 'mols', 'mol', 'morgan', 2, chunk_size=70) == len(fps)
+    con.close()
+    return prefix, fps
+
+
+@pytest.fixture
+def queries(random_fps):
+    fps = random_fps(20, seed=2)
+    return fps, fp_matrix.popcount(fps)
+
+
+def test_popcount_and_tanimoto(random_fps, brute_force_tanimoto):
+    a, b = random_fps(10, seed=3), random_fps(50, seed=4)
+    assert fp_matrix.popcount(a).tolist() == np.unpackbits(a.view(np.uint8), axis=1).sum(axis=1).tolist()
+    sim = fp_matrix.tanimoto(a, fp_matrix.popcount(a), b, fp_matrix.popcount(b))
+    assert np.allclose(sim, brute_force_tanimoto(a, b))
+
+
+def test_export_matrix(library):
+    prefix, fps = library
+    assert np.array_equal(np.load(prefix + '.npy'), fps)
+    assert np.array_equal(np.load(prefix + '.cnt.npy'), fp_matrix.popcount(fps))
+    assert fp_matrix.load_labels(prefix) == [(f'smi{i}', f'id{i}') for i in range(len(fps))]
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+@pytest.mark.parametrize('threshold', [0.0, 0.3, 0.7])
+def test_threshold_search(library, queries, brute_force_tanimoto, ncpu, threshold):
+    prefix, fps = library
+    expected = brute_force_tanimoto(queries[0], fps)
+    qi, li, s = fp_matrix.run_search(prefix, *queries, threshold, None, ncpu=ncpu)
+    q, l = np.nonzero(expected >= threshold)
+    assert sorted(zip(qi.tolist(), li.tolist())) == sorted(zip(q.tolist(), l.tolist()))
+    assert np.allclose(s, expected[qi, li])
+    # hits of every query are sorted by decreasing similarity
+    assert all((np.diff(s[qi == i]) <= 0).all() for i in range(len(queries[0])))
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+@pytest.mark.parametrize('limit', [1, 10, 100])
+def test_top_k_search(library, queries, brute_force_tanimoto, ncpu, limit):
+    prefix, fps = library
+    expected = brute_force_tanimoto(queries[0], fps)
+    qi, li, s = fp_matrix.run_search(prefix, *queries, None, limit, ncpu=ncpu)
+    for i in range(len(queries[0])):
+        assert np.allclose(s[qi == i], np.sort(expected[i])[::-1][:limit])
+        assert np.allclose(s[qi == i], expected[i, li[qi == i]])
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+def test_top_k_search_above_threshold(library, queries, brute_force_tanimoto, ncpu):
+    prefix, fps = library
+    expected = brute_force_tanimoto(queries[0], fps)
+    qi, li, s = fp_matrix.run_search(prefix, *queries, 0.5, 10, ncpu=ncpu)
+    for i in range(len(queries[0])):
+        top = np.sort(expected[i])[::-1][:10]
+        assert np.allclose(s[qi == i], top[top >= 0.5])
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+@pytest.mark.parametrize('threshold', [None, 0.6])
+def test_combined_search(library, queries, brute_force_tanimoto, ncpu, threshold):
+    prefix, fps = library
+    best = brute_force_tanimoto(queries[0], fps).max(axis=0)
+    qi, li, s = fp_matrix.run_search(prefix, *queries, threshold, 25, combine=True, ncpu=ncpu)
+    top = np.sort(best)[::-1][:25]
+    if threshold is not None:
+        top = top[top >= threshold]
+    assert np.allclose(s, top)
+    assert len(set(li.tolist())) == len(li)
+    assert np.allclose(s, brute_force_tanimoto(queries[0][qi], fps)[np.arange(len(qi)), li])
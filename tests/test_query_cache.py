@@ -0,0 +1,63 @@
+import json
+import sqlite3
+
+from db_utils import bump_generation
+from query_cache import QueryCache
+
+
+def create_db(fname):
+    con = sqlite3.connect(fname)
+    con.execute("CREATE TABLE mols (id TEXT, smi TEXT)")
+    con.commit()
+    return con
+
+
+def total_size(cache):
+    return cache.con.execute("SELECT total_size FROM cache_meta").fetchone()[0]
+
+
+def test_dbs_share_cache(tmp_path):
+    cache_fname = tmp_path / 'results.cache'
+    con1, con2 = create_db(tmp_path / 'a.db'), create_db(tmp_path / 'b.db')
+    cache = QueryCache(cache_fname, con1, str(tmp_path / 'a.db'))
+    cache.put([('CCO', 'a', 1.0)], 'q')
+    cache.close()
+    cache = QueryCache(cache_fname, con2, str(tmp_path / 'b.db'))
+    assert cache.get('q') is None
+    cache.put([('CCN', 'b', 0.5)], 'q')
+    cache.close()
+    cache = QueryCache(cache_fname, con1, str(tmp_path / 'a.db'))
+    assert cache.get('q') == [('CCO', 'a', 1.0)]
+    cache.close()
+
+
+def test_changed_db_results_are_purged(tmp_path):
+    cache_fname = tmp_path / 'results.cache'
+    db1, db2 = str(tmp_path / 'a.db'), str(tmp_path / 'b.db')
+    con1, con2 = create_db(db1), create_db(db2)
+    for con, db_name in ((con1, db1), (con2, db2)):
+        cache = QueryCache(cache_fname, con, db_name)
+        cache.put([1], 'q')
+        cache.close()
+    bump_generation(con1)
+    con1.commit()
+    cache = QueryCache(cache_fname, con1, db1)
+    assert cache.get('q') is None
+    assert cache.con.execute("SELECT db_path FROM results").fetchall() == [(db2, )]
+    cache.close()
+
+
+def test_total_size_and_eviction(tmp_path):
+    con = create_db(tmp_path / 'a.db')
+    cache = QueryCache(tmp_path / 'results.cache', con, str(tmp_path / 'a.db'), max_size=100)
+    cache.put(['x' * 10], 1)
+    cache.put(['x' * 20], 2)
+    cache.put(['x' * 30], 1)
+    assert total_size(cache) == cache.con.execute("SELECT sum(size) FROM results").fetchone()[0] == \
+        len(json.dumps(['x' * 30])) + len(json.dumps(['x' * 20]))
+    cache.put(['x' * 50], 3)
+    # the least recently used result is evicted
+    assert cache.get(2) is None
+    assert cache.get(1) is not None and cache.get(3) is not None
+    assert total_size(cache) == cache.con.execute("SELECT sum(size) FROM results").fetchone()[0] <= 100
+    cache.close()
@@ -0,0 +1,42 @@
+import pytest
+
+import query_prep
+from profiling import profiler
+
+
+@pytest.fixture
+def prep(chemicalite, monkeypatch):
+    monkeypatch.setattr(query_prep, '_memo', query_prep.OrderedDict())
+    query_prep.open_prep_pool(0)
+    profiler.enable()
+    yield
+    profiler.enabled = False
+
+
+def test_prepare_queries(prep):
+    prepared, rejected = query_prep.prepare_queries([('CCO', 'a'), ('C1CC', 'b'), ('CCN', 'c')], 'morgan', 2,
+                                                    canonical=True)
+    assert [(smi, mol_id) for smi, mol_id, _, _ in prepared] == [('CCO', 'a'), ('CCN', 'c')]
+    assert all(bfp is not None and can is not None for _, _, bfp, can in prepared)
+    assert rejected == [('C1CC', 'b')]
+
+
+def test_repeated_queries_are_memoized(prep, monkeypatch):
+    queries = [('CCO', 'a'), ('CCO', 'b'), ('C1CC', 'c'), ('C1CC', 'd')]
+    prepared, rejected = query_prep.prepare_queries(queries, 'morgan', 2)
+    assert profiler.counters['query_memo_hits'] == 2
+    assert prepared[0][2] == prepared[1][2]
+    assert rejected == [('C1CC', 'c'), ('C1CC', 'd')]
+    # memoized queries are prepared without the connection
+    monkeypatch.setattr(query_prep, '_con', None)
+    assert query_prep.prepare_queries(queries, 'morgan', 2) == (prepared, rejected)
+    assert profiler.counters['query_memo_hits'] == 6
+    # other fingerprints are not taken from the memo
+    with pytest.raises(AttributeError):
+        query_prep.prepare_queries(queries, 'morgan', 3)
+
+
+def test_memo_is_bounded(prep, monkeypatch):
+    monkeypatch.setattr(query_prep, 'MAX_MEMO', 2)
+    query_prep.prepare_queries([('CCO', 'a'), ('CCN', 'b'), ('CCO', 'a'), ('CCC', 'c')], 'morgan', 2)
+    assert list(query_prep._memo) == [('CCO', 'morgan', 2, False), ('CCC', 'morgan', 2, False)]
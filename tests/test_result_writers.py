@@ -0,0 +1,63 @@
+import gzip
+import sqlite3
+
+import pytest
+
+from result_writers import ResultWriter, SIMILARITY_COLUMNS, open_writer, output_format
+
+ROWS = [('CCO', 'q1', 'CCN', 'a', 0.5), ('CCO', 'q1', None, 'b', 0.25)]
+
+
+def test_result_writer_is_abstract():
+    with pytest.raises(TypeError):
+        ResultWriter(SIMILARITY_COLUMNS, 10)
+
+
+def test_output_format():
+    assert output_format(None) == 'tsv'
+    assert output_format('out.txt.gz') == 'tsv'
+    assert output_format('out.parquet') == 'parquet'
+    assert output_format('out.feather') == 'arrow'
+    assert output_format('out.db') == 'sqlite'
+    assert output_format('out.db', 'tsv') == 'tsv'
+
+
+@pytest.mark.parametrize('fname', ['out.txt', 'out.txt.gz'])
+def test_tsv_writer(tmp_path, fname):
+    fname = str(tmp_path / fname)
+    with open_writer(fname, SIMILARITY_COLUMNS) as writer:
+        writer.batch_size = 1
+        writer.write_rows(ROWS)
+    with (gzip.open(fname, 'rt') if fname.endswith('.gz') else open(fname)) as f:
+        assert f.read() == 'query_smi\tquery_id\tfound_smi\tfound_id\tsimilarity\n' \
+                           'CCO\tq1\tCCN\ta\t0.5\nCCO\tq1\tNone\tb\t0.25\n'
+
+
+def test_sqlite_writer(tmp_path):
+    fname = str(tmp_path / 'out.db')
+    with open_writer(fname, SIMILARITY_COLUMNS, table='hits') as writer:
+        writer.write_rows(ROWS)
+    with open_writer(fname, SIMILARITY_COLUMNS, table='hits') as writer:
+        writer.write_rows(ROWS[:1])
+    assert sqlite3.connect(fname).execute("SELECT * FROM hits").fetchall() == ROWS[:1]
+
+
+@pytest.mark.parametrize('fname', ['out.parquet', 'out.arrow'])
+def test_arrow_writer(tmp_path, fname):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    fname = str(tmp_path / fname)
+    with open_writer(fname, SIMILARITY_COLUMNS) as writer:
+        writer.batch_size = 1
+        writer.write_rows(ROWS)
+    if fname.endswith('.parquet'):
+        table = pq.read_table(fname)
+    else:
+        table = pa.ipc.open_file(fname).read_all()
+    assert table.column_names == [name for name, _ in SIMILARITY_COLUMNS]
+    assert [tuple(row.values()) for row in table.to_pylist()] == ROWS
+
+
+def test_binary_output_requires_file():
+    with pytest.raises(ValueError):
+        open_writer(None, SIMILARITY_COLUMNS, 'parquet')
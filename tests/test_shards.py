@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+
+import add_fp_to_db
+import create_db
+import shards
+import substr_search
+
+
+def test_merge_hits():
+    a = [('a1', 'x', 0.9), ('a2', 'x', 0.5), ('a3', 'x', 0.5)]
+    b = [('b1', 'y', 1.0), ('b2', 'y', 0.5), ('b3', 'y', 0.1)]
+    c = []
+    # ties are taken in the order of shards
+    assert [hit[0] for hit in shards.merge_hits([a, b, c])] == ['b1', 'a1', 'a2', 'a3', 'b2', 'b3']
+    assert [hit[0] for hit in shards.merge_hits([a, b, c], 4)] == ['b1', 'a1', 'a2', 'a3']
+    assert shards.merge_hits([c, c], 3) == []
+
+
+def test_shard_index():
+    # CRC32 of ids does not depend on the process, so compounds are routed to the same shards by every run
+    assert [shards.shard_index(mol_id, 4) for mol_id in ['m0', 'm1', 'm2', 'm3', 'CHEMBL25']] == [1, 3, 1, 3, 2]
+    assert [shards.shard_index(mol_id, 3, ['b', 'd']) for mol_id in ['a', 'b', 'c', 'd', 'e']] == [0, 1, 1, 2, 2]
+
+
+def test_range_bounds():
+    ids = [f'id{i:02d}' for i in range(10)]
+    bounds = shards.range_bounds(reversed(ids), 3)
+    assert bounds == ['id03', 'id06']
+    assert [sum(shards.shard_index(mol_id, 3, bounds) == i for mol_id in ids) for i in range(3)] == [3, 3, 4]
+    assert shards.range_bounds([], 3) == []
+
+
+def test_manifest(tmp_path, monkeypatch):
+    manifest = str(tmp_path / 'lib.json')
+    db_names = shards.compose_shard_names(manifest, 3)
+    assert db_names == [str(tmp_path / f'lib_{i}.db') for i in range(3)]
+    shards.write_manifest(manifest, db_names, 'range', 'mols', ['b', 'd'])
+    assert shards.read_manifest(manifest) == {'shard_by': 'range', 'table': 'mols', 'shards': db_names,
+                                              'bounds': ['b', 'd']}
+    # paths of shards are stored relative to the manifest, so they are found from any directory
+    with open(manifest) as f:
+        assert json.load(f)['shards'] == ['lib_0.db', 'lib_1.db', 'lib_2.db']
+    monkeypatch.chdir(tmp_path.parent)
+    assert shards.shard_db_names(os.path.join(tmp_path.name, 'lib.json')) == db_names
+    assert shards.shard_db_names('lib.db') == ['lib.db']
+    assert shards.is_manifest(manifest)
+
+
+def touch(db_name, ncpu):
+    with open(db_name, 'wt') as f:
+        f.write(str(ncpu))
+
+
+def fail(db_name, ncpu):
+    if db_name.endswith('1.db'):
+        raise ValueError(db_name)
+
+
+def test_run_on_shards(tmp_path):
+    db_names = [str(tmp_path / f'lib_{i}.db') for i in range(3)]
+    shards.run_on_shards(touch, db_names, ncpu=7)
+    assert [open(db_name).read() for db_name in db_names] == ['2', '2', '2']
+    with pytest.raises(RuntimeError, match='lib_1.db'):
+        shards.run_on_shards(fail, db_names)
+
+
+def test_sharded_substructure_search(tmp_path, chemicalite, run_script):
+    # without a limit sharded and unsharded DBs return the same hits, with a limit any limit hits are returned
+    lib = tmp_path / 'lib.smi'
+    lib.write_text(''.join(f'{smi} m{i}\n' for i, smi in enumerate(['c1ccccc1O', 'CCO', 'c1ccccc1CO', 'CCCC',
+                                                                   'Oc1ccc(O)cc1', 'CC(=O)O', 'c1ccncc1O'] * 3)))
+    for db, args in (('lib.db', ()), ('lib.json', ('--shards', 3))):
+        run_script(create_db, '-i', lib, '-o', tmp_path / db, '-m', 'mol', *args)
+        run_script(add_fp_to_db, '-d', tmp_path / db, '-f', 'pattern')
+    found = {}
+    for db in ('lib.db', 'lib.json'):
+        for limit in ((), ('-l', 4)):
+            output = tmp_path / 'output.txt'
+            run_script(substr_search, '-d', tmp_path / db, '-q', 'cO', '-o', output, *limit)
+            found[db, limit] = output.read_text().splitlines()
+    assert sorted(found['lib.db', ()]) == sorted(found['lib.json', ()])
+    assert len(found['lib.db', ()]) == 9
+    for db in ('lib.db', 'lib.json'):
+        assert len(found[db, ('-l', 4)]) == 4
+        assert set(found[db, ('-l', 4)]) <= set(found[db, ()])
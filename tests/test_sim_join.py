@@ -0,0 +1,139 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import fp_matrix
+import sim_join
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(sim_join, 'LIB_BLOCK', 64)
+    monkeypatch.setattr(sim_join, 'QUERY_BLOCK', 8)
+
+
+@pytest.fixture
+def library(random_fps):
+    fps = random_fps(250, seed=5)
+    return fps, fp_matrix.popcount(fps)
+
+
+def self_pairs(sim, threshold):
+    i, j = np.nonzero(np.triu(sim >= threshold, k=1))
+    return sorted(zip(i.tolist(), j.tolist()))
+
+
+def test_popcount_range():
+    cnt = np.array([1, 2, 4, 5, 8, 10, 20])
+    # bit counts b reachable from queries with counts 4..5 at 0.5: 2 <= b <= 10
+    assert sim_join.popcount_range(cnt, 4, 5, 0.5) == (1, 6)
+    assert sim_join.popcount_range(cnt, 4, 5, 0) == (0, len(cnt))
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+@pytest.mark.parametrize('threshold', [0.2, 0.5, 0.9])
+def test_self_join(library, brute_force_tanimoto, ncpu, threshold):
+    fps, cnt = library
+    sim = brute_force_tanimoto(fps, fps)
+    ai, bi, s = sim_join.run_join(fps, cnt, None, None, threshold, ncpu=ncpu)
+    assert sorted(zip(np.minimum(ai, bi).tolist(), np.maximum(ai, bi).tolist())) == self_pairs(sim, threshold)
+    assert np.allclose(s, sim[ai, bi])
+
+
+@pytest.mark.parametrize('ncpu', [1, 3])
+def test_join(library, random_fps, brute_force_tanimoto, ncpu):
+    fps, cnt = library
+    b = random_fps(120, seed=6)
+    sim = brute_force_tanimoto(fps, b)
+    ai, bi, s = sim_join.run_join(fps, cnt, b, fp_matrix.popcount(b), 0.4, ncpu=ncpu)
+    i, j = np.nonzero(sim >= 0.4)
+    assert sorted(zip(ai.tolist(), bi.tolist())) == sorted(zip(i.tolist(), j.tolist()))
+    assert np.allclose(s, sim[ai, bi])
+
+
+def neighbours(fps, cnt, threshold):
+    ai, bi, s = sim_join.run_join(fps, cnt, None, None, threshold)
+    return sim_join.self_neighbour_lists(len(fps), ai, bi, s)
+
+
+def test_neighbour_lists(library, brute_force_tanimoto, tmp_path):
+    fps, cnt = library
+    sim = brute_force_tanimoto(fps, fps)
+    np.fill_diagonal(sim, -1)
+    indptr, indices, sims = neighbours(fps, cnt, 0.3)
+    for i in range(len(fps)):
+        nb, nb_sims = indices[indptr[i]:indptr[i + 1]], sims[indptr[i]:indptr[i + 1]]
+        assert sorted(nb.tolist()) == np.nonzero(sim[i] >= 0.3)[0].tolist()
+        assert (np.diff(nb_sims) <= 0).all()
+    # lists filtered by a higher threshold are the same as lists computed with it
+    for x, y in zip(sim_join.filter_neighbours(indptr, indices, sims, 0.6), neighbours(fps, cnt, 0.6)):
+        assert np.array_equal(x, y)
+    fname = str(tmp_path / 'neighbours.npz')
+    sim_join.save_neighbours(fname, indptr, indices, sims, 0.3)
+    loaded = sim_join.load_neighbours(fname)
+    assert all(np.array_equal(x, y) for x, y in zip(loaded[:3], (indptr, indices, sims)))
+    assert loaded[3] == 0.3
+
+
+def reference_sphere_exclusion(sim, threshold, order):
+    cluster = [-1] * len(sim)
+    centroids = []
+    for i in order:
+        if cluster[i] < 0:
+            cluster[i] = len(centroids)
+            for j in range(len(sim)):
+                if j != i and cluster[j] < 0 and sim[i, j] >= threshold:
+                    cluster[j] = len(centroids)
+            centroids.append(i)
+    return cluster, centroids
+
+
+@pytest.mark.parametrize('method', ['butina', 'leader'])
+def test_sphere_exclusion(library, brute_force_tanimoto, method):
+    fps, cnt = library
+    sim = brute_force_tanimoto(fps, fps)
+    indptr, indices, sims = neighbours(fps, cnt, 0.5)
+    order = sim_join.cluster_order(indptr, method)
+    counts = (sim >= 0.5).sum(axis=1) - 1
+    if method == 'butina':
+        assert np.array_equal(order, np.argsort(-counts, kind='stable'))
+    else:
+        assert np.array_equal(order, np.arange(len(fps)))
+    cluster, centroid_sim, centroids = sim_join.sphere_exclusion(indptr, indices, sims, order)
+    expected_cluster, expected_centroids = reference_sphere_exclusion(sim, 0.5, order)
+    assert cluster.tolist() == expected_cluster
+    assert centroids == expected_centroids
+    centroid = np.array(centroids)[cluster]
+    is_centroid = centroid == np.arange(len(fps))
+    assert np.allclose(centroid_sim[is_centroid], 1)
+    assert np.allclose(centroid_sim[~is_centroid], sim[centroid, np.arange(len(fps))][~is_centroid])
+
+
+def reference_maxmin(sim, k, seed):
+    picks = [int(np.random.default_rng(seed).integers(len(sim)))]
+    picks_sim = [0.0]
+    while len(picks) < k:
+        max_sim = sim[picks].max(axis=0)
+        max_sim[picks] = np.inf
+        picks.append(int(np.argmin(max_sim)))
+        picks_sim.append(float(max_sim[picks[-1]]))
+    return picks, picks_sim
+
+
+@pytest.mark.parametrize('seed', [0, 7])
+def test_maxmin_pick(library, brute_force_tanimoto, seed):
+    fps, cnt = library
+    sim = brute_force_tanimoto(fps, fps)
+    picks, picks_sim = sim_join.maxmin_pick(fps, cnt, 30, seed=seed)
+    expected_picks, expected_sim = reference_maxmin(sim, 30, seed)
+    assert picks == expected_picks
+    assert np.allclose(picks_sim, expected_sim)
+    assert len(set(picks)) == 30
+    # every next pick is at least as similar to previous picks as the ones before it
+    assert (np.diff(picks_sim[1:]) >= 0).all()
+
+
+def test_maxmin_pick_all(library):
+    fps, cnt = library
+    picks, _ = sim_join.maxmin_pick(fps[:10], cnt[:10], 20)
+    assert sorted(picks) == list(range(10))
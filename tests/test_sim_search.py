@@ -0,0 +1,121 @@
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import fp_matrix
+import sim_search
+from add_fp_to_db import create_bfp_table
+from profiling import profiler
+
+
+def tanimoto(a, b):
+    # reference bfp_tanimoto of Chemicalite
+    x, y = int.from_bytes(a, 'little'), int.from_bytes(b, 'little')
+    union = bin(x | y).count('1')
+    return bin(x & y).count('1') / union if union else 0.0
+
+
+@pytest.fixture
+def library(random_fps):
+    fps = random_fps(400, seed=8)
+    return fps, fp_matrix.popcount(fps)
+
+
+@pytest.fixture
+def con(library):
+    # DB with stored fingerprints, Chemicalite is not needed to score them
+    fps, cnt = library
+    con = sqlite3.connect(':memory:')
+    con.create_function('bfp_tanimoto', 2, tanimoto)
+    con.execute("CREATE TABLE mols (smi TEXT, id TEXT)")
+    create_bfp_table(con, 'mols_morgan2_bfp')
+    for i, (row, b) in enumerate(zip(fps, cnt)):
+        con.execute("INSERT INTO mols (rowid, smi, id) VALUES (?, ?, ?)", (i + 1, f'smi{i}', f'id{i}'))
+        con.execute("INSERT INTO mols_morgan2_bfp (id, fp, popcnt) VALUES (?, ?, ?)", (i + 1, row.tobytes(), int(b)))
+    profiler.enable()
+    yield con
+    profiler.enabled = False
+    con.close()
+
+
+@pytest.fixture
+def queries(random_fps):
+    return random_fps(15, seed=9)
+
+
+def test_bfp_popcount(library):
+    fps, cnt = library
+    assert [sim_search.bfp_popcount(row.tobytes()) for row in fps] == cnt.tolist()
+
+
+@pytest.mark.parametrize('threshold', [0.0, 0.2, 0.5, 0.8, 1.0])
+def test_popcount_bounds(library, queries, brute_force_tanimoto, threshold):
+    # compounds outside the bounds cannot reach the threshold
+    fps, cnt = library
+    sim = brute_force_tanimoto(queries, fps)
+    for i, row in enumerate(queries):
+        lo, hi = sim_search.popcount_bounds(row.tobytes(), threshold)
+        assert ((cnt >= lo) & (cnt <= hi))[sim[i] >= threshold].all()
+
+
+def test_similarity_bound(library, queries, brute_force_tanimoto):
+    fps, cnt = library
+    sim = brute_force_tanimoto(queries, fps)
+    bound = np.array([[sim_search.similarity_bound(a, b) for b in cnt] for a in fp_matrix.popcount(queries)])
+    assert (sim <= bound + 1e-9).all()
+    assert sim_search.similarity_bound(0, 0) == 1.0
+
+
+@pytest.mark.parametrize('threshold', [0.3, 0.6])
+def test_popcount_search(con, library, queries, brute_force_tanimoto, threshold):
+    fps, _ = library
+    sim = brute_force_tanimoto(queries, fps)
+    for i, row in enumerate(queries):
+        res = sim_search.search_similar(con, row.tobytes(), threshold, 'morgan', 'mol', 'mols', stored_bfp=True,
+                                        method='popcount')
+        expected = np.nonzero(sim[i] >= threshold)[0]
+        assert sorted(found_id for _, found_id, _ in res) == sorted(f'id{j}' for j in expected)
+        assert [t for _, _, t in res] == sorted((t for _, _, t in res), reverse=True)
+
+
+@pytest.mark.parametrize('k', [1, 5, 50])
+def test_popcount_nearest_neighbours(con, library, queries, brute_force_tanimoto, k):
+    fps, cnt = library
+    sim = brute_force_tanimoto(queries, fps)
+    for i, row in enumerate(queries):
+        res = sim_search.popcount_nearest_neighbours(con, row.tobytes(), k, 'morgan', 'mols')
+        assert [t for _, _, t in res] == pytest.approx(np.sort(sim[i])[::-1][:k].tolist())
+        assert [t for _, _, t in res] == pytest.approx([sim[i, int(found_id[2:])] for _, found_id, _ in res])
+    # buckets are pruned by the similarity bound
+    assert profiler.counters['popcount_buckets'] < len(queries) * len(set(cnt.tolist()))
+
+
+def test_bucket_order(con, library, queries, brute_force_tanimoto, monkeypatch):
+    fps, cnt = library
+    sim = brute_force_tanimoto(queries, fps)
+    scanned = []
+    fetchall = profiler.fetchall
+    monkeypatch.setattr(profiler, 'fetchall', lambda con, sql, params: scanned.append(params[1]) or
+                        fetchall(con, sql, params))
+    for i, row in enumerate(queries):
+        scanned.clear()
+        sim_search.popcount_nearest_neighbours(con, row.tobytes(), 5, 'morgan', 'mols')
+        a = sim_search.bfp_popcount(row.tobytes())
+        # buckets are scanned by decreasing bound until the bound cannot exceed the 5th best found similarity
+        expected = []
+        for bound, b in sorted(((sim_search.similarity_bound(a, b), b) for b in set(cnt.tolist())), reverse=True):
+            found = np.sort(sim[i][np.isin(cnt, expected)])[::-1]
+            if len(found) >= 5 and bound <= found[4]:
+                break
+            expected.append(b)
+        assert scanned == expected
+        # skipped buckets do not contain closer compounds
+        skipped = ~np.isin(cnt, scanned)
+        assert (sim[i][skipped] <= np.sort(sim[i][~skipped])[::-1][4] + 1e-9).all()
+
+
+def test_nearest_neighbours_popcount_requires_stored_bfp(con):
+    with pytest.raises(ValueError):
+        sim_search.nearest_neighbours(con, b'\0' * 256, 5, 'morgan', 'mol', 'mols', method='popcount')
@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+
+import structure_keys
+
+
+@pytest.fixture
+def con():
+    # rows 2 and 4 repeat the structure of row 1, row 5 repeats row 3, row 6 has no key
+    con = sqlite3.connect(':memory:')
+    con.execute("CREATE TABLE mols (id TEXT, smi TEXT, canon_smi TEXT)")
+    con.executemany("INSERT INTO mols (rowid, id, smi, canon_smi) VALUES (?, ?, ?, ?)",
+                    [(1, 'a', 'CCO', 'CCO'), (2, 'b', 'OCC', 'CCO'), (3, 'c', 'CN', 'CN'), (4, 'd', 'C(C)O', 'CCO'),
+                     (5, 'e', 'NC', 'CN'), (6, 'f', 'X', None), (7, 'g', 'Y', None), (8, 'h', 'CCC', 'CCC')])
+    for t in ('mols_morgan2_idx', 'mols_morgan2_bfp'):
+        con.execute(f"CREATE TABLE {t} (id INTEGER PRIMARY KEY, fp BLOB)")
+        con.execute(f"INSERT INTO {t} (id, fp) SELECT rowid, smi FROM mols")
+    return con
+
+
+def test_find_duplicated_structures(con):
+    assert structure_keys.find_duplicated_structures(con, 'mols', 'canon_smi') == \
+        [(2, 'b', 'CCO', 'a'), (4, 'd', 'CCO', 'a'), (5, 'e', 'CN', 'c')]
+
+
+def test_dedup_report(con, tmp_path):
+    report = tmp_path / 'report.txt'
+    n = structure_keys.dedup_structures(con, 'mols', 'canon_smi', [], report_fname=report)
+    assert n == 3
+    assert report.read_text() == 'id\tcanon_smi\tkept_id\nb\tCCO\ta\nd\tCCO\ta\ne\tCN\tc\n'
+    assert con.execute("SELECT count(*) FROM mols").fetchone()[0] == 8
+
+
+def test_dedup_remove_keeps_first_record(con):
+    extra_tables = ['mols_morgan2_idx', 'mols_morgan2_bfp']
+    structure_keys.dedup_structures(con, 'mols', 'canon_smi', extra_tables, remove=True)
+    assert [i for i, in con.execute("SELECT rowid FROM mols ORDER BY rowid")] == [1, 3, 6, 7, 8]
+    for t in extra_tables:
+        assert [i for i, in con.execute(f"SELECT id FROM {t} ORDER BY id")] == [1, 3, 6, 7, 8]
+    assert structure_keys.find_duplicated_structures(con, 'mols', 'canon_smi') == []
+
+
+def test_create_key_columns_and_indexes(con):
+    structure_keys.create_key_columns(con, 'mols', ['canon_smi', 'inchikey'])
+    structure_keys.create_key_indexes(con, 'mols', ['canon_smi', 'inchikey'])
+    assert [i[1] for i in con.execute("PRAGMA table_info(mols)")] == ['id', 'smi', 'canon_smi', 'inchikey']
+    assert {i[1] for i in con.execute("PRAGMA index_list(mols)")} == {'mols_canon_smi_idx', 'mols_inchikey_idx'}
+
+
+def test_sql_for_key():
+    assert structure_keys.sql_for_key('canon_smi', 'm') == 'mol_to_smiles(m)'
+    assert structure_keys.sql_for_key('inchikey', 'm') == 'inchikey(mol_to_smiles(m))'
+    with pytest.raises(ValueError):
+        structure_keys.sql_for_key('smiles', 'm')